@@ -5,7 +5,7 @@ import numpy as np
 from astropy.wcs import WCS, WcsError
 
 from datalab.datalab_session.exceptions import ClientAlertException
-from datalab.datalab_session.utils.file_utils import get_hdu, scale_points
+from datalab.datalab_session.utils.file_utils import get_fits_header, scale_points
 from datalab.datalab_session.utils.filecache import FileCache
 from datalab.datalab_session.utils.centroiding import centroid
 
@@ -31,14 +31,16 @@ def centroiding(input: dict, user: 'User'):
     }
   """
   try:
-    file_path = FileCache().get_fits(input['basename'], input.get('source', 'archive'), user)
-    sci_hdu = get_hdu(file_path, 'SCI')
+    file_cache = FileCache()
+    file_path = file_cache.get_fits(input['basename'], input.get('source', 'archive'), user)
+    sci_header = get_fits_header(file_path, 'SCI')
+    sci_data = file_cache.get_sci_data(file_path)
   except TimeoutError:
     raise ClientAlertException(f"Download of {input['basename']} timed out")
   except TypeError as e:
     raise ClientAlertException(f'Error: {e}')
 
-  image = np.asarray(sci_hdu.data, dtype=float)
+  image = np.asarray(sci_data, dtype=float)
   if image.ndim != 2:
     message = f"Centroiding requires a 2D image, received shape {image.shape}."
     log.error(message)
@@ -78,7 +80,7 @@ def centroiding(input: dict, user: 'User'):
   ra = None
   dec = None
   try:
-    wcs = WCS(sci_hdu.header)
+    wcs = WCS(sci_header)
     if wcs.get_axis_types()[0].get('coordinate_type') is None:
       raise WcsError("No valid WCS solution")
     sky_coord = wcs.pixel_to_world(result.y - 1, result.x - 1)
@@ -5,7 +5,7 @@ from astropy import coordinates
 from django.contrib.auth.models import User
 
 from datalab.datalab_session.exceptions import ClientAlertException
-from datalab.datalab_session.utils.file_utils import scale_points, get_hdu
+from datalab.datalab_session.utils.file_utils import scale_points, get_fits_header
 from datalab.datalab_session.utils.filecache import FileCache
 
 # For creating an array of brightness along a user drawn line
@@ -23,21 +23,23 @@ def line_profile(input: dict, user: User):
     }
   """
   try:
-    file_path = FileCache().get_fits(input['basename'], input['source'], user)
-    sci_hdu = get_hdu(file_path, 'SCI')
+    file_cache = FileCache()
+    file_path = file_cache.get_fits(input['basename'], input['source'], user)
+    sci_header = get_fits_header(file_path, 'SCI')
+    sci_data = file_cache.get_sci_data(file_path)
   except TimeoutError as e:
     raise ClientAlertException(f"Download of {input['basename']} timed out")
   except TypeError as e:
     raise ClientAlertException(f'Error: {e}')
 
-  x_points, y_points = scale_points(input["height"], input["width"], sci_hdu.data.shape[0], sci_hdu.data.shape[1], x_points=[input["x1"], input["x2"]], y_points=[input["y1"], input["y2"]])
+  x_points, y_points = scale_points(input["height"], input["width"], sci_data.shape[0], sci_data.shape[1], x_points=[input["x1"], input["x2"]], y_points=[input["y1"], input["y2"]])
   # Line profile and distance in arcseconds
-  line_profile = profile_line(sci_hdu.data, (x_points[0], y_points[0]), (x_points[1], y_points[1]), mode="constant", cval=-1)
+  line_profile = profile_line(sci_data, (x_points[0], y_points[0]), (x_points[1], y_points[1]), mode="constant", cval=-1)
 
 
   # Calculates for coordinates, angular distance, and position angle
   try:
-    wcs = WCS(sci_hdu.header)
+    wcs = WCS(sci_header)
 
     if(wcs.get_axis_types()[0].get('coordinate_type') == None):
       raise WcsError("No valid WCS solution")
@@ -62,7 +64,7 @@ def line_profile(input: dict, user: User):
 
     try:
       # fallback: use pixscale to calculate the arcsec distance
-      arcsec = (len(line_profile)-1) * sci_hdu.header["PIXSCALE"]
+      arcsec = (len(line_profile)-1) * sci_header["PIXSCALE"]
     except KeyError:
       arcsec = None
 
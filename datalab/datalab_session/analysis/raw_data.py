@@ -3,41 +3,41 @@ import numpy as np
 import math
 from django.contrib.auth.models import User
 from datalab.datalab_session.exceptions import ClientAlertException
-from datalab.datalab_session.utils.file_utils import get_hdu
+from datalab.datalab_session.utils.file_utils import get_fits_header
 from datalab.datalab_session.utils.filecache import FileCache
 from fits2image.scaling import calc_zscale_min_max
 import cv2
 # TODO: This analysis endpoint assumes the image to be of 16 bitdepth. We should make this agnositc to bit depth in the future
 
 
-def extract_samples_in_place(image_array:np.ndarray, naxis1, naxis2):
+def extract_samples(image_array:np.ndarray, naxis1, naxis2):
     flat_image_data = image_array.ravel()
     sample_stride = (naxis1 * naxis2) / 2000
-    samples = flat_image_data[int(sample_stride)::int(sample_stride)]
-    samples.sort()
-    return samples
+    # Sorted into a copy since the image may be a read-only memory map
+    return np.sort(flat_image_data[int(sample_stride)::int(sample_stride)])
 
 
 def raw_data(input: dict, user: User):
+    file_cache = FileCache()
     try:
-        file_path = FileCache().get_fits(input['basename'], input.get('source', 'archive'), user)
+        file_path = file_cache.get_fits(input['basename'], input.get('source', 'archive'), user)
     except TimeoutError as e:
         raise ClientAlertException(f"Download of {input['basename']} timed out")
     except KeyError as e:
         raise ClientAlertException(e)
     
-    sci_hdu = get_hdu(file_path, 'SCI')
-    image_data = sci_hdu.data
+    sci_header = get_fits_header(file_path, 'SCI')
+    image_data = file_cache.get_sci_data(file_path)
 
     # Compute the fits2image autoscale params to send with the image
-    samples = extract_samples_in_place(image_data, sci_hdu.header.get('NAXIS1'), sci_hdu.header.get('NAXIS2'))
+    samples = extract_samples(image_data, sci_header.get('NAXIS1'), sci_header.get('NAXIS2'))
     median = np.median(samples)
     zmin, zmax, _ = calc_zscale_min_max(samples, contrast=0.1, iterations=1)
 
     # resize the image to max. 500 pixels on an axis by default for the UI
     max_size = input.get('max_size', 500)
-    bitpix = abs(int(sci_hdu.header.get('BITPIX', 16)))
-    max_value = int(sci_hdu.header.get('SATURATE', 0))  # If saturate header is present, use that as max value
+    bitpix = abs(int(sci_header.get('BITPIX', 16)))
+    max_value = int(sci_header.get('SATURATE', 0))  # If saturate header is present, use that as max value
     match bitpix:
         case 8:
             datatype = np.uint8
@@ -2,7 +2,7 @@ from django.contrib.auth.models import User
 
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.catalog_utils import ra_dec_from_wcs
-from datalab.datalab_session.utils.file_utils import get_fits_dimensions, get_hdu, scale_points
+from datalab.datalab_session.utils.file_utils import get_catalog, get_fits_dimensions, scale_points
 from datalab.datalab_session.utils.filecache import FileCache
 from datalab.datalab_session.utils.flux_to_mag import flux_to_mag
 
@@ -28,39 +28,39 @@ def source_catalog(input: dict, user: User):
     Returns a dict representing the source catalog data with xwin,ywin coordinates and flux values
   """
   try:
-    file_path = FileCache().get_fits(input['basename'], input.get('source', 'archive'), user)
+    file_path = FileCache().get_fits(input['basename'], input.get('source', 'archive'), user, metadata_only=True)
   except TimeoutError as e:
     raise ClientAlertException(f"Download of {input['basename']} timed out")
   
-  cat_hdu = get_hdu(file_path, 'CAT')
+  cat_data = get_catalog(file_path)
 
   DECIMALS_OF_PRECISION = 6
-  MAX_SOURCE_CATALOG_SIZE = min(len(cat_hdu.data["x"]), 1000)
+  MAX_SOURCE_CATALOG_SIZE = min(len(cat_data["x"]), 1000)
 
   # get xwin,ywin and flux values
   # We get xwin and ywin because they provide more accurate centroid positions
   # Which in turn return more precise values for separation and positon angles for binary and blended stars
-  x_points = cat_hdu.data["xwin"][:MAX_SOURCE_CATALOG_SIZE]
-  y_points = cat_hdu.data["ywin"][:MAX_SOURCE_CATALOG_SIZE]
-  x = cat_hdu.data["x"][:MAX_SOURCE_CATALOG_SIZE]
-  y = cat_hdu.data["y"][:MAX_SOURCE_CATALOG_SIZE]
-  flux = cat_hdu.data["flux"][:MAX_SOURCE_CATALOG_SIZE]
-  fluxerr = cat_hdu.data["fluxerr"][:MAX_SOURCE_CATALOG_SIZE]
+  x_points = cat_data["xwin"][:MAX_SOURCE_CATALOG_SIZE]
+  y_points = cat_data["ywin"][:MAX_SOURCE_CATALOG_SIZE]
+  x = cat_data["x"][:MAX_SOURCE_CATALOG_SIZE]
+  y = cat_data["y"][:MAX_SOURCE_CATALOG_SIZE]
+  flux = cat_data["flux"][:MAX_SOURCE_CATALOG_SIZE]
+  fluxerr = cat_data["fluxerr"][:MAX_SOURCE_CATALOG_SIZE]
   flux_fallback = False
-  if "mag" in cat_hdu.data.names and "magerr" in cat_hdu.data.names:
-    mag = cat_hdu.data["mag"][:MAX_SOURCE_CATALOG_SIZE]
-    magerr = cat_hdu.data["magerr"][:MAX_SOURCE_CATALOG_SIZE]
+  if "mag" in cat_data.names and "magerr" in cat_data.names:
+    mag = cat_data["mag"][:MAX_SOURCE_CATALOG_SIZE]
+    magerr = cat_data["magerr"][:MAX_SOURCE_CATALOG_SIZE]
   else:
     mag, magerr = flux_to_mag(flux, fluxerr)
     flux_fallback = True
 
   # ra, dec values may or may not be present in the CAT hdu
-  if "ra" in cat_hdu.data.names and "dec" in cat_hdu.data.names:
-    ra = cat_hdu.data["ra"][:MAX_SOURCE_CATALOG_SIZE]
-    dec = cat_hdu.data["dec"][:MAX_SOURCE_CATALOG_SIZE]
+  if "ra" in cat_data.names and "dec" in cat_data.names:
+    ra = cat_data["ra"][:MAX_SOURCE_CATALOG_SIZE]
+    dec = cat_data["dec"][:MAX_SOURCE_CATALOG_SIZE]
   else:
     try:
-      ra, dec = ra_dec_from_wcs(file_path, cat_hdu.data[:MAX_SOURCE_CATALOG_SIZE], input['basename'])
+      ra, dec = ra_dec_from_wcs(file_path, cat_data[:MAX_SOURCE_CATALOG_SIZE], input['basename'])
     except ClientAlertException:
       # The overlay is still useful without sky coordinates, so a catalog with no x/y columns or
       # an image with no WCS solution drops ra/dec instead of failing the whole analysis
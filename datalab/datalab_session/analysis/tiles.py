@@ -0,0 +1,122 @@
+import base64
+import math
+import os
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from datalab.datalab_session.exceptions import ClientAlertException
+from datalab.datalab_session.utils.file_utils import get_fits_header
+from datalab.datalab_session.utils.filecache import FileCache
+from datalab.datalab_session.utils.tile_pyramid import (TILE_SIZE, level_shapes, pyramid_cache_key, read_tile,
+                                                        tile_grid, write_pyramid)
+
+# Most bytes of tile pixels returned for one viewport, about 5.6MB of json once base64 encoded. That's 16 float32 tiles,
+# or 32 of uint16 or float16
+MAX_TILE_BYTES = 4 * 1024 * 1024
+
+
+def has_integer_pixels(header) -> bool:
+  """ Whether the pixels of an image with header are integers, i.e. stored as integers and not scaled to fractions """
+  return int(header.get('BITPIX', -32)) > 0 and float(header.get('BSCALE', 1)) == 1 and float(header.get('BZERO', 0)).is_integer()
+
+
+def get_tile_pyramid(file_cache: FileCache, file_path: str):
+  """
+    Returns the memory-mapped stored tiles of the pyramid of a cached fits file and its SCI pixels. The pyramid is built
+    on first access and kept in the FileCache, so later viewports of the file only read the tiles they cover.
+    Call it under a FileCache lease, which pins the cached pyramid until it is mapped.
+  """
+  sci_data = file_cache.get_sci_data(file_path)
+  cache_key = pyramid_cache_key(os.path.basename(file_path).split('.')[0])
+  pyramid_path = file_cache.get_cached_file(cache_key)
+  if pyramid_path is None:
+    integer = has_integer_pixels(get_fits_header(file_path, 'SCI'))
+    pyramid_path = write_pyramid(settings.TEMP_FITS_DIR, cache_key, sci_data, integer, settings.OPERATION_MEMORY_BUDGET)
+    # Mapped before the pyramid is added, so an eviction right after still leaves this request its tiles
+    pyramid = np.load(pyramid_path, mmap_mode='r')
+    file_cache.add_file_to_cache(pyramid_path, fits_file=False)
+    return pyramid, sci_data
+  return np.load(pyramid_path, mmap_mode='r'), sci_data
+
+
+def tiles(input: dict, user: User):
+  """
+    Returns the tiles of a level of the image's tile pyramid covering a viewport. Level 0 is full resolution and every
+    level above it half the size of the one before, so the frontend can zoom and pan without full resolution pixels.
+    input = {
+      basename (str): The name of the file to tile
+      source (str): The source of the file, archive by default
+      x (int): The first column of the viewport in full resolution pixels, 0 by default
+      y (int): The first row of the viewport in full resolution pixels, 0 by default
+      width (int): The width of the viewport in full resolution pixels, the whole image by default
+      height (int): The height of the viewport in full resolution pixels, the whole image by default
+      level (int): The pyramid level to return, by default the finest showing the viewport in max_size pixels a side
+      max_size (int): The size to fit the viewport in when no level is given, 500 by default
+    }
+    Tiles are TILE_SIZE pixels a side, cropped at the edge of the level, and placed by their x and y in the level's
+    pixels. Their rows are in the order of the fits file, the first row being the bottom of the image. Their pixels are
+    base64 encoded little endian values of dtype, uint16, float16 or float32 depending on the range of the image's pixels.
+  """
+  file_cache = FileCache()
+  # The file, its sidecar and pyramid are pinned until mapped, so an eviction can't remove them in between. Once mapped
+  # they stay readable even if evicted
+  with file_cache.lease():
+    try:
+      file_path = file_cache.get_fits(input['basename'], input.get('source', 'archive'), user)
+    except TimeoutError as e:
+      raise ClientAlertException(f"Download of {input['basename']} timed out")
+
+    pyramid, sci_data = get_tile_pyramid(file_cache, file_path)
+  shapes = level_shapes(sci_data.shape)
+
+  x, y = int(input.get('x', 0)), int(input.get('y', 0))
+  width, height = int(input.get('width', sci_data.shape[1] - x)), int(input.get('height', sci_data.shape[0] - y))
+  if width <= 0 or height <= 0 or x < 0 or y < 0 or x >= sci_data.shape[1] or y >= sci_data.shape[0]:
+    raise ClientAlertException(f'Viewport {width}x{height} at ({x}, {y}) is outside the {sci_data.shape[1]}x{sci_data.shape[0]} image')
+
+  if input.get('level') is None:
+    max_size = int(input.get('max_size', 500))
+    if max_size <= 0:
+      raise ClientAlertException(f'max_size {max_size} must be positive')
+    level = min(len(shapes) - 1, max(0, math.ceil(math.log2(max(width, height) / max_size))))
+  else:
+    level = int(input['level'])
+  if not 0 <= level < len(shapes):
+    raise ClientAlertException(f'Level {level} is not in the {len(shapes)} levels of the image')
+
+  # The tiles of the level the viewport overlaps
+  scale = 2 ** level
+  rows, columns = tile_grid(shapes[level])
+  first_row, first_column = y // scale // TILE_SIZE, x // scale // TILE_SIZE
+  last_row = min(rows - 1, (y + height - 1) // scale // TILE_SIZE)
+  last_column = min(columns - 1, (x + width - 1) // scale // TILE_SIZE)
+  tile_count = (last_row - first_row + 1) * (last_column - first_column + 1)
+  max_tiles = MAX_TILE_BYTES // (TILE_SIZE * TILE_SIZE * pyramid.dtype.itemsize)
+  if tile_count > max_tiles:
+    raise ClientAlertException(f'Viewport covers {tile_count} tiles at level {level}, more than {max_tiles}. Use a coarser level')
+
+  tile_list = []
+  for row in range(first_row, last_row + 1):
+    for column in range(first_column, last_column + 1):
+      tile = read_tile(sci_data, pyramid, level, row, column)
+      tile_list.append({
+        'row': row,
+        'column': column,
+        'x': column * TILE_SIZE,
+        'y': row * TILE_SIZE,
+        'width': tile.shape[1],
+        'height': tile.shape[0],
+        'data': base64.b64encode(np.ascontiguousarray(tile, dtype=tile.dtype.newbyteorder('<')).tobytes()).decode('utf-8'),
+      })
+
+  return {
+    'level': level,
+    'levels': len(shapes),
+    'tile_size': TILE_SIZE,
+    'width': shapes[level][1],
+    'height': shapes[level][0],
+    'dtype': pyramid.dtype.name,
+    'tiles': tile_list,
+  }
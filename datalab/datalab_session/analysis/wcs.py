@@ -17,7 +17,7 @@ def wcs(input: dict, user: User):
   }
   """
   try:
-    file_path = FileCache().get_fits(input['basename'], input['source'], user)
+    file_path = FileCache().get_fits(input['basename'], input['source'], user, metadata_only=True)
     sci_header = get_fits_header(file_path, 'SCI')
     fits_dimensions = [sci_header.get('NAXIS1'), sci_header.get('NAXIS2')]
   except TimeoutError as e:
@@ -6,6 +6,7 @@ constructs. Three rather than one with a mode, because each advertises different
 """
 import logging
 from abc import ABC
+from contextlib import ExitStack
 from dataclasses import asdict, dataclass
 from typing import Any, Mapping
 
@@ -33,7 +34,7 @@ from datalab.datalab_session.utils.filecache import FileCache
 from datalab.datalab_session.utils.format import Format
 from datalab.datalab_session.utils.moving_target_search import DEFAULT_TRACK_SEARCH_RADIUS_ARCSEC
 from datalab.datalab_session.utils.period_analysis import PeriodAnalysis
-from datalab.datalab_session.utils.s3_utils import save_files_to_s3
+from datalab.datalab_session.utils.s3_utils import save_batch_to_s3
 from datalab.datalab_session.utils.target_location import (
     EphemerisHeaders,
     FittedTrack,
@@ -176,11 +177,15 @@ class AperturePhotometryOperation(BaseDataOperation, ABC):
 
         try:
             # Pixel data is loaded and released frame by frame inside generate_light_curve, so only
-            # the paths are resolved here.
-            file_cache = FileCache()
+            # the paths are resolved here, downloading the frames in parallel.
+            fits_futures = FileCache().prefetch(
+                [input_file['basename'] for input_file in input_files],
+                [input_file.get('source') for input_file in input_files],
+                submitter,
+            )
             fits_paths = []
-            for index, input_file in enumerate(input_files, start=1):
-                fits_paths.append(file_cache.get_fits(input_file['basename'], input_file.get('source'), submitter))
+            for index, fits_future in enumerate(fits_futures, start=1):
+                fits_paths.append(fits_future.result())
                 self._report_progress(Phase.DOWNLOADING, index / len(input_files))
 
             result = generate_light_curve(
@@ -254,17 +259,23 @@ class AperturePhotometryOperation(BaseDataOperation, ABC):
         self.set_message(f"{step.message}: {fraction * 100:.0f}%")
 
     def _save_diagnostic_images(self, jpegs_by_fits_basename: dict[str, bytes]) -> dict[str, str]:
-        """Uploads each frame's diagnostic overlay, returning FITS basename to presigned url."""
-        urls: dict[str, str] = {}
-        total = len(jpegs_by_fits_basename)
-        for index, (fits_basename, jpeg_bytes) in enumerate(jpegs_by_fits_basename.items(), start=1):
-            with temp_file_manager(f'{self.cache_key}-{index}-diagnostic.jpg', dir=self.temp) as jpeg_path:
+        """Uploads every frame's diagnostic overlay in one batch, returning FITS basename to presigned url."""
+        # Each frame's upload index, used both to name its upload and to map its url back
+        indexed_basenames = list(enumerate(jpegs_by_fits_basename, start=1))
+        with ExitStack() as stack:
+            file_paths_by_index = {}
+            for index, fits_basename in indexed_basenames:
+                jpeg_path = stack.enter_context(
+                    temp_file_manager(f'{self.cache_key}-{index}-diagnostic.jpg', dir=self.temp)
+                )
                 with open(jpeg_path, 'wb') as jpeg_file:
-                    jpeg_file.write(jpeg_bytes)
-                s3_output = save_files_to_s3(self.cache_key, Format.IMAGE, {'diagnostic_jpg_path': jpeg_path}, index=index)
-            urls[fits_basename] = s3_output['diagnostic_url']
-            self._report_progress(Phase.SAVE, index / total)
-        return urls
+                    jpeg_file.write(jpegs_by_fits_basename[fits_basename])
+                file_paths_by_index[index] = {'diagnostic_jpg_path': jpeg_path}
+            s3_outputs = save_batch_to_s3(
+                self.cache_key, Format.IMAGE, file_paths_by_index,
+                progress_callback=lambda fraction: self._report_progress(Phase.SAVE, fraction),
+            )
+        return {fits_basename: s3_outputs[index]['diagnostic_url'] for index, fits_basename in indexed_basenames}
 
 
 class AperturePhotometry(AperturePhotometryOperation):
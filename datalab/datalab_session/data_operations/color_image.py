@@ -1,16 +1,20 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from fits_align.ident import make_transforms
 from fits_align.align import affineremap
+from fits_align.star import SimpleTransform
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
 from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
 from datalab.datalab_session.utils.s3_utils import save_files_to_s3
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.format import Format
-from datalab.datalab_session.utils.file_utils import create_composite_jpgs, create_composite_tif, temp_file_manager
+from datalab.datalab_session.utils.file_utils import create_composite_images, temp_file_manager
 
 
 log = logging.getLogger()
@@ -53,15 +57,16 @@ class Color_Image(BaseDataOperation):
     def _process_inputs(self, submitter, color_input_list) -> tuple[list[InputDataHandler], list[float], list[float]]:
         input_dicts: List = []
         input_handlers: List = []
-        for index, input in enumerate(color_input_list, start=1):
-            input_handlers.append(InputDataHandler(submitter, input['basename'], input['source']))
+        for index, input_handler in enumerate(InputDataHandler.prefetch(submitter, color_input_list), start=1):
+            input_handlers.append(input_handler)
             self.set_operation_progress(self.PROGRESS_STEPS['INPUT_PROCESSING'] * (index / len(color_input_list)))
 
         # Attempt to do the image alignment here
         fits_files = [handler.fits_file for handler in input_handlers]
+        input_keys = [f"{input['source']}_{input['basename']}" for input in color_input_list]
 
         try:
-            aligned_images = self._align_images(fits_files)
+            aligned_images = self._align_images(fits_files, input_keys)
         except KeyError:
             log.info('Could not align images due to missing CAT header')
             aligned_images = fits_files
@@ -83,21 +88,44 @@ class Color_Image(BaseDataOperation):
 
         return input_dicts
     
-    def _align_images(self, fits_files: list[str]) -> list[str]:
+    @staticmethod
+    def _transform_cache_key(reference_key: str, image_key: str) -> str:
+        return f'color_image_transform_{reference_key}_{image_key}'
+
+    def _find_transforms(self, fits_files: list[str], input_keys: list[str]) -> list:
+        """
+        Returns the transform from each image after the first onto the first, or None where its stars couldn't be
+        identified. Transforms are cached per pair of images, so recomposing the same images with other colours or
+        scales skips identifying their stars again.
+        """
+        cache_keys = [self._transform_cache_key(input_keys[0], image_key) for image_key in input_keys[1:]]
+        # A failed identification is cached as an empty tuple
+        cached = cache.get_many(cache_keys)
+        missing = [index for index, cache_key in enumerate(cache_keys) if cache_key not in cached]
+        if missing:
+            identifications = make_transforms(fits_files[0], [fits_files[index + 1] for index in missing])
+            found = {cache_keys[index]: tuple(float(v) for v in id.trans.v) if id.ok else ()
+                     for index, id in zip(missing, identifications)}
+            cache.set_many(found, timeout=settings.COLOR_IMAGE_TRANSFORM_CACHE_TTL)
+            cached.update(found)
+        log.info(f'Color image alignment: identified {len(missing)} transforms, {len(cache_keys) - len(missing)} were cached')
+        return [SimpleTransform(cached[cache_key]) if cached[cache_key] else None for cache_key in cache_keys]
+
+    def _align_images(self, fits_files: list[str], input_keys: list[str]) -> list[str]:
         ref_image = fits_files[0]
-        images_to_align = fits_files[1:]
-        identifications = make_transforms(ref_image, images_to_align)
-
-        aligned_images = [ref_image]
-        for id in identifications:
-            if id.ok:
-                aligned_img = affineremap(id.ukn.filepath, id.trans, outdir=self.temp)
-                aligned_images.append(aligned_img)
-        
-        if len(aligned_images) != len(fits_files):
+        transforms = self._find_transforms(fits_files, input_keys)
+        if not all(transforms):
             log.info('could not align all images')
             return fits_files
-        
+
+        # Remapped on a thread per image, each image once even if it is used for more than one channel
+        remaps = {}
+        with ThreadPoolExecutor(max_workers=len(fits_files) - 1 or 1) as executor:
+            for fits_file, transform in zip(fits_files[1:], transforms):
+                if fits_file not in remaps:
+                    remaps[fits_file] = executor.submit(affineremap, fits_file, transform, outdir=self.temp)
+            aligned_images = [ref_image] + [remaps[fits_file].result() for fits_file in fits_files[1:]]
+
         return aligned_images
 
     def operate(self, submitter: User):
@@ -112,8 +140,7 @@ class Color_Image(BaseDataOperation):
         ) as (tif_path, large_jpg_path, small_jpg_path):
         
             try:
-                create_composite_tif(input_dicts, tif_path)
-                create_composite_jpgs(input_dicts, large_jpg_path, small_jpg_path)
+                create_composite_images(input_dicts, tif_path, large_jpg_path, small_jpg_path)
             except Exception as ex:
                 # Catches exceptions in the fits2image methods to report back to frontend
                 raise ClientAlertException(ex)
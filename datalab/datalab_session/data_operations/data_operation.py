@@ -12,6 +12,7 @@ from datalab.datalab_session.tasks import execute_data_operation
 from datalab.datalab_session.utils.format import Format
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
+from datalab.datalab_session.utils.filecache import FileCache
 
 CACHE_DURATION = 60 * 60 * 24 * 30  # cache for 30 days
 
@@ -108,7 +109,8 @@ class BaseDataOperation(ABC):
     
     def allocate_operate(self, submitter):
         """
-        Wraps the operate() method, creates a unique temp directory for the operation
+        Wraps the operate() method, creates a unique temp directory for the operation and holds a FileCache lease
+        while it runs, so the input files it fetches can't be evicted before it is done with them
         """
         # Create the temp directory for the operation
         try:
@@ -123,7 +125,8 @@ class BaseDataOperation(ABC):
             log.warning(f"Failed to create temp dir for operation {self.cache_key}: {e} using default {self.temp}")
         
         # Run the operation
-        self.operate(submitter)
+        with FileCache().lease():
+            self.operate(submitter)
 
         # Clean up the temp directory
         if self.temp and os.path.exists(self.temp):
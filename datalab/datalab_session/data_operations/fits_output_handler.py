@@ -1,10 +1,13 @@
 import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from astropy.io import fits
-from datalab.datalab_session.utils.file_utils import create_jpgs, temp_file_manager
+from django.conf import settings
+from datalab.datalab_session.utils.file_utils import create_jpgs_from_data, temp_file_manager
 from datalab.datalab_session.utils.s3_utils import save_files_to_s3
 from datalab.datalab_session.utils.filecache import FileCache
+from datalab.datalab_session.utils.fits_compression import ProfiledCompImageHDU, get_compression_profile
 
 class FITSOutputHandler():
   """A class to handle FITS output files and create jpgs.
@@ -16,11 +19,12 @@ class FITSOutputHandler():
   Attributes:
     datalab_id (str): The cache key for the FITS file.
     primary_hdu (fits.PrimaryHDU): The primary HDU for the FITS file.
-    image_hdu (fits.CompImageHDU): The image HDU for the FITS file.
+    image_hdu (ProfiledCompImageHDU): The image HDU for the FITS file.
     data (np.array): The data for the image HDU.
   """
     
-  def __init__(self, cache_key: str, data: np.array, dir: str, comment: str=None, data_header: fits.Header=None) -> None:
+  def __init__(self, cache_key: str, data: np.array, dir: str, comment: str=None, data_header: fits.Header=None,
+               compression: str=None) -> None:
       """Inits FITSOutputHandler with cache_key and data.
       
       Args:
@@ -28,10 +32,13 @@ class FITSOutputHandler():
         data (np.array): The data that will create the image HDU.
         dir (str): The directory where the FITS file will be saved.
         comment (str): Optionally add a comment to add to the FITS file.
+        compression (str): The compression profile of the FITS file, FITS_OUTPUT_COMPRESSION by default.
       """
       self.datalab_id = cache_key
       self.primary_hdu = fits.PrimaryHDU(header=fits.Header([('DLAB_KEY', cache_key)]))
-      self.image_hdu = fits.CompImageHDU(data=data, header=data_header, name='SCI')
+      profile = get_compression_profile(compression or settings.FITS_OUTPUT_COMPRESSION)
+      self.image_hdu = ProfiledCompImageHDU(data=data, header=data_header, name='SCI', profile=profile,
+                                            workers=settings.FITS_COMPRESSION_WORKERS)
       self.dir = dir
 
       if comment: self.set_comment(comment)
@@ -59,23 +66,27 @@ class FITSOutputHandler():
     hdu_list = fits.HDUList([self.primary_hdu, self.image_hdu])
     file_name = f'{self.datalab_id}-{index}' if index else f'{self.datalab_id}'
 
-    with tempfile.NamedTemporaryFile(suffix=f'{file_name}.fits', delete=False) as fits_output_file:
-      # Create the output FITS file
-      fits_output_path = fits_output_file.name
-      hdu_list.writeto(fits_output_path, overwrite=True)
+    with temp_file_manager(f"{file_name}-large.jpg", f"{file_name}-small.jpg") as (gen_large_jpg, gen_small_jpg), \
+        ThreadPoolExecutor(max_workers=1) as executor:
+      # Create jpgs if not provided, from the data in memory while the FITS file is compressed
+      render = None
+      if not large_jpg_path or not small_jpg_path:
+        render = executor.submit(create_jpgs_from_data, self.image_hdu.data, self.image_hdu.header.copy(), gen_large_jpg, gen_small_jpg)
+
+      with tempfile.NamedTemporaryFile(suffix=f'{file_name}.fits', delete=False) as fits_output_file:
+        # Create the output FITS file
+        fits_output_path = fits_output_file.name
+        hdu_list.writeto(fits_output_path, overwrite=True)
 
       FileCache().add_file_to_cache(fits_output_path)
+      if render:
+        render.result()
 
-      # Create jpgs if not provided
-      with temp_file_manager(f"{file_name}-large.jpg", f"{file_name}-small.jpg") as (gen_large_jpg, gen_small_jpg):
-        if not large_jpg_path or not small_jpg_path:
-          create_jpgs(fits_output_path, gen_large_jpg, gen_small_jpg)
+      if tif_path:
+        file_paths['tif_path'] = tif_path
 
-        if tif_path:
-          file_paths['tif_path'] = tif_path
-        
-        file_paths['large_jpg_path'] = large_jpg_path or gen_large_jpg
-        file_paths['small_jpg_path'] = small_jpg_path or gen_small_jpg
-        file_paths['fits_path'] = fits_output_path
+      file_paths['large_jpg_path'] = large_jpg_path or gen_large_jpg
+      file_paths['small_jpg_path'] = small_jpg_path or gen_small_jpg
+      file_paths['fits_path'] = fits_output_path
 
-        return save_files_to_s3(self.datalab_id, format, file_paths, index)
+      return save_files_to_s3(self.datalab_id, format, file_paths, index)
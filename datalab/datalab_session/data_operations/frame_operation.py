@@ -0,0 +1,75 @@
+from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import numpy as np
+
+from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
+from datalab.datalab_session.data_operations.fits_output_handler import FITSOutputHandler
+from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
+from datalab.datalab_session.utils.format import Format
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+class FrameOperation(BaseDataOperation):
+    """ Shared implementation of operations that turn every input frame into an output frame of its own.
+
+        The frames run through a pipeline: the FileCache downloads the inputs ahead of the frame being computed, each
+        frame is computed into one of two scratch buffers, and its output is written and uploaded on another thread
+        while the next frame is computed into the other buffer.
+    """
+    # How many outputs are computed or waiting to be saved at once, each holding a scratch buffer
+    SCRATCH_BUFFERS = 2
+    # Progress of the operation once every frame is output
+    FRAMES_PROGRESS = 1.0
+
+    @abstractmethod
+    def output_layout(self, image: InputDataHandler) -> tuple:
+        """ The (shape, dtype) of the output computed from image """
+
+    @abstractmethod
+    def compute_frame(self, image: InputDataHandler, out: np.ndarray):
+        """ Computes the output for image into out, a scratch buffer of the output_layout given for it """
+
+    @abstractmethod
+    def frame_comment(self, input: dict) -> str:
+        """ The comment added to the output of the input file input """
+
+    def _save_frame(self, data: np.ndarray, comment: str, header, index: int) -> dict:
+        return FITSOutputHandler(f'{self.cache_key}', data, self.temp, comment, data_header=header).create_and_save_data_products(Format.FITS, index=index)
+
+    def output_frames(self, images, input_list: list) -> list:
+        """ Computes and saves the output of every image yielded by images, an InputDataHandler for each input in
+            input_list, setting the output as each is saved. Returns the outputs in the order of input_list.
+        """
+        outputs = []
+        # The scratch buffer of each frame being saved and its save, oldest first
+        saves = deque()
+
+        def collect(save):
+            outputs.append(save.result())
+            self.set_output(outputs)
+            self.set_operation_progress(self.FRAMES_PROGRESS * len(outputs) / len(input_list))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for index, image in enumerate(images, start=1):
+                buffer = None
+                if len(saves) == self.SCRATCH_BUFFERS:
+                    # The oldest buffer is free again once the frame computed into it has been saved
+                    buffer, save = saves.popleft()
+                    collect(save)
+                with image:
+                    shape, dtype = self.output_layout(image)
+                    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+                        buffer = np.empty(shape, dtype=dtype)
+                    self.compute_frame(image, buffer)
+                    header = image.sci_hdu.header.copy()
+                comment = self.frame_comment(input_list[index - 1])
+                saves.append((buffer, executor.submit(self._save_frame, buffer, comment, header, index)))
+
+            while saves:
+                collect(saves.popleft()[1])
+        return outputs
@@ -115,10 +115,10 @@ The calibrated photometry catalogs of the two images are cross-matched by sky po
     return search_radius_arcmin
 
   def _band_catalog(self, image: dict, user: User) -> dict:
-    """ Downloads one band's fits file and extracts its calibrated source catalog """
+    """ Downloads one band's fits headers and catalog and extracts its calibrated source catalog """
     basename = image.get('basename')
     try:
-      fits_path = FileCache().get_fits(basename, image.get('source', 'archive'), user)
+      fits_path = FileCache().get_fits(basename, image.get('source', 'archive'), user, metadata_only=True)
     except TimeoutError:
       raise ClientAlertException(f'Download of {basename} timed out')
 
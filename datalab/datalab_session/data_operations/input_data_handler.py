@@ -1,9 +1,10 @@
 import gc
+from functools import cached_property
 
 from astropy.io import fits
 from django.contrib.auth.models import User
 
-from datalab.datalab_session.utils.file_utils import get_hdu
+from datalab.datalab_session.utils.file_utils import get_hdu, get_fits_header
 from datalab.datalab_session.utils.filecache import FileCache
 
 class InputDataHandler():
@@ -13,10 +14,12 @@ class InputDataHandler():
     basename (str): The basename of the FITS file.
     fits_file (str): The path to the FITS file.
     sci_hdu (fits.HDU): The HDU from the 'SCI' extension of the FITS file.
-    sci_data (np.array): The data from the 'SCI' extension of the FITS file.
+    sci_data (np.array): The data from the 'SCI' extension of the FITS file, read-only and memory-mapped from the FileCache's
+      decompressed sidecar.
+    Both are loaded on first use, so handlers of inputs only read from their files never decompress a sidecar.
   """
 
-  def __init__(self, submitter: User, basename: str, source: str = None) -> None:
+  def __init__(self, submitter: User, basename: str, source: str = None, fits_file: str = None) -> None:
     """
     Supported sources are 'datalab' and 'archive'
     New sources will need to be added in get_fits
@@ -24,21 +27,49 @@ class InputDataHandler():
     Args:
       basename (str): The basename query for the FITS file
       source (str): location of the fits file
+      fits_file (str): local path of the already downloaded FITS file, fetched from the FileCache if not given
     """
     self.submitter = submitter
     self.basename = basename
     self.source = source
-    self.fits_file = FileCache().get_fits(basename, source, submitter)
-    self.sci_hdu = get_hdu(self.fits_file, 'SCI')
-    self.sci_data = self.sci_hdu.data
+    self.fits_file = fits_file or FileCache().get_fits(basename, source, submitter)
+
+  @cached_property
+  def sci_data(self):
+    return FileCache().get_sci_data(self.fits_file)
+
+  @cached_property
+  def sci_hdu(self):
+    return fits.ImageHDU(data=self.sci_data, header=self._sci_data_header())
+
+  def _sci_data_header(self) -> fits.Header:
+    # The SCI header describing sci_data. Its pixels are already scaled, so the integer scaling of the file's pixels
+    # would shift any output written with the header
+    header = get_fits_header(self.fits_file, 'SCI')
+    for keyword in ('BZERO', 'BSCALE', 'BLANK'):
+      header.remove(keyword, ignore_missing=True)
+    header['BITPIX'] = fits.hdu.base.DTYPE2BITPIX[self.sci_data.dtype.name]
+    return header
+
+  @classmethod
+  def prefetch(cls, submitter: User, input_list: list):
+    """Yields an InputDataHandler for each input in order, downloading the later inputs while the earlier ones are used.
+
+    Args:
+      input_list (list): The input file dicts with a basename and source each
+    """
+    fits_futures = FileCache().prefetch(
+      [input['basename'] for input in input_list], [input['source'] for input in input_list], submitter)
+    for input, fits_future in zip(input_list, fits_futures):
+      yield cls(submitter, input['basename'], input['source'], fits_file=fits_future.result())
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_val, exc_tb):
     # Using this as a context manager will ensure memory is returned when we are done with the file
-    del self.sci_hdu
-    del self.sci_data
+    self.__dict__.pop('sci_hdu', None)
+    self.__dict__.pop('sci_data', None)
     gc.collect()
 
   def __str__(self) -> str:
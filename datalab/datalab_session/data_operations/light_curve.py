@@ -7,7 +7,7 @@ from datalab.datalab_session.data_operations.data_operation import BaseDataOpera
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.catalog_utils import find_nearest_source
 from datalab.datalab_session.utils.format import Format
-from datalab.datalab_session.utils.file_utils import get_hdu
+from datalab.datalab_session.utils.file_utils import get_catalog
 from datalab.datalab_session.utils.filecache import FileCache
 from datalab.datalab_session.utils.flux_to_mag import flux_to_mag
 
@@ -94,17 +94,22 @@ def light_curve(input: dict, user: User, allow_flux_fallback=True, progress_call
   excluded_images = []
   flux_fallback = False
 
-  for index, image in enumerate(images, start=1):
-    basename = image.get("basename")
+  image_sources = []
+  for image in images:
     image_source = image.get("source")
     if image_source is None and isinstance(input.get("source"), str):
       image_source = input.get("source")
-    if image_source is None:
-      image_source = "archive"
+    image_sources.append(image_source or "archive")
+  # Catalogs download in parallel while the earlier ones are searched for the target. Only the headers and
+  # catalogs are fetched, never the images
+  fits_futures = FileCache().prefetch([image.get("basename") for image in images], image_sources, user, metadata_only=True)
+
+  for index, (image, fits_future) in enumerate(zip(images, fits_futures), start=1):
+    basename = image.get("basename")
 
     try:
-      file_path = FileCache().get_fits(basename, image_source, user)
-      cat_hdu = get_hdu(file_path, extension="CAT")
+      file_path = fits_future.result()
+      cat_data = get_catalog(file_path)
     except Exception as e:
       log.error(f"Error retrieving catalog for image {basename}: {e}")
       excluded_images.append(basename)
@@ -113,7 +118,7 @@ def light_curve(input: dict, user: User, allow_flux_fallback=True, progress_call
     if progress_callback:
       progress_callback(index / len(images))
 
-    target_source = find_target_source(cat_hdu, target_ra, target_dec)
+    target_source = find_target_source(cat_data, target_ra, target_dec)
     if target_source is None:
       log.info(f"No source found matching target coordinates: RA={target_ra}, DEC={target_dec} in image {basename}")
       excluded_images.append(basename)
@@ -149,14 +154,12 @@ def light_curve(input: dict, user: User, allow_flux_fallback=True, progress_call
   }
 
 
-def find_target_source(cat_hdu, target_ra, target_dec):
+def find_target_source(cat_data, target_ra, target_dec):
   """
   Find the catalog source closest to the target coordinates, within MATCH_RADIUS_ARCSEC.
 
   Returns the nearest source rather than the first one within tolerance.
   """
-  cat_data = cat_hdu.data
-
   if "ra" not in cat_data.names or "dec" not in cat_data.names:
     log.warning("CAT data does not have ra or dec names!")
     return None
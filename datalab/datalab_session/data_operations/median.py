@@ -1,6 +1,6 @@
 import logging
 
-import numpy as np
+from django.conf import settings
 from django.contrib.auth.models import User
 
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
@@ -8,7 +8,7 @@ from datalab.datalab_session.data_operations.fits_output_handler import FITSOutp
 from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.format import Format
-from datalab.datalab_session.utils.file_utils import crop_arrays
+from datalab.datalab_session.utils.strips import strip_median
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -55,16 +55,19 @@ The output is a median image for the n input images. This operation is commonly
         log.info(comment)
 
         input_fits_list = []
-        for index, input in enumerate(input_list, start=1):
-            input_fits_list.append(InputDataHandler(submitter, input['basename'], input['source']))
+        for index, input_fits in enumerate(InputDataHandler.prefetch(submitter, input_list), start=1):
+            input_fits_list.append(input_fits)
             log.info(f'input fits list: {input_fits_list}')
             self.set_operation_progress(Median.PROGRESS_STEPS['MEDIAN_MIDPOINT'] * (index / len(input_list)))
 
-        cropped_data, shape = crop_arrays([image.sci_data for image in input_fits_list], flatten=True)
-        median = np.median(cropped_data, axis=0, overwrite_input=True)
-        median = np.reshape(median, shape)
+        # The inputs' pixels are memory-mapped, so only the band of rows being medianed is ever read into memory
+        median_start = Median.PROGRESS_STEPS['MEDIAN_MIDPOINT']
+        median_span = Median.PROGRESS_STEPS['MEDIAN_CALCULATION_PERCENTAGE_COMPLETION'] - median_start
+        median = strip_median(
+            [image.sci_data for image in input_fits_list], settings.OPERATION_MEMORY_BUDGET,
+            progress_callback=lambda fraction: self.set_operation_progress(median_start + median_span * fraction)
+        )
 
-        self.set_operation_progress(Median.PROGRESS_STEPS['MEDIAN_CALCULATION_PERCENTAGE_COMPLETION'])
         output = FITSOutputHandler(self.cache_key, median, self.temp, comment, data_header=input_fits_list[0].sci_hdu.header.copy()).create_and_save_data_products(Format.FITS)
         log.info(f'Median output: {output}')
         self.set_output(output)
@@ -4,24 +4,34 @@ import numpy as np
 from django.contrib.auth.models import User
 
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
-from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
-from datalab.datalab_session.data_operations.fits_output_handler import FITSOutputHandler
+from datalab.datalab_session.data_operations.frame_operation import FrameOperation
 from datalab.datalab_session.utils.format import Format
 from datalab.datalab_session.exceptions import ClientAlertException
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+# Pixels sampled from each frame to estimate its median
+MEDIAN_SAMPLE_SIZE = 1000000
 
-class Normalization(BaseDataOperation):
+
+def sample_median(data: np.ndarray, sample_size: int = MEDIAN_SAMPLE_SIZE) -> float:
+    """ The median of data estimated from every nth of its pixels, at most about sample_size of them, rather than from
+        partitioning the whole frame. Frames of up to sample_size pixels get their exact median.
+    """
+    sample = data.ravel()[::max(1, data.size // sample_size)]
+    return float(np.median(sample))
+
+
+class Normalization(FrameOperation):
     MINIMUM_NUMBER_OF_INPUTS = 1
     MAXIMUM_NUMBER_OF_INPUTS = 999
     PROGRESS_STEPS = {
         'INPUT_PROCESSING_PERCENTAGE_COMPLETION': 0.2,
-        'NORMALIZATION_MIDPOINT_OFFSET': 0.5,
         'NORMALIZATION_PERCENTAGE_COMPLETION': 0.9,
         'OUTPUT_PERCENTAGE_COMPLETION': 1.0
     }
+    FRAMES_PROGRESS = PROGRESS_STEPS['NORMALIZATION_PERCENTAGE_COMPLETION']
 
     @staticmethod
     def name():
@@ -50,24 +60,25 @@ The output is a normalized image. This operation is commonly used as a precursor
             }
         }
 
+    def output_layout(self, image):
+        # Dividing integer pixels gives floats
+        dtype = image.sci_data.dtype if image.sci_data.dtype.kind == 'f' else np.dtype(np.float64)
+        return image.sci_data.shape, dtype.newbyteorder('=')
+
+    def compute_frame(self, image, out):
+        np.divide(image.sci_data, sample_median(image.sci_data), out=out)
+
+    def frame_comment(self, input):
+        return f'Datalab Normalization on file {input["basename"]}'
+
     def operate(self, submitter: User):
         input_list = self._validate_file_inputs(input_key='input_files')
         log.info(f'Normalization operation on {len(input_list)} file(s)')
         self.set_operation_progress(Normalization.PROGRESS_STEPS['INPUT_PROCESSING_PERCENTAGE_COMPLETION'])
 
-        output_files = []
-        for index, input in enumerate(input_list, start=1):
-            with InputDataHandler(submitter, input["basename"], input["source"]) as image:
-                self.set_operation_progress(Normalization.PROGRESS_STEPS['NORMALIZATION_PERCENTAGE_COMPLETION'] * (index - Normalization.PROGRESS_STEPS['NORMALIZATION_MIDPOINT_OFFSET']) / len(input_list))
-                median = np.median(image.sci_data)
-                normalized_image = image.sci_data / median
-                comment = f'Datalab Normalization on file {input_list[index-1]["basename"]}'
-                output = FITSOutputHandler(f'{self.cache_key}', normalized_image, self.temp, comment, data_header=image.sci_hdu.header.copy()).create_and_save_data_products(Format.FITS, index=index)
-                output_files.append(output)
-                self.set_output(output_files)
-                self.set_operation_progress(Normalization.PROGRESS_STEPS['NORMALIZATION_PERCENTAGE_COMPLETION'] * index / len(input_list))
-
-            log.info(f'Normalization output: {output_files}')
-            self.set_output(output_files)
-            self.set_operation_progress(Normalization.PROGRESS_STEPS['OUTPUT_PERCENTAGE_COMPLETION'])
-            self.set_status('COMPLETED')
+        output_files = self.output_frames(InputDataHandler.prefetch(submitter, input_list), input_list)
+
+        log.info(f'Normalization output: {output_files}')
+        self.set_output(output_files)
+        self.set_operation_progress(Normalization.PROGRESS_STEPS['OUTPUT_PERCENTAGE_COMPLETION'])
+        self.set_status('COMPLETED')
@@ -1,6 +1,9 @@
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+from django.conf import settings
 from django.contrib.auth.models import User
 
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
@@ -8,8 +11,13 @@ from datalab.datalab_session.data_operations.fits_output_handler import FITSOutp
 from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.format import Format
-from datalab.datalab_session.utils.file_utils import crop_arrays
-from reproject import reproject_adaptive
+from datalab.datalab_session.utils.alignment import (NotATranslation, covered_bbox, phase_correlation_shift, shift_frame,
+                                                     wcs_translations)
+from datalab.datalab_session.utils.combine import (InverseVarianceAccumulator, SigmaClipAccumulator, SumAccumulator,
+                                                   combine_frames)
+from datalab.datalab_session.utils.filecache import FileCache
+from datalab.datalab_session.utils.reprojection import (REPROJECTION_METHODS, load_reprojection, reproject_frame,
+                                                        reprojection_cache_key, reprojection_pool, write_reprojection)
 from astropy.io import fits
 from reproject.mosaicking import find_optimal_celestial_wcs
 from astropy.wcs import WCS
@@ -21,6 +29,14 @@ log.setLevel(logging.INFO)
 class Stack(BaseDataOperation):
     MINIMUM_NUMBER_OF_INPUTS = 2
     MAXIMUM_NUMBER_OF_INPUTS = 999
+    # How each stacking mode combines its frames, once reprojected or aligned
+    COMBINE_MODES = {
+        'simple': SumAccumulator,
+        'reproject': SumAccumulator,
+        'align': SumAccumulator,
+        'sigma_clip': SigmaClipAccumulator,
+        'inverse_variance': InverseVarianceAccumulator,
+    }
     PROGRESS_STEPS = {
         'STACKING_MIDPOINT': 0.5,
         'STACKING_PERCENTAGE_COMPLETION': 0.6,
@@ -35,7 +51,12 @@ class Stack(BaseDataOperation):
     def description():
         return """The stacking operation takes in 2..n input images and adds the values pixel-by-pixel.
 
-The output is a stacked image for the n input images. This operation is commonly used for improving signal to noise."""
+The output is a stacked image for the n input images. This operation is commonly used for improving signal to noise.
+The align mode shifts dithered images of one pointing onto the first before adding them, which is much faster than
+reprojecting them, and reprojects instead if their WCSs show a rotation or a change of scale.
+The sigma clip mode instead averages each pixel after rejecting values more than 3 standard deviations from the mean,
+removing cosmic rays and satellite trails. The inverse variance mode averages each pixel weighting every image by the
+inverse of its background noise, so noisier images count for less."""
 
     @staticmethod
     def wizard_description():
@@ -53,24 +74,29 @@ The output is a stacked image for the n input images. This operation is commonly
                 },
                 'stacking_mode': {
                     'name': 'Stacking Mode',
-                    'description': 'Choose simple stacking or reprojection before stacking',
+                    'description': 'Choose simple stacking, reprojection or alignment by shifting before stacking, a sigma clipped mean or an inverse variance weighted mean',
                     'type': 'select',
-                    'options': ['simple', 'reproject'],
+                    'options': list(Stack.COMBINE_MODES),
                     'default': 'simple'
+                },
+                'reprojection_method': {
+                    'name': 'Reprojection Method',
+                    'description': 'Reproject the images onto a common WCS before combining them: adaptive is the most faithful, interp the fastest and exact computes each pixel\'s exact overlap. The reproject mode uses adaptive unless another is chosen, as does the align mode when the images can\'t be shifted into place',
+                    'type': 'select',
+                    'options': ['none', *REPROJECTION_METHODS],
+                    'default': 'none'
                 }
             }
         }
         return description
     
-    def find_optimal_reference(self, images):
+    def find_optimal_reference(self, image_extents):
         """
-        images: list of InputDataHandler
+        image_extents: list of (shape, header) tuples of the images' SCI extensions
         returns: optimized_wcs, optimized_shape
         """
 
-        image_hdus = [img.sci_hdu for img in images]
-
-        wcs_opt, shape_out = find_optimal_celestial_wcs(image_hdus)
+        wcs_opt, shape_out = find_optimal_celestial_wcs(image_extents)
         return wcs_opt, shape_out
 
     def crop_bbox_from_footprint(self, footprint: np.ndarray):
@@ -139,79 +165,203 @@ The output is a stacked image for the n input images. This operation is commonly
         r0, r1, c0, c1 = bbox
         return np.ascontiguousarray(img[r0:r1, c0:c1])
 
-    def prepare_for_sum(self, images, footprints):
+    def crop_header(self, header, bbox):
         """
-        images: list of 2D float arrays (len=3)
-        footprints: list of 2D {0,1} arrays (len=3)
-        Returns: cropped_images, common_bbox
+        Moves the WCS reference pixel of header to match an image cropped to bbox
         """
+        if 'CRPIX1' in header and 'CRPIX2' in header:
+            header['CRPIX1'] -= bbox[2]
+            header['CRPIX2'] -= bbox[0]
+        return header
 
-
-        per_bbox = [self.crop_bbox_from_footprint(fp) for fp in footprints]
-        common_bbox = self.intersect_bboxes(per_bbox)
-        cropped = [self.crop(im, common_bbox) for im in images]
-
-        log.info(f'cropped: {cropped[0].shape}, common_bbox: {common_bbox}')
-        return cropped, common_bbox
-
-    def reproject_images_to_reference(self, input_fits, optimized_wcs, optimized_shape):
+    def stream_inputs(self, submitter: User, input_files: list, fits_files: list):
+        """
+        Yields an InputDataHandler for each input in turn, releasing its pixels before the next is read, so only one
+        frame is in memory at a time. The first call downloads the inputs, reporting progress, and records their paths
+        in fits_files. Later calls reopen them from the FileCache.
         """
-        input_fits: list of InputDataHandler
-        optimized_wcs: WCS object for the optimal reference frame
-        optimized_shape: (ny, nx) shape 
+        if fits_files:
+            for input, fits_file in zip(input_files, fits_files):
+                with InputDataHandler(submitter, input['basename'], input['source'], fits_file=fits_file) as input_fits:
+                    yield input_fits
+            return
+
+        for index, input_fits in enumerate(InputDataHandler.prefetch(submitter, input_files), start=1):
+            with input_fits:
+                fits_files.append(input_fits.fits_file)
+                yield input_fits
+            self.set_operation_progress(Stack.PROGRESS_STEPS['STACKING_MIDPOINT'] * (index / len(input_files)))
 
-        returns:
-            reprojected_arrays: list of 2D float arrays reprojected to the optimal reference frame
-            footprints: list of 2D  numpy arrays indicating valid data regions in
+    def reproject_inputs(self, submitter: User, input_files: list, fits_files: list, optimized_wcs, optimized_shape,
+                         method: str, pool, max_in_flight: int):
         """
-        reprojected_arrays = []
-        footprints = []
-        for img in input_fits:
-            array, footprint = reproject_adaptive(
-                img.sci_hdu,
-                optimized_wcs,
-                shape_out=optimized_shape,
-                return_footprint=True,
-                conserve_flux=True
-            )
-            reprojected_arrays.append(array)
-            footprints.append(footprint)
+        Yields the reprojected array and footprint of each input in order. Reprojections of the same input onto the same
+        WCS with the same method are cached in the FileCache and reused, the rest are run on pool, at most max_in_flight
+        at once, and cached for the next stack.
+        """
+        file_cache = FileCache()
+        target_header = optimized_wcs.to_header_string()
+        cache_keys = [
+            reprojection_cache_key(f"{input['source']}_{input['basename']}", target_header, optimized_shape, method)
+            for input in input_files
+        ]
+        inputs = enumerate(self.stream_inputs(submitter, input_files, fits_files))
+        in_flight = deque()
+
+        def submit_next():
+            index, input_fits = next(inputs)
+            cached_path = file_cache.get_cached_file(cache_keys[index])
+            if cached_path:
+                in_flight.append((index, cached_path, None))
+            else:
+                # Copied out of the memory-mapped pixels, which are released once the next input is read
+                data = np.array(input_fits.sci_data, dtype=np.float32)
+                header = input_fits.sci_hdu.header.tostring()
+                in_flight.append((index, None, pool.submit(reproject_frame, data, header, target_header, optimized_shape, method)))
+
+        for _ in range(max_in_flight):
+            try:
+                submit_next()
+            except StopIteration:
+                break
+        while in_flight:
+            index, cached_path, reprojection = in_flight.popleft()
+            if cached_path:
+                array, footprint = load_reprojection(cached_path)
+            else:
+                array, footprint = reprojection.result()
+                try:
+                    file_cache.add_file_to_cache(
+                        write_reprojection(settings.TEMP_FITS_DIR, cache_keys[index], array, footprint), fits_file=False)
+                except OSError as e:
+                    log.warning(f'Could not cache the reprojection of {input_files[index]["basename"]}: {repr(e)}')
+            try:
+                submit_next()
+            except StopIteration:
+                pass
+            yield array, footprint
+
+    def reprojected_stack(self, submitter: User, input_files: list, fits_files: list, image_extents: list, accumulator,
+                          method: str):
+        """
+        Combines the inputs reprojected onto their optimal celestial WCS, cropped to where they all have data.
+        image_extents: list of (shape, header) tuples of the images' SCI extensions
+        returns: stacked, header
+        """
+        optimized_wcs, optimized_shape = self.find_optimal_reference(image_extents)
+        self.set_operation_progress(Stack.PROGRESS_STEPS['STACKING_PERCENTAGE_COMPLETION'])
 
-        return reprojected_arrays, footprints
+        # Each reprojection in flight holds a copy of its input and its float32 array and footprint
+        reprojection_bytes = 4 * (max(np.prod(shape) for shape, _ in image_extents) + 2 * np.prod(optimized_shape))
+        max_in_flight = int(max(1, min(2 * settings.REPROJECT_WORKERS, settings.OPERATION_MEMORY_BUDGET // reprojection_bytes)))
+        workers = min(settings.REPROJECT_WORKERS, max_in_flight, len(input_files))
+        log.info(f'Reprojecting {len(input_files)} images with {method} on {workers} processes')
+        # A single worker reprojects on a thread, which still overlaps with combining, rather than spawning a process
+        pool = reprojection_pool(workers, settings.REPROJECT_WORKER_MEMORY_LIMIT) if workers > 1 else ThreadPoolExecutor(max_workers=1)
+        bboxes = []
+
+        def frames():
+            bboxes.clear()
+            for array, footprint in self.reproject_inputs(submitter, input_files, fits_files, optimized_wcs,
+                                                          optimized_shape, method, pool, max_in_flight):
+                bboxes.append(self.crop_bbox_from_footprint(footprint))
+                yield array
+
+        with pool:
+            stacked = combine_frames(frames, accumulator)
+        common_bbox = self.intersect_bboxes(bboxes)
+        stacked = self.crop(stacked, common_bbox)
+        log.info(f'cropped: {stacked.shape}, common_bbox: {common_bbox}')
+
+        header = image_extents[0][1]
+        header.update(optimized_wcs.to_header())
+        return stacked, self.crop_header(header, common_bbox)
+
+    def aligned_stack(self, submitter: User, input_files: list, fits_files: list, image_extents: list, accumulator,
+                      shifts: list = None):
+        """
+        Combines the inputs shifted onto the first, cropped to where they all have data.
+        shifts: the (dy, dx) of each input from wcs_translations, or None to find them by phase correlation
+        returns: stacked, header
+        """
+        shape = image_extents[0][0]
+        shifts = list(shifts) if shifts else []
+        bboxes = []
+
+        def frames():
+            reference = None
+            bboxes.clear()
+            for index, input_fits in enumerate(self.stream_inputs(submitter, input_files, fits_files)):
+                if index == len(shifts):
+                    # Only measured on the first pass, against the first input
+                    if reference is None:
+                        reference = np.array(input_fits.sci_data, dtype=np.float32)
+                        shifts.append((0.0, 0.0))
+                    else:
+                        shifts.append(phase_correlation_shift(reference, input_fits.sci_data))
+                    log.info(f'{input_files[index]["basename"]} is shifted by {shifts[index]} from {input_files[0]["basename"]}')
+                bboxes.append(covered_bbox(shape, input_fits.sci_data.shape, shifts[index]))
+                yield shift_frame(input_fits.sci_data, shifts[index], shape)
+
+        stacked = combine_frames(frames, accumulator)
+        common_bbox = self.intersect_bboxes(bboxes)
+        stacked = self.crop(stacked, common_bbox)
+        log.info(f'cropped: {stacked.shape}, common_bbox: {common_bbox}')
+
+        return stacked, self.crop_header(image_extents[0][1], common_bbox)
 
     def operate(self, submitter: User):
-        stacking_mode = self.input_data.get("stacking_mode")
+        stacking_mode = self.input_data.get("stacking_mode") or 'simple'
+        if stacking_mode not in Stack.COMBINE_MODES:
+            raise ClientAlertException(f'Unknown stacking mode {stacking_mode}, expected one of {", ".join(Stack.COMBINE_MODES)}')
+        reprojection_method = self.input_data.get("reprojection_method") or 'none'
+        if reprojection_method != 'none' and reprojection_method not in REPROJECTION_METHODS:
+            raise ClientAlertException(f'Unknown reprojection method {reprojection_method}, expected one of none, {", ".join(REPROJECTION_METHODS)}')
         input_files = self._validate_file_inputs(input_key='input_files')
         comment= f'Datalab Stacking on {", ".join([image["basename"] for image in input_files])}'
         log.info(comment)
 
-        input_fits_list = []
-        for index, input in enumerate(input_files, start=1):
-            input_fits_list.append(InputDataHandler(submitter, input['basename'], input['source']))
-            log.info(f'input fits list in normalization: {input_fits_list}')
-            self.set_operation_progress(Stack.PROGRESS_STEPS['STACKING_MIDPOINT'] * (index / len(input_files)))
-
-        if stacking_mode == "reproject":
-            optimized_wcs, optimized_shape = self.find_optimal_reference(input_fits_list)
-            arrays, footprints = self.reproject_images_to_reference(input_fits_list, optimized_wcs, optimized_shape)
-            cropped_data, _ = self.prepare_for_sum(arrays, footprints)
-
-            optimized_header = optimized_wcs.to_header()
-            header = input_fits_list[0].sci_hdu.header.copy()
-            header.update(optimized_header)
+        fits_files = []
+        accumulator = Stack.COMBINE_MODES[stacking_mode]()
+
+        if stacking_mode in ('reproject', 'align') or reprojection_method != 'none':
+            image_extents = [(input_fits.sci_data.shape, input_fits.sci_hdu.header.copy())
+                             for input_fits in self.stream_inputs(submitter, input_files, fits_files)]
+            shifts = None
+            if stacking_mode == 'align':
+                # Shifting is only exact for inputs whose WCSs differ by a translation, the rest are reprojected
+                try:
+                    shifts = wcs_translations([header for _, header in image_extents], image_extents[0][0])
+                    if shifts is None:
+                        log.info('Aligning by phase correlation, as not every input has a celestial WCS')
+                    reprojection_method = 'none'
+                except NotATranslation as e:
+                    log.info(f'Reprojecting rather than aligning: {e}')
+                    reprojection_method = reprojection_method if reprojection_method != 'none' else 'adaptive'
+            elif reprojection_method == 'none':
+                reprojection_method = 'adaptive'
+
+            if reprojection_method != 'none':
+                stacked, header = self.reprojected_stack(submitter, input_files, fits_files, image_extents, accumulator,
+                                                         reprojection_method)
+            else:
+                stacked, header = self.aligned_stack(submitter, input_files, fits_files, image_extents, accumulator, shifts)
 
         else:
-            arrays = [image.sci_data for image in input_fits_list]
-            cropped_data, _ = crop_arrays(arrays)
-            header = input_fits_list[0].sci_hdu.header.copy()
+            headers = []
 
-        self.set_operation_progress(Stack.PROGRESS_STEPS['STACKING_PERCENTAGE_COMPLETION'])
-        
-        stacked_sum = np.nansum(np.stack(cropped_data), axis=0)
+            def frames():
+                for input_fits in self.stream_inputs(submitter, input_files, fits_files):
+                    if not headers:
+                        headers.append(input_fits.sci_hdu.header.copy())
+                    yield input_fits.sci_data
+
+            stacked = combine_frames(frames, accumulator)
+            header = headers[0]
 
         self.set_operation_progress(Stack.PROGRESS_STEPS['STACKING_OUTPUT_PERCENTAGE_COMPLETION'])
 
-        output = FITSOutputHandler(self.cache_key, stacked_sum, self.temp, comment, data_header=header).create_and_save_data_products(Format.FITS)
+        output = FITSOutputHandler(self.cache_key, stacked.astype(np.float32), self.temp, comment, data_header=header).create_and_save_data_products(Format.FITS)
         log.info(f'Stacked output: {output}')
 
         self.set_output(output)
@@ -4,25 +4,25 @@ import numpy as np
 from django.contrib.auth.models import User
 
 from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
-from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
-from datalab.datalab_session.data_operations.fits_output_handler import FITSOutputHandler
+from datalab.datalab_session.data_operations.frame_operation import FrameOperation
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.utils.format import Format
-from datalab.datalab_session.utils.file_utils import crop_arrays
+from datalab.datalab_session.utils.strips import common_shape
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
 
-class Subtraction(BaseDataOperation):
+class Subtraction(FrameOperation):
     MINIMUM_NUMBER_OF_INPUT_FILES = 1
     MAXIMUM_NUMBER_OF_INPUT_FILES = 999
     NUMBER_OF_SUBTRACTION_FILES = 1
     PROGRESS_STEPS = {
-        'SUBTRACTION_MIDPOINT_OFFSET': 0.5,
         'SUBTRACTION_PERCENTAGE_COMPLETION': 0.8,
         'OUTPUT_PERCENTAGE_COMPLETION': 1.0
     }
+    FRAMES_PROGRESS = PROGRESS_STEPS['SUBTRACTION_PERCENTAGE_COMPLETION']
+
     @staticmethod
     def name():
         return 'Subtraction'
@@ -58,27 +58,29 @@ class Subtraction(BaseDataOperation):
             },
         }
 
+    def output_layout(self, image):
+        # Cropped to the part of the image the subtraction file covers, as crop_arrays does
+        shape = common_shape([image.sci_data, self.subtraction_fits.sci_data])
+        return shape, np.result_type(image.sci_data, self.subtraction_fits.sci_data).newbyteorder('=')
+
+    def compute_frame(self, image, out):
+        height, width = out.shape
+        np.subtract(image.sci_data[:height, :width], self.subtraction_fits.sci_data[:height, :width], out=out)
+
+    def frame_comment(self, input):
+        return f'Datalab Subtraction of {self.subtraction_basename} subtracted from {input["basename"]}'
+
     def operate(self, submitter: User):
         input_files = self._validate_file_inputs(input_key='input_files')
         subtraction_file_input = self._validate_file_inputs(input_key='subtraction_file')
 
         log.info(f'Subtraction operation on {len(input_files)} files')
 
-        subtraction_fits = InputDataHandler(submitter, subtraction_file_input[0]['basename'], subtraction_file_input[0]['source'])
-        outputs = []
-
-        ## Processing input files
-        for index, input in enumerate(input_files, start=1):
-            with InputDataHandler(submitter, input['basename'], input['source']) as input_image:
-                self.set_operation_progress(Subtraction.PROGRESS_STEPS['SUBTRACTION_PERCENTAGE_COMPLETION'] * (index - Subtraction.PROGRESS_STEPS['SUBTRACTION_MIDPOINT_OFFSET']) / len(input_files))
-                (input_image_data, subtraction_image), _ = crop_arrays([input_image.sci_data, subtraction_fits.sci_data])
-                difference_array = np.subtract(input_image_data, subtraction_image)
-                subtraction_comment = f'Datalab Subtraction of {subtraction_file_input[0]["basename"]} subtracted from {input_files[index-1]["basename"]}'
-                outputs.append(FITSOutputHandler(
-                    f'{self.cache_key}', difference_array, self.temp, subtraction_comment,
-                    data_header=input_image.sci_hdu.header.copy()).create_and_save_data_products(Format.FITS, index=index))
-                self.set_output(outputs)
-                self.set_operation_progress(Subtraction.PROGRESS_STEPS['SUBTRACTION_PERCENTAGE_COMPLETION'] + index / len(input_files))
+        # The subtraction file is downloaded alongside the input files, and memory-mapped for the whole operation
+        images = InputDataHandler.prefetch(submitter, subtraction_file_input + input_files)
+        self.subtraction_basename = subtraction_file_input[0]['basename']
+        with next(images) as self.subtraction_fits:
+            outputs = self.output_frames(images, input_files)
 
         log.info(f'Subtraction output: {outputs}')
         self.set_output(outputs)
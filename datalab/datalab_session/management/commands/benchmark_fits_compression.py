@@ -0,0 +1,35 @@
+import numpy as np
+from astropy.io import fits
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from datalab.datalab_session.utils.fits_compression import COMPRESSION_PROFILES, benchmark_compression, get_compression_profile
+
+
+class Command(BaseCommand):
+    help = ('Compresses an image with each fits compression profile, reporting the throughput and compression ratio '
+            'of each, to compare them before changing FITS_OUTPUT_COMPRESSION or FITS_COMPRESSION_WORKERS')
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('fits', nargs='?', help='Fits file whose SCI image to compress. Defaults to a synthetic frame')
+        parser.add_argument('--size', type=int, default=4096, help='Width and height of the synthetic frame')
+        parser.add_argument('--profile', action='append', choices=list(COMPRESSION_PROFILES),
+                            help='Profile to benchmark, may be repeated. Defaults to all of them')
+        parser.add_argument('--workers', type=int, action='append',
+                            help='Compression threads, may be repeated. Defaults to FITS_COMPRESSION_WORKERS')
+
+    def handle(self, *args, **options):
+        if options['fits']:
+            with fits.open(options['fits']) as hdul:
+                data = np.array(hdul['SCI'].data)
+        else:
+            # Sky background with read noise, roughly what a reduced frame compresses like
+            data = np.random.default_rng(0).normal(1000, 30, (options['size'], options['size'])).astype(np.float32)
+        self.stdout.write(f"Compressing a {data.shape[1]}x{data.shape[0]} {data.dtype} image ({data.nbytes} bytes)")
+        for profile_name in options['profile'] or COMPRESSION_PROFILES:
+            for workers in options['workers'] or [settings.FITS_COMPRESSION_WORKERS]:
+                result = benchmark_compression(data, get_compression_profile(profile_name), workers)
+                self.stdout.write(
+                    f"{result.profile} with {result.workers} workers: {result.bytes_per_second / 1048576:.1f} MiB/s, "
+                    f"ratio {result.ratio:.2f}, {result.seconds:.2f}s"
+                )
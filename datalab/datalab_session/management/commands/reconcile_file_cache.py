@@ -1,5 +1,5 @@
 import sys
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
 
 from datalab.datalab_session.utils.filecache import FileCache
 
@@ -7,7 +7,10 @@ from datalab.datalab_session.utils.filecache import FileCache
 class Command(BaseCommand):
     help = 'Reconciles the filecache with the files currently in the tmp dir of the system. Meant to run on pod creation'
     
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--full', action='store_true', help='List every file in the tmp dir rather than reading the manifest')
+
     def handle(self, *args, **kwargs):
-        FileCache().reconcile_cache()
+        FileCache().reconcile_cache(full=kwargs['full'])
 
         sys.exit(0)
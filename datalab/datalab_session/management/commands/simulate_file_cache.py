@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from datalab.datalab_session.utils.filecache_eviction import EVICTION_STRATEGIES, get_eviction_strategy, read_trace, simulate
+
+
+class Command(BaseCommand):
+    help = ('Replays a FileCache access trace recorded to FILECACHE_TRACE_PATH against each eviction strategy, '
+            'to compare their hit rates before changing FILECACHE_EVICTION_STRATEGY')
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('trace', help='Path of the recorded trace')
+        parser.add_argument('--cache-size', type=int, default=settings.FILECACHE_TOTAL_SIZE, help='Cache size in bytes')
+        parser.add_argument('--strategy', action='append', choices=list(EVICTION_STRATEGIES),
+                            help='Strategy to simulate, may be repeated. Defaults to all of them')
+
+    def handle(self, *args, **options):
+        trace = read_trace(options['trace'])
+        self.stdout.write(f"Replaying {len(trace)} accesses against a {options['cache_size']} byte cache")
+        for strategy_name in options['strategy'] or EVICTION_STRATEGIES:
+            result = simulate(trace, get_eviction_strategy(strategy_name), options['cache_size'])
+            self.stdout.write(
+                f"{result.strategy}: hit rate {result.hit_rate:.1%}, byte hit rate {result.byte_hit_rate:.1%}, "
+                f"{result.evictions} evictions"
+            )
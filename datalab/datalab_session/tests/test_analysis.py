@@ -1,4 +1,5 @@
 from unittest import mock
+import base64
 import json
 import os
 import tempfile
@@ -6,12 +7,14 @@ from types import SimpleNamespace
 
 from astropy.io import fits
 from astropy.wcs import WCS
-from django.test import TestCase
+from django.test import TestCase, override_settings
 import numpy as np
 from numpy.testing import assert_almost_equal
 
-from datalab.datalab_session.analysis import centroiding, line_profile, source_catalog
+from datalab.datalab_session.analysis import centroiding, line_profile, source_catalog, tiles
 from datalab.datalab_session.data_operations import light_curve as light_curve_module
+from datalab.datalab_session.exceptions import ClientAlertException
+from datalab.datalab_session.tests.test_files.file_extended_test_case import completed_futures, decompressed_sci_data
 
 
 class TestAnalysis(TestCase):
@@ -29,6 +32,7 @@ class TestAnalysis(TestCase):
     def test_line_profile(self, mock_file_cache):
         mock_instance = mock_file_cache.return_value
         mock_instance.get_fits.return_value = self.analysis_fits_1_path
+        mock_instance.get_sci_data.side_effect = decompressed_sci_data
 
         output = line_profile.line_profile({
             'basename': 'fits_1',
@@ -158,7 +162,7 @@ class TestAnalysis(TestCase):
         # the 3 arcsec neighbour is listed first, the 0.2 arcsec target second
         cat_hdu = self.cat_hdu([150.0, 150.0], [30.0 + 3.0 / 3600.0, 30.0 + 0.2 / 3600.0])
 
-        source = light_curve_module.find_target_source(cat_hdu, 150.0, 30.0)
+        source = light_curve_module.find_target_source(cat_hdu.data, 150.0, 30.0)
 
         self.assertIsNotNone(source)
         self.assertAlmostEqual(source['mag'], 16.0)
@@ -166,20 +170,20 @@ class TestAnalysis(TestCase):
     def test_find_target_source_outside_match_radius(self):
         cat_hdu = self.cat_hdu([150.0], [30.0 + 6.0 / 3600.0])
 
-        self.assertIsNone(light_curve_module.find_target_source(cat_hdu, 150.0, 30.0))
+        self.assertIsNone(light_curve_module.find_target_source(cat_hdu.data, 150.0, 30.0))
 
     def test_find_target_source_without_ra_dec_columns(self):
         cat_hdu = fits.BinTableHDU.from_columns(
             [fits.Column(name='flux', format='D', array=np.array([1000.0]))], name='CAT')
 
-        self.assertIsNone(light_curve_module.find_target_source(cat_hdu, 150.0, 30.0))
+        self.assertIsNone(light_curve_module.find_target_source(cat_hdu.data, 150.0, 30.0))
 
     @mock.patch('datalab.datalab_session.data_operations.light_curve.find_target_source')
-    @mock.patch('datalab.datalab_session.data_operations.light_curve.get_hdu')
+    @mock.patch('datalab.datalab_session.data_operations.light_curve.get_catalog')
     @mock.patch('datalab.datalab_session.data_operations.light_curve.FileCache')
-    def test_light_curve_uses_catalog_magnitude(self, mock_file_cache, mock_get_hdu, mock_find_target_source):
-        mock_file_cache.return_value.get_fits.return_value = self.analysis_fits_1_path
-        mock_get_hdu.return_value = SimpleNamespace()
+    def test_light_curve_uses_catalog_magnitude(self, mock_file_cache, mock_get_catalog, mock_find_target_source):
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.analysis_fits_1_path)
+        mock_get_catalog.return_value = SimpleNamespace()
         mock_find_target_source.return_value = {
             'mag': 15.2,
             'magerr': 0.03,
@@ -201,11 +205,11 @@ class TestAnalysis(TestCase):
         self.assertEqual(output['light_curve'][0]['magerr'], 0.03)
 
     @mock.patch('datalab.datalab_session.data_operations.light_curve.find_target_source')
-    @mock.patch('datalab.datalab_session.data_operations.light_curve.get_hdu')
+    @mock.patch('datalab.datalab_session.data_operations.light_curve.get_catalog')
     @mock.patch('datalab.datalab_session.data_operations.light_curve.FileCache')
-    def test_light_curve_falls_back_to_flux(self, mock_file_cache, mock_get_hdu, mock_find_target_source):
-        mock_file_cache.return_value.get_fits.return_value = self.analysis_fits_1_path
-        mock_get_hdu.return_value = SimpleNamespace()
+    def test_light_curve_falls_back_to_flux(self, mock_file_cache, mock_get_catalog, mock_find_target_source):
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.analysis_fits_1_path)
+        mock_get_catalog.return_value = SimpleNamespace()
         mock_find_target_source.return_value = {
             'flux': 100.0,
             'fluxerr': 5.0,
@@ -248,15 +252,16 @@ class TestAnalysis(TestCase):
         self.assertGreater(result.background_model.effective_pixels, 0.0)
         self.assertEqual(result.message, 'Centroid calculation completed.')
 
-    @mock.patch('datalab.datalab_session.analysis.centroiding.get_hdu')
+    @mock.patch('datalab.datalab_session.analysis.centroiding.get_fits_header')
     @mock.patch('datalab.datalab_session.analysis.centroiding.FileCache')
-    def test_centroiding_scales_display_coordinates(self, mock_file_cache, mock_get_hdu):
+    def test_centroiding_scales_display_coordinates(self, mock_file_cache, mock_get_fits_header):
         mock_instance = mock_file_cache.return_value
         mock_instance.get_fits.return_value = self.analysis_fits_1_path
 
         fits_image = np.zeros((80, 120), dtype=float)
         fits_image[48, 36] = 1200.0
-        mock_get_hdu.return_value = SimpleNamespace(data=fits_image)
+        mock_instance.get_sci_data.return_value = fits_image
+        mock_get_fits_header.return_value = fits.Header()
         input_data = {
             'basename': 'fits_1',
             'height': 160,
@@ -280,9 +285,9 @@ class TestAnalysis(TestCase):
         self.assertIsNone(output['ra'])
         self.assertIsNone(output['dec'])
 
-    @mock.patch('datalab.datalab_session.analysis.centroiding.get_hdu')
+    @mock.patch('datalab.datalab_session.analysis.centroiding.get_fits_header')
     @mock.patch('datalab.datalab_session.analysis.centroiding.FileCache')
-    def test_centroiding_returns_ra_dec(self, mock_file_cache, mock_get_hdu):
+    def test_centroiding_returns_ra_dec(self, mock_file_cache, mock_get_fits_header):
         mock_instance = mock_file_cache.return_value
         mock_instance.get_fits.return_value = self.analysis_fits_1_path
 
@@ -299,7 +304,8 @@ class TestAnalysis(TestCase):
         header['CD1_2'] = 0.0
         header['CD2_1'] = 0.0
         header['CD2_2'] = 0.01
-        mock_get_hdu.return_value = SimpleNamespace(data=fits_image, header=header)
+        mock_instance.get_sci_data.return_value = fits_image
+        mock_get_fits_header.return_value = header
         input_data = {
             'basename': 'fits_1',
             'height': 160,
@@ -350,3 +356,48 @@ class TestAnalysis(TestCase):
 
         self.assertFalse(result.success)
         self.assertEqual(result.message, 'Centroid calculation has zero weight in both dimensions.')
+
+    @mock.patch('datalab.datalab_session.analysis.tiles.get_fits_header')
+    @mock.patch('datalab.datalab_session.analysis.tiles.FileCache')
+    def test_tiles_builds_pyramid_once_and_returns_viewport_tiles(self, mock_file_cache, mock_get_fits_header):
+        image = np.arange(700 * 600, dtype=np.float32).reshape(700, 600) % 4096
+        mock_instance = mock_file_cache.return_value
+        mock_instance.get_fits.return_value = '/cache/frame_1.fits.fz'
+        mock_instance.get_sci_data.return_value = image
+        mock_get_fits_header.return_value = fits.Header([('BITPIX', 16)])
+
+        with tempfile.TemporaryDirectory() as temp_dir, override_settings(TEMP_FITS_DIR=temp_dir):
+            cached = {}
+            mock_instance.get_cached_file.side_effect = lambda key: cached.get(key)
+            mock_instance.add_file_to_cache.side_effect = lambda path, fits_file: cached.update({os.path.basename(path).split('.')[0]: path})
+
+            # the whole 700x600 image fits in 500 pixels at level 1, whose 350x300 pixels are 2x2 tiles
+            overview = tiles.tiles({'basename': 'frame_1'}, None)
+            self.assertEqual((overview['level'], overview['levels'], overview['dtype']), (1, 3, 'uint16'))
+            self.assertEqual([(tile['row'], tile['column']) for tile in overview['tiles']], [(0, 0), (0, 1), (1, 0), (1, 1)])
+            last_tile = overview['tiles'][-1]
+            self.assertEqual((last_tile['height'], last_tile['width']), (350 - 256, 300 - 256))
+
+            # a full resolution viewport only returns the tiles it overlaps, from the pyramid built for the overview
+            zoomed = tiles.tiles({'basename': 'frame_1', 'x': 300, 'y': 200, 'width': 100, 'height': 100, 'level': 0}, None)
+            mock_get_fits_header.assert_called_once()
+            self.assertEqual(mock_instance.lease.return_value.__enter__.call_count, 2)
+            self.assertEqual([(tile['row'], tile['column']) for tile in zoomed['tiles']], [(0, 1), (1, 1)])
+            tile = zoomed['tiles'][1]
+            pixels = np.frombuffer(base64.b64decode(tile['data']), dtype='<u2').reshape(tile['height'], tile['width'])
+            np.testing.assert_array_equal(pixels, image[256:512, 256:512])
+
+            with self.assertRaisesRegex(ClientAlertException, 'not in the 3 levels'):
+                tiles.tiles({'basename': 'frame_1', 'level': 3}, None)
+            with self.assertRaisesRegex(ClientAlertException, 'max_size 0 must be positive'):
+                tiles.tiles({'basename': 'frame_1', 'max_size': 0}, None)
+            # the whole image at full resolution is 3x3 tiles
+            with mock.patch.object(tiles, 'MAX_TILE_BYTES', 8 * 256 * 256 * 2), self.assertRaisesRegex(ClientAlertException, 'covers 9 tiles.*more than 8'):
+                tiles.tiles({'basename': 'frame_1', 'level': 0}, None)
+
+    def test_tiles_of_scaled_integer_images_are_not_integers(self):
+        self.assertTrue(tiles.has_integer_pixels(fits.Header([('BITPIX', 16)])))
+        self.assertTrue(tiles.has_integer_pixels(fits.Header([('BITPIX', 16), ('BSCALE', 1.0), ('BZERO', 32768)])))
+        self.assertFalse(tiles.has_integer_pixels(fits.Header([('BITPIX', 16), ('BSCALE', 0.5)])))
+        self.assertFalse(tiles.has_integer_pixels(fits.Header([('BITPIX', 32), ('BZERO', 0.5)])))
+        self.assertFalse(tiles.has_integer_pixels(fits.Header([('BITPIX', -32)])))
@@ -3,8 +3,8 @@ from mixer.backend.django import mixer
 from django.contrib.auth.models import User
 from django.urls import reverse
 from unittest import mock
-from types import SimpleNamespace
 
+from astropy.io import fits
 import numpy as np
 
 from datalab.datalab_session.models import DataOperation, DataSession
@@ -30,15 +30,16 @@ class TestOperationsApi(APITestCase):
         self.assertEqual(DataOperation.objects.all().count(), 1)
         self.assertEqual(DataOperation.objects.first().id, operation2.id)
 
-    @mock.patch('datalab.datalab_session.analysis.centroiding.get_hdu')
+    @mock.patch('datalab.datalab_session.analysis.centroiding.get_fits_header')
     @mock.patch('datalab.datalab_session.analysis.centroiding.FileCache')
-    def test_centroiding_analysis_endpoint(self, mock_file_cache, mock_get_hdu):
+    def test_centroiding_analysis_endpoint(self, mock_file_cache, mock_get_fits_header):
         mock_instance = mock_file_cache.return_value
         mock_instance.get_fits.return_value = 'test.fits'
 
         fits_image = np.zeros((80, 120), dtype=float)
         fits_image[48, 36] = 1200.0
-        mock_get_hdu.return_value = SimpleNamespace(data=fits_image)
+        mock_instance.get_sci_data.return_value = fits_image
+        mock_get_fits_header.return_value = fits.Header()
         data = {
             'basename': 'fits_1',
             'height': 160,
@@ -1,9 +1,25 @@
 import pathlib as pl
+from concurrent.futures import Future
 from hashlib import md5
 from os import path, remove, listdir
 
 from django.test import TestCase
 
+from datalab.datalab_session.utils.file_utils import get_hdu
+
+def completed_futures(*results):
+    """ Stands in for FileCache.prefetch, returning already resolved futures in order """
+    futures = []
+    for result in results:
+        future = Future()
+        future.set_result(result)
+        futures.append(future)
+    return iter(futures)
+
+def decompressed_sci_data(file_path):
+    """ Stands in for FileCache.get_sci_data, decompressing the file without a sidecar """
+    return get_hdu(file_path, 'SCI').data
+
 # extending the TestCase class to include a custom assertions for file operations
 class FileExtendedTestCase(TestCase):
     def assertIsFile(self, path):
@@ -20,6 +20,7 @@ from datalab.datalab_session.data_operations.aperture_photometry import (
 )
 from datalab.datalab_session.data_operations.utils import available_operations
 from datalab.datalab_session.exceptions import ClientAlertException
+from datalab.datalab_session.tests.test_files.file_extended_test_case import completed_futures
 from datalab.datalab_session.utils.aperture_light_curve import LightCurveResult
 
 
@@ -71,14 +72,14 @@ class TestMovingTargetOperations(unittest.TestCase):
         ) as mock_generate, mock.patch(
             "datalab.datalab_session.data_operations.aperture_photometry.FileCache"
         ) as mock_file_cache, mock.patch(
-            "datalab.datalab_session.data_operations.aperture_photometry.save_files_to_s3",
-            return_value={"diagnostic_url": "https://bucket/x.jpg"},
+            "datalab.datalab_session.data_operations.aperture_photometry.save_batch_to_s3",
+            return_value={},
         ), mock.patch.object(
             NonSiderealAperturePhotometry, "set_output"
         ) as mock_set_output, mock.patch.object(
             NonSiderealAperturePhotometry, "set_operation_progress"
         ), mock.patch.object(NonSiderealAperturePhotometry, "set_status"):
-            mock_file_cache.return_value.get_fits.return_value = "/tmp/frame_1.fits"
+            mock_file_cache.return_value.prefetch.return_value = completed_futures("/tmp/frame_1.fits")
             mock_generate.return_value = SimpleNamespace(
                 light_curve_rows=[],
                 selected_comparison_stars=[],
@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from itertools import permutations
 import shutil
 import tempfile
 from types import SimpleNamespace
@@ -10,17 +11,24 @@ import os
 from astropy.io import fits
 from astropy.time import Time
 from astropy.wcs import WCS
+from fits_align.ident import make_transforms
 import numpy as np
+from django.core.cache import cache
+from django.test import override_settings
 
 from datalab.datalab_session.data_operations.data_operation import BaseDataOperation
 from datalab.datalab_session.data_operations.aperture_photometry import AperturePhotometry
 from datalab.datalab_session.data_operations.color_image import Color_Image
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.data_operations.hr_diagram import HRDiagram
+from datalab.datalab_session.data_operations.input_data_handler import InputDataHandler
 from datalab.datalab_session.data_operations.light_curve import LightCurve
 from datalab.datalab_session.data_operations.median import Median
+from datalab.datalab_session.data_operations.normalization import Normalization, sample_median
 from datalab.datalab_session.data_operations.stacking import Stack
-from datalab.datalab_session.tests.test_files.file_extended_test_case import FileExtendedTestCase
+from datalab.datalab_session.data_operations.subtraction import Subtraction
+from datalab.datalab_session.utils.reprojection import reproject_frame
+from datalab.datalab_session.tests.test_files.file_extended_test_case import FileExtendedTestCase, completed_futures, decompressed_sci_data
 from datalab.datalab_session.utils.format import Format
 from datalab.datalab_session.utils.comparison_calibration import SharedEnsemble
 from datalab.datalab_session.utils.target_location import FixedPosition
@@ -178,6 +186,29 @@ class TestDataOperation(FileExtendedTestCase):
         self.assertEqual(self.data_operation.get_message(), 'Test message')
 
 
+class TestInputDataHandler(FileExtendedTestCase):
+
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    def test_sci_hdu_of_scaled_integer_frame_matches_its_float_data(self, mock_file_cache):
+        # uint16 frames are stored as int16 with BZERO=32768, while the sidecar holds their float32 values
+        frame = np.arange(40000, 40012, dtype=np.uint16).reshape(3, 4)
+        header = fits.Header([('BLANK', -32768)])
+        mock_file_cache.return_value.get_sci_data.side_effect = lambda path: decompressed_sci_data(path).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fits_path = os.path.join(temp_dir, 'uint16.fits.fz')
+            fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(frame, header, name='SCI')]).writeto(fits_path)
+            image = InputDataHandler(None, 'uint16', 'local', fits_file=fits_path)
+
+            self.assertEqual(image.sci_hdu.header['BITPIX'], -32)
+            for keyword in ('BZERO', 'BSCALE', 'BLANK'):
+                self.assertNotIn(keyword, image.sci_hdu.header)
+            output_path = os.path.join(temp_dir, 'output.fits')
+            fits.ImageHDU(data=np.array(image.sci_data), header=image.sci_hdu.header.copy()).writeto(output_path)
+            with fits.open(output_path) as hdul:
+                np.testing.assert_array_equal(hdul[1].data, frame)
+
+
 class TestMedianOperation(FileExtendedTestCase):
     temp_median_path = f'{test_path}temp_median.fits'
     test_median_path = f'{test_path}median/median_1_2.fits'
@@ -192,14 +223,11 @@ class TestMedianOperation(FileExtendedTestCase):
     @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
     @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
     @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
-    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
     def test_operate(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache, mock_named_tempfile):
         # return the test fits paths in order of the input_files instead of aws fetch
-        mock_fc_instance1 = mock.MagicMock()
-        mock_fc_instance1.get_fits.return_value = self.test_fits_1_path
-        mock_fc_instance2 = mock.MagicMock()
-        mock_fc_instance2.get_fits.return_value = self.test_fits_2_path
-        mock_file_cache.side_effect = [mock_fc_instance1, mock_fc_instance2]
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.test_fits_1_path, self.test_fits_2_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
 
         # save temp output to a known path so we can test it
         mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_median_path
@@ -235,6 +263,119 @@ class TestMedianOperation(FileExtendedTestCase):
             median.operate(None)
 
 
+def saved_fits_data(saved):
+    """ Stands in for save_files_to_s3, keeping the SCI data of each FITS output saved by its index """
+    def save_files_to_s3(cache_key, format, file_paths, index=None):
+        with fits.open(file_paths['fits_path']) as hdul:
+            saved[index] = (hdul['SCI'].data.copy(), hdul[0].header['COMMENT'][0])
+        os.remove(file_paths['fits_path'])
+        return f'output_{index}'
+    return save_files_to_s3
+
+
+class TestSubtractionOperation(FileExtendedTestCase):
+    test_fits_1_path = f'{test_path}fits_1.fits.fz'
+    test_fits_2_path = f'{test_path}fits_2.fits.fz'
+
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    def test_operate(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache):
+        # the subtraction file is prefetched first, then the input files
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(
+            self.test_fits_2_path, self.test_fits_1_path, self.test_fits_2_path, self.test_fits_1_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
+        saved = {}
+        mock_save_files_to_s3.side_effect = saved_fits_data(saved)
+
+        input_data = {
+            'input_files': [
+                {'basename': 'fits_1', 'source': 'local'},
+                {'basename': 'fits_2', 'source': 'local'},
+                {'basename': 'fits_3', 'source': 'local'},
+            ],
+            'subtraction_file': [{'basename': 'fits_2', 'source': 'local'}]
+        }
+
+        subtraction = Subtraction(input_data)
+        subtraction.operate(None)
+
+        self.assertEqual(subtraction.get_operation_progress(), 1.0)
+        # outputs are in the order of the inputs, though each is saved while the next is computed
+        self.assertEqual(subtraction.get_output().get('output_files'), ['output_1', 'output_2', 'output_3'])
+        fits_1, fits_2 = decompressed_sci_data(self.test_fits_1_path), decompressed_sci_data(self.test_fits_2_path)
+        for index, expected in ((1, fits_1 - fits_2), (2, np.zeros_like(fits_2)), (3, fits_1 - fits_2)):
+            np.testing.assert_allclose(saved[index][0], expected, atol=1e-3)
+        self.assertEqual(saved[3][1], 'Datalab Subtraction of fits_2 subtracted from fits_3')
+
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    def test_operate_on_scaled_integer_frames(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache):
+        # uint16 frames are stored as int16 with BZERO=32768, and their sidecars hold the float32 values
+        frame_1 = np.arange(40000, 40012, dtype=np.uint16).reshape(3, 4)
+        frame_2 = np.full((3, 4), 40005, dtype=np.uint16)
+        mock_file_cache.return_value.get_sci_data.side_effect = lambda path: decompressed_sci_data(path).astype(np.float32)
+        saved = {}
+        mock_save_files_to_s3.side_effect = saved_fits_data(saved)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = []
+            for index, frame in enumerate((frame_2, frame_1), start=1):
+                paths.append(os.path.join(temp_dir, f'uint16_{index}.fits.fz'))
+                fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(frame, fits.Header([('BLANK', -32768)]), name='SCI')]).writeto(paths[-1])
+            mock_file_cache.return_value.prefetch.return_value = completed_futures(*paths)
+
+            Subtraction({
+                'input_files': [{'basename': 'uint16_2', 'source': 'local'}],
+                'subtraction_file': [{'basename': 'uint16_1', 'source': 'local'}]
+            }).operate(None)
+
+        np.testing.assert_array_equal(saved[1][0], frame_1.astype(np.float32) - frame_2)
+
+
+class TestNormalizationOperation(FileExtendedTestCase):
+    test_fits_1_path = f'{test_path}fits_1.fits.fz'
+    test_fits_2_path = f'{test_path}fits_2.fits.fz'
+
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    def test_operate(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache):
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.test_fits_1_path, self.test_fits_2_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
+        saved = {}
+        mock_save_files_to_s3.side_effect = saved_fits_data(saved)
+
+        input_data = {
+            'input_files': [
+                {'basename': 'fits_1', 'source': 'local'},
+                {'basename': 'fits_2', 'source': 'local'},
+            ]
+        }
+
+        normalization = Normalization(input_data)
+        normalization.operate(None)
+
+        self.assertEqual(normalization.get_operation_progress(), 1.0)
+        self.assertEqual(normalization.get_output().get('output_files'), ['output_1', 'output_2'])
+        for index, path in ((1, self.test_fits_1_path), (2, self.test_fits_2_path)):
+            data = decompressed_sci_data(path)
+            # frames smaller than MEDIAN_SAMPLE_SIZE are divided by their exact median
+            np.testing.assert_allclose(saved[index][0], data / np.median(data), rtol=1e-3)
+            self.assertEqual(saved[index][1], f'Datalab Normalization on file fits_{index}')
+
+    def test_sample_median(self):
+        rng = np.random.default_rng(1)
+        data = rng.normal(100.0, 10.0, (1000, 1000)).astype(np.float32)
+        self.assertEqual(sample_median(data, data.size), float(np.median(data)))
+        # a sample of a tenth of the pixels
+        self.assertAlmostEqual(sample_median(data, data.size // 10), float(np.median(data)), delta=0.1)
+
+
 class TestLightCurveOperation(FileExtendedTestCase):
 
     @mock.patch('datalab.datalab_session.data_operations.light_curve.light_curve')
@@ -295,7 +436,7 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
             'annulus_outer_radius': 19.10,
         }
 
-    @mock.patch('datalab.datalab_session.data_operations.aperture_photometry.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.aperture_photometry.save_batch_to_s3')
     @mock.patch('datalab.datalab_session.data_operations.aperture_photometry.generate_light_curve')
     @mock.patch('datalab.datalab_session.data_operations.aperture_photometry.FileCache')
     @mock.patch.object(AperturePhotometry, 'set_status')
@@ -308,10 +449,10 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
         mock_set_status,
         mock_file_cache,
         mock_generate_light_curve,
-        mock_save_files_to_s3,
+        mock_save_batch_to_s3,
     ):
-        mock_file_cache.return_value.get_fits.return_value = '/tmp/fits_1.fits'
-        mock_save_files_to_s3.return_value = {'diagnostic_url': 'https://bucket/fits_1-diagnostic.jpg'}
+        mock_file_cache.return_value.prefetch.return_value = completed_futures('/tmp/fits_1.fits')
+        mock_save_batch_to_s3.return_value = {1: {'diagnostic_url': 'https://bucket/fits_1-diagnostic.jpg'}}
         mock_generate_light_curve.return_value = SimpleNamespace(
             light_curve_rows=[
                 LightCurveRow(
@@ -344,7 +485,7 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
         self.addCleanup(shutil.rmtree, aperture_photometry.temp, ignore_errors=True)
         aperture_photometry.operate(None)
 
-        mock_file_cache.return_value.get_fits.assert_called_once_with('fits_1', 'local', None)
+        mock_file_cache.return_value.prefetch.assert_called_once_with(['fits_1'], ['local'], None)
         mock_generate_light_curve.assert_called_once_with(
             fits_paths=['/tmp/fits_1.fits'],
             locator=FixedPosition(ra_deg=10.0, dec_deg=20.0),
@@ -369,8 +510,9 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
         self.assertTrue(math.isnan(
             output['output_data'][0]['light_curve'][0]['target_calibrated_apparent_magnitude_uncertainty']
         ))
-        mock_save_files_to_s3.assert_called_once_with(
-            aperture_photometry.cache_key, Format.IMAGE, mock.ANY, index=1
+        mock_save_batch_to_s3.assert_called_once_with(
+            aperture_photometry.cache_key, Format.IMAGE, {1: {'diagnostic_jpg_path': mock.ANY}},
+            progress_callback=mock.ANY,
         )
         self.assertEqual(
             output['output_data'][0]['diagnostic_images'],
@@ -423,7 +565,7 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
                 mock.patch.object(AperturePhotometry, 'set_output') as mock_set_output, \
                 mock.patch.object(AperturePhotometry, 'set_operation_progress'), \
                 mock.patch.object(AperturePhotometry, 'set_status'):
-            mock_file_cache.return_value.get_fits.return_value = '/tmp/fits_1.fits'
+            mock_file_cache.return_value.prefetch.return_value = completed_futures('/tmp/fits_1.fits')
             mock_generate_light_curve.return_value = SimpleNamespace(
                 light_curve_rows=[],
                 selected_comparison_stars=[],
@@ -449,7 +591,7 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
                 mock.patch.object(AperturePhotometry, 'set_output') as mock_set_output, \
                 mock.patch.object(AperturePhotometry, 'set_operation_progress'), \
                 mock.patch.object(AperturePhotometry, 'set_status'):
-            mock_file_cache.return_value.get_fits.return_value = '/tmp/fits_1.fits'
+            mock_file_cache.return_value.prefetch.return_value = completed_futures('/tmp/fits_1.fits')
             mock_generate_light_curve.return_value = SimpleNamespace(
                 light_curve_rows=[], selected_comparison_stars=[], diagnostics=[],
                 pipeline_diagnostics=[],
@@ -475,7 +617,7 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
                 mock.patch.object(AperturePhotometry, 'set_output') as mock_set_output, \
                 mock.patch.object(AperturePhotometry, 'set_operation_progress'), \
                 mock.patch.object(AperturePhotometry, 'set_status'):
-            mock_file_cache.return_value.get_fits.return_value = '/tmp/fits_1.fits'
+            mock_file_cache.return_value.prefetch.return_value = completed_futures('/tmp/fits_1.fits')
             mock_generate_light_curve.return_value = SimpleNamespace(
                 light_curve_rows=[], selected_comparison_stars=[],
                 diagnostics=['applied a 4.0 mmag error floor', 'fits_1.fits: 6 stars checked'],
@@ -523,13 +665,13 @@ class TestAperturePhotometryOperation(FileExtendedTestCase):
 
         with mock.patch('datalab.datalab_session.data_operations.aperture_photometry.generate_light_curve') as mock_generate_light_curve, \
                 mock.patch('datalab.datalab_session.data_operations.aperture_photometry.FileCache') as mock_file_cache, \
-                mock.patch('datalab.datalab_session.data_operations.aperture_photometry.save_files_to_s3') as mock_save, \
+                mock.patch('datalab.datalab_session.data_operations.aperture_photometry.save_batch_to_s3') as mock_save, \
                 mock.patch.object(AperturePhotometry, 'set_output') as mock_set_output, \
                 mock.patch.object(AperturePhotometry, 'set_operation_progress'), \
                 mock.patch.object(AperturePhotometry, 'set_message'), \
                 mock.patch.object(AperturePhotometry, 'set_status'):
-            mock_file_cache.return_value.get_fits.return_value = '/tmp/fits_1.fits'
-            mock_save.return_value = {'diagnostic_url': 'https://bucket/x.jpg'}
+            mock_file_cache.return_value.prefetch.return_value = completed_futures('/tmp/fits_1.fits')
+            mock_save.return_value = {}
             mock_generate_light_curve.return_value = SimpleNamespace(
                 light_curve_rows=rows, selected_comparison_stars=[], diagnostics=[],
                 pipeline_diagnostics=[],
@@ -550,24 +692,23 @@ class TestColorImageOperation(FileExtendedTestCase):
     test_red_path = f'{test_path}color_image/red.fits'
     test_green_path = f'{test_path}color_image/green.fits'
     test_blue_path = f'{test_path}color_image/blue.fits'
+    # the source and basename of the channels, which the alignment transforms between them are cached by
+    channel_keys = ['local_red_fits', 'local_green_fits', 'local_blue_fits']
 
     def tearDown(self):
         self.clean_test_dir()
+        # whichever channel the inputs are sorted to align onto
+        cache.delete_many([Color_Image._transform_cache_key(*keys) for keys in permutations(self.channel_keys, 2)])
         return super().tearDown()
     
     @mock.patch('datalab.datalab_session.data_operations.color_image.save_files_to_s3')
-    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
     @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.tempfile.NamedTemporaryFile')
     @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
     def test_operate(self, mock_file_cache, mock_named_tempfile, mock_create_jpgs, mock_save_files_to_s3):
         # return the test fits paths in order of the input_files instead of aws fetch
-        mock_fc_instance1 = mock.MagicMock()
-        mock_fc_instance1.get_fits.return_value = self.test_red_path
-        mock_fc_instance2 = mock.MagicMock()
-        mock_fc_instance2.get_fits.return_value = self.test_green_path
-        mock_fc_instance3 = mock.MagicMock()
-        mock_fc_instance3.get_fits.return_value = self.test_blue_path
-        mock_file_cache.side_effect = [mock_fc_instance1, mock_fc_instance2, mock_fc_instance3]
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.test_red_path, self.test_green_path, self.test_blue_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
 
         # save temp output to a known path so we can test
         mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_color_path
@@ -591,6 +732,40 @@ class TestColorImageOperation(FileExtendedTestCase):
         self.assertEqual(color_image.get_operation_progress(), 1.0)
         self.assertEqual(output, [self.temp_color_path])
 
+    @mock.patch('datalab.datalab_session.data_operations.color_image.make_transforms', wraps=make_transforms)
+    @mock.patch('datalab.datalab_session.data_operations.color_image.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.tempfile.NamedTemporaryFile')
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    def test_operate_reuses_cached_transforms(self, mock_file_cache, mock_named_tempfile, mock_create_jpgs, mock_save_files_to_s3, mock_make_transforms):
+        mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_color_path
+        mock_create_jpgs.return_value.__enter__.return_value = ('test_path', 'test_path')
+        mock_save_files_to_s3.return_value = self.temp_color_path
+
+        channels = [
+            {'basename': 'red_fits', 'source': 'local', 'zmin': 0, 'zmax': 255, 'color': {'r': 255, 'g': 0, 'b': 0}},
+            {'basename': 'green_fits', 'source': 'local', 'zmin': 0, 'zmax': 255, 'color': {'r': 0, 'g': 255, 'b': 0}},
+            {'basename': 'blue_fits', 'source': 'local', 'zmin': 0, 'zmax': 255, 'color': {'r': 0, 'g': 0, 'b': 255}}
+        ]
+        aligned = []
+        # the remapped channels are written to the operation's temp dir
+        with tempfile.TemporaryDirectory() as temp_dir, override_settings(TEMP_FITS_DIR=temp_dir):
+            for zmax in (255, 128):
+                mock_file_cache.return_value.prefetch.return_value = completed_futures(self.test_red_path, self.test_green_path, self.test_blue_path)
+                color_image = Color_Image({'color_channels': [dict(channel, zmax=zmax) for channel in channels]})
+                aligned.append(color_image._process_inputs(None, color_image.input_data['color_channels']))
+
+        # the second composition of the same images reuses the transforms found for the first
+        mock_make_transforms.assert_called_once()
+        # alignment reads the files themselves, so no channel's pixels are decompressed
+        mock_file_cache.return_value.get_sci_data.assert_not_called()
+        for first, second in zip(*aligned):
+            self.assertEqual(first['fits_path'], second['fits_path'])
+            self.assertEqual(second['zmax'], 128)
+        # the reference is used as it is and the other channels are remapped onto it
+        self.assertEqual(aligned[1][0]['fits_path'], self.test_red_path)
+        self.assertTrue(all(inputs['fits_path'].startswith(temp_dir) for inputs in aligned[1][1:]))
+
 
 class TestHRDiagramOperation(FileExtendedTestCase):
     temp_blue_path = f'{test_path}temp_hr_blue.fits'
@@ -1089,7 +1264,7 @@ class TestStackOperation(FileExtendedTestCase):
     @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
     @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
     @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
-    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
     def test_operate(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache, mock_named_tempfile):
         # Generate negative images
         for original, negative_path in [
@@ -1101,22 +1276,16 @@ class TestStackOperation(FileExtendedTestCase):
             hdul.writeto(negative_path, overwrite=True)
 
         # Mock behavior
-        mock_fc_instance1 = mock.MagicMock()
-        mock_fc_instance1.get_fits.return_value = self.test_fits_1_path
-        mock_fc_instance2 = mock.MagicMock()
-        mock_fc_instance2.get_fits.return_value = self.test_fits_2_path
-        mock_fc_instance1n = mock.MagicMock()
-        mock_fc_instance1n.get_fits.return_value = self.temp_fits_1_negative_path
-        mock_fc_instance2n = mock.MagicMock()
-        mock_fc_instance2n.get_fits.return_value = self.temp_fits_2_negative_path
-        mock_file_cache.side_effect = [mock_fc_instance1, mock_fc_instance2, mock_fc_instance1n, mock_fc_instance2n]
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(
+            self.test_fits_1_path, self.test_fits_2_path, self.temp_fits_1_negative_path, self.temp_fits_2_negative_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
 
         mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_stacked_path
         mock_create_jpgs.return_value.__enter__.return_value = ('test_path', 'test_path')
         mock_save_files_to_s3.return_value = self.temp_stacked_path
 
         input_data = {
-            # input_data satisfies the Stack operation argument check, but the data comes from the mock_get_fits (above)
+            # input_data satisfies the Stack operation argument check, but the data comes from the mock prefetch (above)
             'input_files': [
                 {'basename': 'fits_1', 'source': 'local'},
                 {'basename': 'fits_2', 'source': 'local'},
@@ -1139,6 +1308,114 @@ class TestStackOperation(FileExtendedTestCase):
 
         self.assertTrue(np.sum(output_hdul['SCI'].data) < 0.01)  # Changed to be close to zero because I was getting some tiny non-zero values when stacking multiple images
 
+    @mock.patch('datalab.datalab_session.utils.file_utils.tempfile.NamedTemporaryFile')
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    def test_operate_inverse_variance(self, mock_create_jpgs, mock_save_files_to_s3, mock_file_cache, mock_named_tempfile):
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(self.test_fits_1_path, self.test_fits_1_path)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
+        mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_stacked_path
+        mock_save_files_to_s3.return_value = self.temp_stacked_path
+
+        input_data = {
+            'input_files': [
+                {'basename': 'fits_1', 'source': 'local'},
+                {'basename': 'fits_1', 'source': 'local'},
+            ],
+            'stacking_mode': 'inverse_variance'
+        }
+
+        stack = Stack(input_data)
+        stack.operate(None)
+
+        # the weighted mean of two copies of an image is the image
+        with fits.open(self.temp_stacked_path) as output_hdul, fits.open(self.test_fits_1_path) as input_hdul:
+            np.testing.assert_allclose(output_hdul['SCI'].data, input_hdul['SCI'].data, rtol=1e-6)
+
+    @override_settings(REPROJECT_WORKERS=1)
+    @mock.patch('datalab.datalab_session.utils.file_utils.tempfile.NamedTemporaryFile')
+    @mock.patch('datalab.datalab_session.data_operations.stacking.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    @mock.patch('datalab.datalab_session.data_operations.stacking.reproject_frame', wraps=reproject_frame)
+    def test_operate_reproject_reuses_cached_reprojections(self, mock_reproject_frame, mock_create_jpgs, mock_save_files_to_s3,
+                                                           mock_file_cache, mock_stacking_file_cache, mock_named_tempfile):
+        # two images of the same field, the second shifted by a few pixels
+        fits_paths = []
+        for index, (shift_x, shift_y) in enumerate([(0, 0), (3, 2)]):
+            wcs = WCS(naxis=2)
+            wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+            wcs.wcs.crval = [150, 2]
+            wcs.wcs.crpix = [50 + shift_x, 50 + shift_y]
+            wcs.wcs.cdelt = [-1e-4, 1e-4]
+            fits_path = f'{test_path}temp_reproject_{index}.fits'
+            data = np.random.default_rng(index).normal(100, 5, (100, 100)).astype(np.float32)
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data, header=wcs.to_header(), name='SCI')]).writeto(fits_path, overwrite=True)
+            fits_paths.append(fits_path)
+
+        cached_files = {}
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
+        mock_stacking_file_cache.return_value.get_cached_file.side_effect = cached_files.get
+        mock_stacking_file_cache.return_value.add_file_to_cache.side_effect = \
+            lambda file_path, fits_file: cached_files.setdefault(os.path.basename(file_path).split('.')[0], file_path)
+        mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_stacked_path
+        mock_save_files_to_s3.return_value = self.temp_stacked_path
+
+        input_files = [{'basename': 'reproject_0', 'source': 'local'}, {'basename': 'reproject_1', 'source': 'local'}]
+        stacked = []
+        with tempfile.TemporaryDirectory() as temp_dir, override_settings(TEMP_FITS_DIR=temp_dir):
+            for stacking_mode in ['reproject', 'sigma_clip']:
+                mock_file_cache.return_value.prefetch.return_value = completed_futures(*fits_paths)
+                Stack({'input_files': input_files, 'stacking_mode': stacking_mode, 'reprojection_method': 'interp'}).operate(None)
+                with fits.open(self.temp_stacked_path) as output_hdul:
+                    stacked.append(output_hdul['SCI'].data)
+
+        # the sigma clipped mean of two images is half their sum, and reuses the reprojections of the first stack
+        self.assertEqual(stacked[0].shape, (98, 97))
+        np.testing.assert_allclose(stacked[1], stacked[0] / 2, rtol=1e-5)
+        self.assertEqual(mock_reproject_frame.call_count, 2)
+        self.assertEqual(len(cached_files), 2)
+
+    @mock.patch('datalab.datalab_session.utils.file_utils.tempfile.NamedTemporaryFile')
+    @mock.patch('datalab.datalab_session.data_operations.input_data_handler.FileCache')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.FileCache', new=mock.MagicMock)
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.save_files_to_s3')
+    @mock.patch('datalab.datalab_session.data_operations.fits_output_handler.create_jpgs_from_data')
+    @mock.patch('datalab.datalab_session.data_operations.stacking.reproject_frame')
+    def test_operate_align_shifts_dithered_images(self, mock_reproject_frame, mock_create_jpgs, mock_save_files_to_s3,
+                                                  mock_file_cache, mock_named_tempfile):
+        # two dithers cut from one field, the second 4 rows down and 6 columns left of the first
+        field = np.random.default_rng(0).normal(100, 5, (120, 120)).astype(np.float32)
+        fits_paths = []
+        for index, (top, left) in enumerate([(10, 10), (14, 4)]):
+            wcs = WCS(naxis=2)
+            wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+            wcs.wcs.crval = [150, 2]
+            wcs.wcs.crpix = [61 - left, 61 - top]
+            wcs.wcs.cdelt = [-1e-4, 1e-4]
+            fits_path = f'{test_path}temp_align_{index}.fits'
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(field[top:top + 100, left:left + 100], header=wcs.to_header(), name='SCI')]).writeto(fits_path, overwrite=True)
+            fits_paths.append(fits_path)
+
+        mock_file_cache.return_value.prefetch.return_value = completed_futures(*fits_paths)
+        mock_file_cache.return_value.get_sci_data.side_effect = decompressed_sci_data
+        mock_named_tempfile.return_value.__enter__.return_value.name = self.temp_stacked_path
+        mock_save_files_to_s3.return_value = self.temp_stacked_path
+
+        input_files = [{'basename': 'align_0', 'source': 'local'}, {'basename': 'align_1', 'source': 'local'}]
+        Stack({'input_files': input_files, 'stacking_mode': 'align'}).operate(None)
+
+        # the overlap of the dithers, with the WCS moved to match
+        with fits.open(self.temp_stacked_path) as output_hdul:
+            np.testing.assert_allclose(output_hdul['SCI'].data, 2 * field[14:110, 10:104])
+            self.assertEqual(output_hdul['SCI'].header['CRPIX1'], 51)
+            self.assertEqual(output_hdul['SCI'].header['CRPIX2'], 47)
+        mock_reproject_frame.assert_not_called()
+
     def test_not_enough_files(self):
         input_data = {
             'input_files': [{'basename': 'sample_lco_fits_1'}]
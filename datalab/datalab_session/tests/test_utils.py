@@ -1,6 +1,18 @@
+import gzip
+import hashlib
+import importlib
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from unittest import mock
 
+import fakeredis
 from astropy.table import Table, MaskedColumn
+from astropy.wcs import WCS
+from fits2image.conversions import multi_fits_to_img
 
 from datalab.datalab_session.utils.file_utils import *
 from datalab.datalab_session.utils.s3_utils import *
@@ -12,6 +24,19 @@ from datalab.datalab_session.utils.catalog_utils import (cross_match_one_to_one,
                                                          mean_observation_epoch, propagate_positions)
 from datalab.datalab_session.utils.gaia import (GAIA_EPOCH, GAIA_PARALLAX_ZERO_POINT_MAS, estimate_membership,
                                                 gaia_cone_search)
+from datalab.datalab_session.utils import filecache
+from datalab.datalab_session.utils.filecache import FileCache
+from datalab.datalab_session.utils.filecache_eviction import GDSFStrategy, LRUStrategy, TraceRecord, simulate
+from datalab.datalab_session.utils.filecache_manifest import FileCacheManifest
+from datalab.datalab_session.utils import fits_compression
+from datalab.datalab_session.utils.fits_compression import COMPRESSION_PROFILES, ProfiledCompImageHDU
+from datalab.datalab_session.utils.strips import strip_median, strip_rows
+from datalab.datalab_session.utils.tile_pyramid import (TILE_SIZE, level_shapes, read_tile, tile_dtype, tile_offsets,
+                                                        write_pyramid)
+from datalab.datalab_session.utils.alignment import (NotATranslation, covered_bbox, phase_correlation_shift, shift_frame,
+                                                     wcs_translations)
+from datalab.datalab_session.utils.combine import (InverseVarianceAccumulator, SigmaClipAccumulator, SumAccumulator,
+                                                   combine_frames)
 from datalab.datalab_session.exceptions import ClientAlertException
 from datalab.datalab_session.tests.test_files.file_extended_test_case import FileExtendedTestCase
 
@@ -28,6 +53,164 @@ class FileUtilsTestClass(FileExtendedTestCase):
     fits_path = self.test_fits_path
     self.assertEqual(get_fits_dimensions(fits_path), (100, 100))
 
+  def test_fits_metadata_sidecar(self):
+    with tempfile.TemporaryDirectory() as temp_dir:
+      fits_path = os.path.join(temp_dir, 'fits_1.fits.fz')
+      shutil.copy(self.test_fits_path, fits_path)
+      self.assertGreater(write_fits_metadata(fits_path), 0)
+
+      with mock.patch('datalab.datalab_session.utils.file_utils.fits.open') as mock_open:
+        header = get_fits_header(fits_path)
+        catalog = get_catalog(fits_path)
+      mock_open.assert_not_called()
+
+      with fits.open(self.test_fits_path) as hdul:
+        self.assertEqual(header.tostring(), hdul['SCI'].header.tostring())
+        self.assertEqual(catalog.names, hdul['CAT'].data.names)
+        self.assertEqual(len(catalog), len(hdul['CAT'].data))
+        np.testing.assert_array_equal(catalog['flux'], hdul['CAT'].data['flux'])
+      self.assertEqual(catalog[0]['flux'], catalog['flux'][0])
+
+  def test_fits_metadata_sidecar_of_replaced_file_is_ignored(self):
+    with tempfile.TemporaryDirectory() as temp_dir:
+      fits_path = os.path.join(temp_dir, 'fits_1.fits.fz')
+      shutil.copy(self.test_fits_path, fits_path)
+      write_fits_metadata(fits_path)
+      with fits.open(fits_path, mode='update') as hdul:
+        hdul['SCI'].header['OBJECT'] = 'replaced'
+
+      self.assertEqual(get_fits_header(fits_path)['OBJECT'], 'replaced')
+
+  def test_download_fits_metadata_fetches_headers_and_catalog(self):
+    with tempfile.TemporaryDirectory() as temp_dir, self.settings(TEMP_FITS_DIR=temp_dir):
+      with fits.open(self.test_fits_path) as hdul:
+        image = np.arange(512 * 512, dtype=np.float32).reshape(512, 512)
+        full_path = os.path.join(temp_dir, 'full.fits.fz')
+        fits.HDUList([fits.PrimaryHDU(header=hdul[0].header), fits.CompImageHDU(image, hdul['SCI'].header, name='SCI'),
+                      hdul['CAT'].copy()]).writeto(full_path)
+      with open(full_path, 'rb') as full_file:
+        full_bytes = full_file.read()
+
+      fetched = []
+      def fetch_range(fits_url, offset, length):
+        fetched.append(length)
+        return full_bytes[offset:offset + length]
+
+      slim_path = os.path.join(temp_dir, 'slim.fits.fz')
+      with mock.patch('datalab.datalab_session.utils.s3_utils._fetch_range', side_effect=fetch_range), \
+          mock.patch('datalab.datalab_session.utils.s3_utils.get_fits_url', return_value='fits_url'):
+        download_fits_metadata(slim_path, 'fits_1')
+
+      self.assertLess(sum(fetched), len(full_bytes))
+      self.assertEqual(get_fits_header(slim_path).tostring(), get_fits_header(full_path).tostring())
+      self.assertEqual(get_fits_dimensions(slim_path), (512, 512))
+      np.testing.assert_array_equal(get_catalog(slim_path)['flux'], get_catalog(full_path)['flux'])
+
+  def test_stream_download_resumes_and_verifies(self):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+
+    def response(status_code, body, headers, fail_after=None):
+      fake = mock.MagicMock(status_code=status_code, headers=headers)
+      fake.__enter__.return_value = fake
+      def iter_content(chunk_size):
+        for start in range(0, len(body), chunk_size):
+          if fail_after is not None and start >= fail_after:
+            raise requests.ConnectionError('connection reset')
+          yield body[start:start + chunk_size]
+      fake.iter_content.side_effect = iter_content
+      return fake
+
+    interrupted = response(200, content, {'Content-Length': str(len(content)), 'ETag': etag}, fail_after=DOWNLOAD_CHUNK_SIZE)
+    resumed = response(206, content[DOWNLOAD_CHUNK_SIZE:], {
+      'Content-Range': f'bytes {DOWNLOAD_CHUNK_SIZE}-{len(content) - 1}/{len(content)}', 'ETag': etag})
+    with tempfile.TemporaryDirectory() as temp_dir, \
+        mock.patch('datalab.datalab_session.utils.s3_utils.get_http_session') as mock_session:
+      mock_session.return_value.get.side_effect = [interrupted, resumed]
+      file_path = os.path.join(temp_dir, 'fits_1.fits.fz')
+
+      with self.assertRaises(requests.ConnectionError):
+        stream_download('https://bucket/fits_1', file_path)
+      self.assertEqual(os.path.getsize(f'{file_path}{DOWNLOAD_PART_SUFFIX}'), DOWNLOAD_CHUNK_SIZE)
+      stats = stream_download('https://bucket/fits_1', file_path)
+
+      self.assertEqual(mock_session.return_value.get.call_args.kwargs['headers'], {'Range': f'bytes={DOWNLOAD_CHUNK_SIZE}-'})
+      self.assertEqual((stats.size, stats.transferred), (len(content), len(content) - DOWNLOAD_CHUNK_SIZE))
+      with open(file_path, 'rb') as downloaded_file:
+        self.assertEqual(downloaded_file.read(), content)
+
+      # A download that doesn't match its checksum is discarded rather than resumed
+      mock_session.return_value.get.side_effect = [response(200, content[::-1], {'ETag': etag})]
+      with self.assertRaises(DownloadVerificationError):
+        stream_download('https://bucket/fits_2', os.path.join(temp_dir, 'fits_2.fits.fz'))
+      self.assertEqual(os.listdir(temp_dir), ['fits_1.fits.fz'])
+
+  @mock.patch('datalab.datalab_session.utils.s3_utils.get_http_session')
+  def test_get_archive_urls_caches_per_user(self, mock_session):
+    def frames(url, params, headers, timeout):
+      results = [] if params['basename_exact'] == 'missing' else [{'url': f"https://archive/{params['basename_exact']}"}]
+      return mock.MagicMock(**{'json.return_value': {'results': results}})
+    mock_session.return_value.get.side_effect = frames
+    cache.clear()
+
+    self.assertEqual(get_archive_urls(['fits_1', 'fits_2', 'fits_1'], user=None),
+                     {'fits_1': 'https://archive/fits_1', 'fits_2': 'https://archive/fits_2'})
+    self.assertEqual(mock_session.return_value.get.call_count, 2)
+    self.assertEqual(get_archive_url('fits_2', user=None), 'https://archive/fits_2')
+    self.assertEqual(get_archive_url('fits_2-large', user=None), 'https://archive/fits_2')
+    self.assertEqual(mock_session.return_value.get.call_count, 2)
+
+    with self.assertRaises(ClientAlertException):
+      get_archive_urls(['fits_3', 'missing'], user=None)
+    # The url that was found is still cached
+    get_archive_url('fits_3', user=None)
+    self.assertEqual(mock_session.return_value.get.call_count, 4)
+
+  @mock.patch('datalab.datalab_session.utils.s3_utils.get_s3_client')
+  def test_s3_urls_and_missing_keys_are_cached(self, mock_s3_client):
+    s3 = mock_s3_client.return_value
+    s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+    s3.generate_presigned_url.side_effect = lambda ClientMethod, Params, ExpiresIn: f"https://bucket/{Params['Key']}?{s3.generate_presigned_url.call_count}"
+    cache.clear()
+
+    self.assertFalse(key_exists('abc/abc.tif'))
+    self.assertFalse(key_exists('abc/abc.tif'))
+    self.assertEqual(s3.head_object.call_count, 1)
+
+    # Storing the key replaces the negative entry with its url
+    self.assertEqual(add_file_to_bucket('abc/abc.tif', '/tmp/abc.tif'), 'https://bucket/abc/abc.tif?1')
+    self.assertTrue(key_exists('abc/abc.tif'))
+    self.assertEqual(get_s3_url('abc/abc.tif'), 'https://bucket/abc/abc.tif?1')
+    self.assertEqual(s3.head_object.call_count, 1)
+    self.assertEqual(s3.generate_presigned_url.call_count, 1)
+
+    # A signed url doesn't mean the object exists, while a successful HEAD request is remembered
+    get_s3_url('def/def.tif')
+    self.assertFalse(key_exists('def/def.tif'))
+    self.assertEqual(s3.head_object.call_count, 2)
+    s3.head_object.side_effect = None
+    self.assertTrue(key_exists('ghi/ghi.tif'))
+    self.assertTrue(key_exists('ghi/ghi.tif'))
+    self.assertEqual(s3.head_object.call_count, 3)
+
+  @mock.patch('datalab.datalab_session.utils.s3_utils.add_file_to_bucket', side_effect=lambda key, path: f'https://bucket/{key}')
+  def test_save_batch_to_s3(self, mock_add_file_to_bucket):
+    progress = []
+    outputs = save_batch_to_s3('abc', 'image', {
+      1: {'diagnostic_jpg_path': '/tmp/abc-1.jpg'},
+      2: {'large_jpg_path': '/tmp/abc-2-large.jpg', 'fits_path': '/tmp/abc-2.fits'},
+    }, progress_callback=progress.append)
+
+    self.assertEqual(mock_add_file_to_bucket.call_count, 3)
+    self.assertEqual(progress, [1 / 3, 2 / 3, 1.0])
+    self.assertEqual(outputs, {
+      1: {'basename': 'abc-1', 'source': 'datalab', 'type': 'image', 'diagnostic_url': 'https://bucket/abc/abc-1-diagnostic.jpg'},
+      2: {'basename': 'abc-2', 'source': 'datalab', 'type': 'image', 'large_url': 'https://bucket/abc/abc-2-large.jpg',
+          'fits_url': 'https://bucket/abc/abc-2.fits'},
+    })
+    self.assertEqual(save_files_to_s3('abc', 'image', {'fits_path': '/tmp/abc.fits'}),
+                     {'basename': 'abc', 'source': 'datalab', 'type': 'image', 'fits_url': 'https://bucket/abc/abc.fits'})
+
   def test_create_fits(self):
     test_2d_ndarray = np.zeros((10, 10))
     with create_fits('create_fits_test', test_2d_ndarray) as path:
@@ -56,7 +239,38 @@ class FileUtilsTestClass(FileExtendedTestCase):
       self.assertIsFile(small_jpg)
       self.assertFilesEqual(large_jpg, self.test_large_jpg_path)
       self.assertFilesEqual(small_jpg, self.test_small_jpg_path)
-  
+
+  def test_create_jpgs_from_data(self):
+    with fits.open(self.test_fits_path) as hdul, temp_file_manager('large.jpg', 'small.jpg') as (large_jpg, small_jpg):
+      create_jpgs_from_data(hdul['SCI'].data, hdul['SCI'].header, large_jpg, small_jpg)
+      self.assertFilesEqual(large_jpg, self.test_large_jpg_path)
+      self.assertFilesEqual(small_jpg, self.test_small_jpg_path)
+
+  def test_create_composite_images(self):
+    color_path = 'datalab/datalab_session/tests/test_files/color_image/'
+    offset_channel = fits.getdata(f'{color_path}blue.fits', 'SCI')[5:, 3:]
+
+    def input_dicts():
+      # an in memory channel smaller than the others, which are cropped to its size around their centers
+      return [
+        {'fits_path': f'{color_path}red.fits', 'scale_algorithm': 'zscale', 'color': [1, 0, 0], 'zmin': 100, 'zmax': 900},
+        {'fits_path': f'{color_path}green.fits', 'scale_algorithm': 'zscale', 'color': [0, 1, 0.3], 'zmin': 50, 'zmax': 700},
+        {'fits_data': offset_channel.copy(), 'scale_algorithm': 'zscale', 'color': [0, 0, 1], 'zmin': 80, 'zmax': 800},
+      ]
+
+    with temp_file_manager('test.tif', 'large.jpg', 'small.jpg', 'expected.tif', 'expected_large.jpg', 'expected_small.jpg') as paths:
+      tif_path, large_jpg, small_jpg, expected_tif, expected_large_jpg, expected_small_jpg = paths
+      create_composite_images(input_dicts(), tif_path, large_jpg, small_jpg)
+
+      # matches rendering each output separately with fits2image
+      multi_fits_to_img(input_dicts(), expected_tif, width=100, height=100, file_type='tiff')
+      multi_fits_to_img(input_dicts(), expected_large_jpg, width=100, height=100, file_type='jpeg')
+      multi_fits_to_img(input_dicts(), expected_small_jpg, width=200, height=200, file_type='jpeg')
+      self.assertEqual(Image.open(tif_path).size, (97, 95))
+      self.assertFilesEqual(tif_path, expected_tif)
+      self.assertFilesEqual(large_jpg, expected_large_jpg)
+      self.assertFilesEqual(small_jpg, expected_small_jpg)
+
   def test_stack_arrays(self):
     test_array_1 = np.zeros((10, 20))
     test_array_2 = np.ones((20, 10))
@@ -480,3 +694,520 @@ class GaiaUtilsTestClass(FileExtendedTestCase):
 
     self.assertIsNotNone(guess)
     self.assertLess(guess['parallax_min'], 0.0)
+
+
+class FitsCompressionTestClass(FileExtendedTestCase):
+
+  @staticmethod
+  def written(hdu):
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer)
+    return buffer.getvalue()
+
+  def test_parallel_tiles_match_astropy(self):
+    # Byte for byte, so an astropy release changing the internals the parallel compressor copies fails here
+    rng = np.random.default_rng(0)
+    float_data = rng.normal(1000, 30, (130, 70)).astype(np.float32)
+    float_data[3, 4] = np.nan
+    frames = [float_data, float_data.astype(np.float64), rng.integers(0, 60000, (130, 70)).astype(np.uint16),
+              rng.integers(-3000, 3000, (130, 70)).astype(np.int16), rng.integers(-3000, 3000, (130, 70)).astype(np.int32)]
+    for data in frames:
+      for profile in COMPRESSION_PROFILES.values():
+        astropy_hdu = fits.CompImageHDU(data, name='SCI', compression_type=profile.compression_type,
+                                        tile_shape=profile.tile_shape(data.shape), quantize_level=profile.quantize_level)
+        # astropy stamps gzip tiles with the time, where ours carry none
+        with mock.patch('astropy.io.fits.hdu.compressed._codecs.gzip_compress', lambda buffer: gzip.compress(buffer, mtime=0)):
+          astropy_written = self.written(astropy_hdu)
+        written = self.written(ProfiledCompImageHDU(data, name='SCI', profile=profile, workers=4))
+        self.assertEqual(written, astropy_written, f'{profile.name} {data.dtype}')
+        # so the same image always compresses to the same bytes
+        self.assertEqual(self.written(ProfiledCompImageHDU(data, name='SCI', profile=profile, workers=2)), written)
+
+  def test_science_profile_is_lossless(self):
+    data = np.random.default_rng(0).normal(1000, 30, (40, 50)).astype(np.float32)
+    with fits.open(io.BytesIO(self.written(ProfiledCompImageHDU(data, name='SCI', profile=COMPRESSION_PROFILES['science'])))) as hdul:
+      np.testing.assert_array_equal(hdul['SCI'].data, data)
+      self.assertEqual(hdul['SCI']._header['ZTILE2'], 16)
+
+  def test_serial_fallback_matches_astropy(self):
+    data = np.random.default_rng(0).normal(1000, 30, (40, 50)).astype(np.float32)
+    profile = COMPRESSION_PROFILES['preview']
+    astropy_hdu = fits.CompImageHDU(data, name='SCI', compression_type=profile.compression_type,
+                                    tile_shape=profile.tile_shape(data.shape), quantize_level=profile.quantize_level)
+    with mock.patch.object(fits_compression, 'PARALLEL_COMPRESSION', False):
+      written = self.written(ProfiledCompImageHDU(data, name='SCI', profile=profile))
+    with fits.open(io.BytesIO(written)) as hdul, fits.open(io.BytesIO(self.written(astropy_hdu))) as astropy_hdul:
+      self.assertEqual(hdul['SCI']._header['ZTILE2'], 40)
+      np.testing.assert_array_equal(hdul['SCI'].data, astropy_hdul['SCI'].data)
+
+  def test_missing_astropy_internals_fall_back_to_serial_compression(self):
+    # an astropy without the private module the parallel compressor imports
+    try:
+      with mock.patch.dict(sys.modules, {'astropy.io.fits.hdu.compressed._tiled_compression': None}):
+        importlib.reload(fits_compression)
+        self.assertFalse(fits_compression.PARALLEL_COMPRESSION)
+        data = np.arange(20 * 30, dtype=np.float32).reshape(20, 30)
+        hdu = fits_compression.ProfiledCompImageHDU(data, name='SCI', profile=fits_compression.COMPRESSION_PROFILES['science'])
+        with fits.open(io.BytesIO(self.written(hdu))) as hdul:
+          np.testing.assert_array_equal(hdul['SCI'].data, data)
+    finally:
+      importlib.reload(fits_compression)
+    self.assertTrue(fits_compression.PARALLEL_COMPRESSION)
+
+class StripsTestClass(FileExtendedTestCase):
+
+  def test_strip_median_matches_median_of_cropped_stack(self):
+    rng = np.random.default_rng(0)
+    arrays = [rng.normal(100, 10, (37, 25)).astype(np.float32) for _ in range(4)] + [rng.normal(100, 10, (40, 23)).astype(np.float32)]
+    expected = np.median(np.stack([array[:37, :23] for array in arrays]), axis=0)
+    progress = []
+    # a budget of 3 rows of every frame at a time, so the last band is a partial one
+    median = strip_median(arrays, memory_budget=3 * 5 * 23 * 4, progress_callback=progress.append)
+
+    np.testing.assert_array_equal(median, expected)
+    self.assertEqual(len(progress), 13)
+    self.assertEqual(progress[-1], 1.0)
+
+  def test_strip_rows_fit_budget(self):
+    self.assertEqual(strip_rows(frames=100, width=4096, itemsize=4, memory_budget=512 * 1024 * 1024), 327)
+    # a single row over budget is still read
+    self.assertEqual(strip_rows(frames=999, width=4096, itemsize=4, memory_budget=1024), 1)
+
+
+class TilePyramidTestClass(FileExtendedTestCase):
+
+  def test_level_shapes_halve_down_to_one_tile(self):
+    self.assertEqual(level_shapes((1000, 600)), [(1000, 600), (500, 300), (250, 150)])
+    self.assertEqual(level_shapes((100, 100)), [(100, 100)])
+    # 4 + 2 tiles of levels 1 and 2, level 0 being read from the frame
+    self.assertEqual(tile_offsets((1000, 600)), [0, 4, 5])
+
+  def test_tile_dtype_is_the_most_compact_that_fits(self):
+    self.assertEqual(tile_dtype(0, 65535, integer=True), np.uint16)
+    self.assertEqual(tile_dtype(-1, 100, integer=True), np.float16)
+    self.assertEqual(tile_dtype(-10.5, 60000.0, integer=False), np.float16)
+    self.assertEqual(tile_dtype(0, 1e6, integer=False), np.float32)
+
+  def test_write_pyramid_tiles_downsampled_levels(self):
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 50, (601, 523)).astype(np.float32)
+    level_1 = np.pad(data, ((0, 1), (0, 1)), mode='edge')
+    level_1 = level_1.reshape(301, 2, 262, 2).mean(axis=(1, 3))
+    level_2 = np.pad(level_1, ((0, 1), (0, 0)), mode='edge').reshape(151, 2, 131, 2).mean(axis=(1, 3))
+
+    with tempfile.TemporaryDirectory() as directory:
+      # bands of 4 rows while building level 1
+      path = write_pyramid(directory, 'tiles_test', data, integer=False, memory_budget=4 * 523 * 4)
+      tiles = np.load(path, mmap_mode='r')
+      self.assertEqual(tiles.dtype, np.float16)
+      self.assertEqual(tiles.shape, (tile_offsets(data.shape)[-1], TILE_SIZE, TILE_SIZE))
+
+      # the last tile of level 1 is cropped to the edge of the level
+      tile = read_tile(data, tiles, 1, 1, 1)
+      self.assertEqual(tile.shape, (301 - TILE_SIZE, 262 - TILE_SIZE))
+      np.testing.assert_allclose(tile, level_1[TILE_SIZE:, TILE_SIZE:], rtol=1e-3)
+      np.testing.assert_allclose(read_tile(data, tiles, 2, 0, 0), level_2, rtol=1e-3)
+      # level 0 is read from the frame itself
+      np.testing.assert_array_equal(read_tile(data, tiles, 0, 2, 0), data[2 * TILE_SIZE:, :TILE_SIZE].astype(np.float16))
+
+
+class CombineTestClass(FileExtendedTestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    self.frames = [rng.normal(100, 5, (30, 20)) for _ in range(8)]
+    super().setUp()
+
+  def test_sum_matches_nansum_of_cropped_frames(self):
+    frames = self.frames + [np.full((25, 22), np.nan)]
+    frames[0][1, 2] = np.nan
+    stacked = combine_frames(lambda: iter(frames), SumAccumulator())
+    np.testing.assert_allclose(stacked, np.nansum(np.stack([frame[:25, :20] for frame in frames]), axis=0))
+
+  def test_sigma_clip_rejects_outliers(self):
+    frames = self.frames + self.frames[:4]
+    frames[3] = frames[3].copy()
+    frames[3][4, 5] = 1e6
+    passes = []
+
+    def frame_passes():
+      passes.append(1)
+      return iter(frames)
+
+    stacked = combine_frames(frame_passes, SigmaClipAccumulator())
+    expected = np.mean(frames, axis=0)
+    expected[4, 5] = np.mean([frame[4, 5] for index, frame in enumerate(frames) if index != 3])
+    self.assertAlmostEqual(stacked[4, 5], expected[4, 5])
+    self.assertLess(np.abs(stacked - expected).max(), 5)
+    self.assertGreater(len(passes), 1)
+
+  def test_inverse_variance_favours_quiet_frames(self):
+    rng = np.random.default_rng(1)
+    quiet = 100 + rng.normal(0, 1, (200, 200))
+    noisy = 110 + rng.normal(0, 10, (200, 200))
+    stacked = combine_frames(lambda: iter([quiet, noisy]), InverseVarianceAccumulator())
+    # the quiet frame weighs about 100 times as much as the noisy one
+    self.assertAlmostEqual(np.mean(stacked), 100 + 10 / 101, delta=0.05)
+
+
+class AlignmentTestClass(FileExtendedTestCase):
+
+  def setUp(self):
+    # a field of stars, from which frames are cut at different offsets
+    rng = np.random.default_rng(0)
+    self.field = rng.normal(100, 5, (700, 640))
+    y, x = np.mgrid[0:700, 0:640]
+    for star_y, star_x in zip(rng.uniform(0, 700, 150), rng.uniform(0, 640, 150)):
+      self.field += 1000 * np.exp(-((y - star_y)**2 + (x - star_x)**2) / 4)
+    super().setUp()
+
+  @staticmethod
+  def header(crpix, rotation=0):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150, 2]
+    wcs.wcs.crpix = crpix
+    angle = np.deg2rad(rotation)
+    wcs.wcs.cd = 1e-4 * np.array([[-np.cos(angle), np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    return wcs.to_header()
+
+  def test_wcs_translations(self):
+    shifts = wcs_translations([self.header([300, 250]), self.header([296.5, 252])], (500, 600))
+    np.testing.assert_allclose(shifts, [(0, 0), (2, -3.5)], atol=1e-6)
+
+    with self.assertRaises(NotATranslation):
+      wcs_translations([self.header([300, 250]), self.header([300, 250], rotation=0.5)], (500, 600))
+    self.assertIsNone(wcs_translations([self.header([300, 250]), fits.Header()], (500, 600)))
+
+  def test_phase_correlation_finds_whole_and_subpixel_shifts(self):
+    reference = self.field[50:650, 40:600]
+    np.testing.assert_allclose(phase_correlation_shift(reference, self.field[57:657, 31:591]), (-7, 9), atol=0.01)
+
+    # the field translated by a fraction of a pixel
+    frequencies_y, frequencies_x = np.fft.fftfreq(700)[:, None], np.fft.fftfreq(640)[None, :]
+    translated = np.fft.ifft2(np.fft.fft2(self.field) * np.exp(-2j * np.pi * (frequencies_y * 0.4 + frequencies_x * -0.3))).real
+    np.testing.assert_allclose(phase_correlation_shift(reference, translated[50:650, 40:600]), (0.4, -0.3), atol=0.01)
+
+  def test_shift_frame_onto_reference(self):
+    reference = self.field[50:650, 40:600]
+    frame = self.field[57:657, 31:591]
+    aligned = shift_frame(frame, (-7, 9), reference.shape)
+    r0, r1, c0, c1 = covered_bbox(reference.shape, frame.shape, (-7, 9))
+
+    self.assertEqual((r0, r1, c0, c1), (7, 600, 0, 551))
+    np.testing.assert_array_equal(aligned[r0:r1, c0:c1], reference[r0:r1, c0:c1])
+    self.assertTrue(np.isnan(aligned[:r0]).all() and np.isnan(aligned[:, c1:]).all())
+
+
+class FileCacheEvictionTestClass(FileExtendedTestCase):
+
+  @staticmethod
+  def trace_with_bulk_run(scan):
+    """ Two small frames used over and over, interrupted by a bulk operation reading 20 large frames once each """
+    trace = []
+    for time in range(10):
+      trace.append(TraceRecord(time, 'hot_1', 100))
+      trace.append(TraceRecord(time + 0.5, 'hot_2', 100))
+    trace.extend(TraceRecord(10 + index / 100, f'bulk_{index}', 1000, scan) for index in range(20))
+    for time in range(11, 21):
+      trace.append(TraceRecord(time, 'hot_1', 100))
+      trace.append(TraceRecord(time + 0.5, 'hot_2', 100))
+    return trace
+
+  def test_lru_bulk_run_flushes_hot_frames(self):
+    result = simulate(self.trace_with_bulk_run(scan=False), LRUStrategy, cache_size=3000)
+
+    # both hot frames miss once at the start and once more after the bulk run
+    self.assertEqual(result.requests, 60)
+    self.assertEqual(result.hits, 36)
+
+  def test_scan_keeps_hot_frames_cached(self):
+    for strategy in [LRUStrategy, GDSFStrategy]:
+      result = simulate(self.trace_with_bulk_run(scan=True), strategy, cache_size=3000)
+      self.assertEqual(result.hits, 38, strategy.name)
+
+  def test_gdsf_keeps_small_frequent_frames_over_large_ones(self):
+    trace = [TraceRecord(time, 'hot', 100) for time in range(5)]
+    trace.extend(TraceRecord(5 + index, f'large_{index}', 1000) for index in range(5))
+    trace.append(TraceRecord(10, 'hot', 100))
+
+    self.assertEqual(simulate(trace, LRUStrategy, cache_size=2500).hits, 4)
+    self.assertEqual(simulate(trace, GDSFStrategy, cache_size=2500).hits, 5)
+    self.assertAlmostEqual(GDSFStrategy.priority(0, 2.0, 3, 1048576), 5.0)
+
+
+class FileCacheManifestTestClass(FileExtendedTestCase):
+
+  def setUp(self):
+    self.manifest_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.manifest_dir, ignore_errors=True)
+    self.manifest = FileCacheManifest(self.manifest_dir)
+
+  def test_compact_replays_log_into_snapshot(self):
+    self.manifest.record_add('archive_a', '/tmp/archive_a.fits.fz', 100, 1.0)
+    self.manifest.record_add('archive_b', '/tmp/archive_b.fits.fz', 200, 2.0)
+    self.manifest.record_sidecar('archive_a', 40)
+    self.manifest.record_remove('archive_b')
+    # a worker that died mid-write leaves a torn line behind
+    with open(self.manifest.log_path, 'a') as log_file:
+      log_file.write('{"op": "add", "file_')
+    self.assertFalse(self.manifest.exists())
+
+    entries = self.manifest.compact()
+
+    self.assertTrue(self.manifest.exists())
+    self.assertFalse(os.path.exists(self.manifest.log_path))
+    self.assertEqual(entries, {'archive_a': {'file_path': '/tmp/archive_a.fits.fz', 'size': 100, 'sidecar_size': 40, 'time': 1.0}})
+    self.manifest.record_add('archive_c', '/tmp/archive_c.fits.fz', 300, 3.0)
+    self.assertEqual(set(self.manifest.compact()), {'archive_a', 'archive_c'})
+
+  def test_rewrite_keeps_records_made_while_listing(self):
+    self.manifest.record_add('archive_stale', '/tmp/archive_stale.fits.fz', 100, 1.0)
+    rotated_logs = self.manifest.begin_rewrite()
+    self.manifest.record_add('archive_new', '/tmp/archive_new.fits.fz', 100, 2.0)
+
+    self.manifest.finish_rewrite({'archive_a': {'file_path': '/tmp/archive_a.fits.fz', 'size': 10, 'sidecar_size': 0, 'time': 0.0}}, rotated_logs)
+
+    self.assertEqual(set(self.manifest.compact()), {'archive_a', 'archive_new'})
+
+
+class FileCacheRedisTestClass(FileExtendedTestCase):
+  """ Runs the FileCache and its lua scripts against fakeredis, downloading files of fake bytes into a temp dir """
+
+  CACHE_SIZE = 1000
+
+  def setUp(self):
+    super().setUp()
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+    self.enterContext(self.settings(TEMP_FITS_DIR=self.temp_dir, FILECACHE_TOTAL_SIZE=self.CACHE_SIZE,
+                                    FILECACHE_EVICTION_STRATEGY='lru', FILECACHE_TRACE_PATH=''))
+    self.server = fakeredis.FakeServer()
+    self.redis = fakeredis.FakeRedis(server=self.server)
+    # every FileCache gets a client of its own, like the workers sharing the real redis
+    mock_cache = self.enterContext(mock.patch.object(filecache, 'cache'))
+    mock_cache.client.get_client.side_effect = lambda: fakeredis.FakeRedis(server=self.server)
+    self.enterContext(mock.patch.object(filecache, 'write_fits_metadata', return_value=0))
+    self.mock_download = self.enterContext(mock.patch.object(filecache, 'download_fits', side_effect=self.download))
+    self.file_sizes = {}
+    self.file_cache = FileCache()
+
+  def download(self, file_path, basename, source, user):
+    # Streams to the .part file and renames it into place like download_fits, the file holding its size in bytes
+    with open(f'{file_path}{DOWNLOAD_PART_SUFFIX}', 'wb') as part_file:
+      part_file.write(b'x' * self.file_sizes.get(basename, 100))
+    os.replace(f'{file_path}{DOWNLOAD_PART_SUFFIX}', file_path)
+
+  def total_size(self):
+    return int(self.redis.get(self.file_cache.total_size_name))
+
+  def index(self):
+    return [file_key.decode('utf-8') for file_key in self.redis.zrange(self.file_cache.index_name, 0, -1)]
+
+  def test_get_fits_downloads_on_miss_and_hits_cache(self):
+    self.assertIsNone(self.file_cache.get_cached_file('archive_a'))
+
+    file_path = self.file_cache.get_fits('a')
+
+    self.assertEqual(file_path, os.path.join(self.temp_dir, 'archive_a.fits.fz'))
+    self.assertEqual(FileCache().get_fits('a'), file_path)
+    self.assertEqual(self.file_cache.get_cached_file('archive_a'), file_path)
+    self.mock_download.assert_called_once()
+    self.assertEqual(int(self.redis.hget('archive_a', 'hits')), 3)
+    self.assertEqual(int(self.redis.hget('archive_a', 'size')), 100)
+    self.assertIsNone(self.redis.hget('archive_a', 'owner'))
+
+  def test_total_size_is_the_sum_of_entries(self):
+    self.file_sizes = {'a': 100, 'b': 250}
+    self.file_cache.get_fits('a')
+    self.file_cache.get_fits('b')
+    output_path = os.path.join(self.temp_dir, 'output.fits')
+    with open(output_path, 'wb') as output_file:
+      output_file.write(b'x' * 50)
+    self.file_cache.add_file_to_cache(output_path)
+    # replacing an entry only counts the difference
+    with open(output_path, 'wb') as output_file:
+      output_file.write(b'x' * 70)
+    self.file_cache.add_file_to_cache(output_path)
+
+    self.assertEqual(self.total_size(), 420)
+    self.assertEqual(self.total_size(), sum(int(self.redis.hget(file_key, 'size')) for file_key in self.index()))
+
+  def test_eviction_follows_the_index_order(self):
+    self.file_sizes = {'a': 300, 'b': 300, 'c': 300, 'd': 300}
+    for basename in ['a', 'b', 'c']:
+      self.file_cache.get_fits(basename)
+    # a hit moves a to the end of the index
+    self.file_cache.get_fits('a')
+    self.assertEqual(self.index(), ['archive_b', 'archive_c', 'archive_a'])
+
+    self.file_cache.get_fits('d')
+
+    self.assertEqual(self.index(), ['archive_c', 'archive_a', 'archive_d'])
+    self.assertEqual(self.total_size(), 900)
+    self.assertIsNone(self.redis.hget('archive_b', 'file_path'))
+    self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'archive_b.fits.fz')))
+    self.assertIsFile(os.path.join(self.temp_dir, 'archive_a.fits.fz'))
+
+  def test_legacy_download_entries_are_taken_over(self):
+    # entries claimed before download leases had no owner or lease_expiry, and were left behind by dead workers
+    file_path = os.path.join(self.temp_dir, 'archive_a.fits.fz')
+    self.redis.hset('archive_a', mapping={'file_path': file_path, 'size': -1})
+
+    self.assertEqual(self.file_cache.get_fits('a'), file_path)
+
+    self.mock_download.assert_called_once()
+    self.assertEqual(int(self.redis.hget('archive_a', 'size')), 100)
+    self.assertEqual(self.total_size(), 100)
+
+  def wait_for_waiters(self, file_key, count):
+    # Blocks until count workers are subscribed to file_key's download channel
+    channel = self.file_cache._download_channel(file_key)
+    for _ in range(500):
+      if dict(self.redis.pubsub_numsub(channel)).get(channel.encode('utf-8'), 0) >= count:
+        return
+      time.sleep(0.01)
+    self.fail(f'{count} workers never waited on {file_key}')
+
+  def run_get_fits(self, basename, results):
+    # Calls get_fits on a thread of its own, as another worker would, recording its path or error in results
+    def get_fits():
+      try:
+        results.append(FileCache().get_fits(basename))
+      except Exception as e:
+        results.append(e)
+    thread = threading.Thread(target=get_fits)
+    thread.start()
+    self.addCleanup(thread.join, 5)
+    return thread
+
+  def test_concurrent_get_fits_downloads_once_and_wakes_every_waiter(self):
+    download_started, finish_download = threading.Event(), threading.Event()
+    def slow_download(*args):
+      download_started.set()
+      finish_download.wait(5)
+      self.download(*args)
+    self.mock_download.side_effect = slow_download
+
+    results = []
+    threads = [self.run_get_fits('a', results)]
+    self.assertTrue(download_started.wait(5))
+    threads += [self.run_get_fits('a', results) for _ in range(3)]
+    self.wait_for_waiters('archive_a', 3)
+    finish_download.set()
+    for thread in threads:
+      thread.join(5)
+
+    self.assertEqual(results, [os.path.join(self.temp_dir, 'archive_a.fits.fz')] * 4)
+    self.mock_download.assert_called_once()
+
+  def test_failed_download_wakes_waiters_to_download_it_themselves(self):
+    download_started, fail_download = threading.Event(), threading.Event()
+    def failing_download(*args):
+      if not download_started.is_set():
+        download_started.set()
+        fail_download.wait(5)
+        raise ConnectionError('archive unreachable')
+      self.download(*args)
+    self.mock_download.side_effect = failing_download
+
+    results = []
+    first = self.run_get_fits('a', results)
+    self.assertTrue(download_started.wait(5))
+    waiters = [self.run_get_fits('a', results) for _ in range(3)]
+    self.wait_for_waiters('archive_a', 3)
+    fail_download.set()
+    for thread in [first] + waiters:
+      thread.join(5)
+
+    # the first download raises, then one waiter downloads the file again for all of them
+    errors = [result for result in results if isinstance(result, Exception)]
+    self.assertEqual(len(errors), 1)
+    self.assertIsInstance(errors[0], ConnectionError)
+    self.assertEqual([result for result in results if result not in errors], [os.path.join(self.temp_dir, 'archive_a.fits.fz')] * 3)
+    self.assertEqual(self.mock_download.call_count, 2)
+
+  def test_leased_files_survive_eviction_until_the_lease_ends(self):
+    self.file_sizes = {'a': 400, 'b': 400, 'c': 400, 'd': 400}
+    with self.file_cache.lease():
+      self.file_cache.get_fits('a')
+      # another worker, outside the lease, caches b
+      self.run_get_fits('b', []).join(5)
+      # a is the first to evict, but pinned by the lease
+      self.file_cache.get_fits('c')
+      self.assertEqual(self.index(), ['archive_a', 'archive_c'])
+      self.assertIsNone(self.redis.hget('archive_b', 'file_path'))
+
+    self.file_cache.get_fits('d')
+
+    self.assertEqual(self.index(), ['archive_c', 'archive_d'])
+    self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'archive_a.fits.fz')))
+
+  def test_expired_pins_no_longer_protect_files(self):
+    self.file_sizes = {'a': 400, 'b': 400, 'c': 400}
+    lease = self.file_cache.lease()
+    self.file_cache.get_fits('a', lease=lease)
+    self.file_cache.get_fits('b')
+    # the worker holding the lease died, so its pin was last refreshed more than PIN_TTL ago
+    self.redis.zadd('archive_a:pins', {lease.lease_id: time.time() - 1})
+
+    self.file_cache.get_fits('c')
+
+    self.assertEqual(self.index(), ['archive_b', 'archive_c'])
+    self.assertEqual(self.redis.zcard('archive_a:pins'), 0)
+
+  def test_late_completion_of_a_taken_over_download_is_discarded(self):
+    first_started, finish_first = threading.Event(), threading.Event()
+    def downloads(file_path, basename, source, user):
+      if not first_started.is_set():
+        first_started.set()
+        finish_first.wait(5)
+        self.file_sizes[basename] = 100
+      else:
+        self.file_sizes[basename] = 200
+      self.download(file_path, basename, source, user)
+    self.mock_download.side_effect = downloads
+
+    results = []
+    first = self.run_get_fits('a', results)
+    self.assertTrue(first_started.wait(5))
+    first_owner = self.redis.hget('archive_a', 'owner').decode('utf-8')
+    # the first worker stalled past its download lease, so the next get_fits takes the download over
+    self.redis.hset('archive_a', 'lease_expiry', time.time() - 1)
+    file_path = self.file_cache.get_fits('a')
+    finish_first.set()
+    first.join(5)
+
+    self.assertEqual(results, [file_path])
+    self.assertEqual(os.path.getsize(file_path), 200)
+    self.assertEqual(int(self.redis.hget('archive_a', 'size')), 200)
+    self.assertEqual(self.total_size(), 200)
+    self.assertEqual([name for name in os.listdir(self.temp_dir) if name.endswith(filecache.DOWNLOADING_SUFFIXES)], [])
+    # nor can the first worker store its download once it was taken over
+    self.assertIsNone(self.file_cache._store_file('archive_a', file_path, 100, owner=first_owner))
+    self.assertEqual(int(self.redis.hget('archive_a', 'size')), 200)
+
+  @mock.patch.object(filecache, 'get_archive_urls')
+  def test_prefetch_finds_files_cached_under_their_fits_names(self, mock_get_archive_urls):
+    file_path = self.file_cache.get_fits('a')
+
+    futures = self.file_cache.prefetch(['a-large', 'a-small'])
+
+    self.assertEqual([future.result() for future in futures], [file_path, file_path])
+    mock_get_archive_urls.assert_not_called()
+    self.mock_download.assert_called_once()
+
+  @mock.patch('datalab.datalab_session.utils.s3_utils.get_http_session')
+  def test_prefetch_of_a_jpg_name_looks_its_fits_file_up_once(self, mock_session):
+    mock_session.return_value.get.side_effect = lambda url, params, headers, timeout: mock.MagicMock(
+      **{'json.return_value': {'results': [{'url': f"https://archive/{params['basename_exact']}"}]}})
+    def download(file_path, basename, source, user):
+      self.assertEqual(get_fits_url(basename, source, user), 'https://archive/foo')
+      self.download(file_path, basename, source, user)
+    self.mock_download.side_effect = download
+    cache.clear()
+
+    [future] = self.file_cache.prefetch(['foo-large'])
+
+    self.assertEqual(future.result(), os.path.join(self.temp_dir, 'archive_foo.fits.fz'))
+    self.assertEqual([call.kwargs['params'] for call in mock_session.return_value.get.call_args_list], [{'basename_exact': 'foo'}])
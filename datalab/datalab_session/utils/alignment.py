@@ -0,0 +1,143 @@
+import math
+
+import numpy as np
+from astropy.wcs import WCS
+
+# Largest difference, in pixels anywhere on the frame, between a frame's WCS and the reference's shifted by a translation
+# for the frame to be aligned by shifting it rather than reprojecting it
+TRANSLATION_TOLERANCE = 0.25
+# Frames are block averaged down to at most this many pixels a side to find their shift by phase correlation, which is
+# then refined on a crop of this size at full resolution
+CORRELATION_SIZE = 512
+# Shifts closer than this to a whole number of pixels are applied without interpolating
+INTEGER_SHIFT_TOLERANCE = 1e-3
+
+
+class NotATranslation(ValueError):
+    ''' A frame's WCS differs from the reference's by more than a translation, e.g. a rotation or a different scale '''
+
+
+def wcs_translations(headers: list, shape: tuple) -> list:
+    ''' The shift (dy, dx) of each frame from the first, the reference of the given shape, such that the reference's
+        pixel (y, x) is at (y + dy, x + dx) in the frame. Returns None if any header has no celestial WCS, and raises
+        NotATranslation if the WCSs differ by more than a translation of TRANSLATION_TOLERANCE pixels.
+    '''
+    wcss = [WCS(header).celestial for header in headers]
+    if not all(wcs.has_celestial for wcs in wcss):
+        return None
+    # The corners and center of the reference, where any rotation or change of scale shows most
+    height, width = shape
+    x = np.array([0, width - 1, 0, width - 1, (width - 1) / 2])
+    y = np.array([0, 0, height - 1, height - 1, (height - 1) / 2])
+    sky = wcss[0].pixel_to_world_values(x, y)
+    shifts = []
+    for index, wcs in enumerate(wcss):
+        frame_x, frame_y = wcs.world_to_pixel_values(*sky)
+        dx, dy = frame_x - x, frame_y - y
+        if not np.all(np.isfinite(dx)) or max(np.ptp(dx), np.ptp(dy)) > TRANSLATION_TOLERANCE:
+            raise NotATranslation(f'Frame {index} differs from the first by more than a translation')
+        shifts.append((float(dy[-1]), float(dx[-1])))
+    return shifts
+
+
+def _downsample(data: np.ndarray, factor: int) -> np.ndarray:
+    # Block averages data by factor, dropping the rows and columns that don't fill a block
+    height, width = data.shape[0] // factor * factor, data.shape[1] // factor * factor
+    return data[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+
+def _peak_offset(values: np.ndarray) -> float:
+    # Subpixel offset of the peak of three samples around the middle one. A phase correlation peak is a sampled sinc
+    # rather than a parabola, so the offset is the share of the peak in its larger neighbour (Foroosh et al. 2002)
+    before, peak, after = values
+    if after >= before:
+        return float(after / (after + peak)) if after > 0 else 0.0
+    return float(-before / (before + peak)) if before > 0 else 0.0
+
+
+def _phase_correlation(reference: np.ndarray, frame: np.ndarray) -> tuple:
+    # The subpixel (dy, dx) that frame's content is translated by from reference's, both the same shape
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+    prepared = []
+    for data in (reference, frame):
+        data = np.asarray(data, dtype=np.float64)
+        data = np.where(np.isfinite(data), data, np.nanmedian(data))
+        prepared.append(np.fft.rfft2((data - data.mean()) * window))
+    cross_power = prepared[1] * np.conj(prepared[0])
+    correlation = np.fft.irfft2(cross_power / np.maximum(np.abs(cross_power), 1e-12), s=reference.shape)
+
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        around = [correlation[tuple((peak[i] + step) % size if i == axis else peak[i] for i in range(2))] for step in (-1, 0, 1)]
+        position = peak[axis] + _peak_offset(around)
+        shift.append(position - size if position > size / 2 else position)
+    return tuple(shift)
+
+
+def phase_correlation_shift(reference: np.ndarray, frame: np.ndarray) -> tuple:
+    ''' The shift (dy, dx) of frame from reference, as returned by wcs_translations, found by phase correlation of the
+        frames block averaged to CORRELATION_SIZE pixels, then refined at full resolution on a central crop
+    '''
+    height, width = min(reference.shape[0], frame.shape[0]), min(reference.shape[1], frame.shape[1])
+    factor = max(1, math.ceil(max(height, width) / CORRELATION_SIZE))
+    coarse_dy, coarse_dx = _phase_correlation(_downsample(reference[:height, :width], factor),
+                                              _downsample(frame[:height, :width], factor))
+    # The content moved by (dy, dx), so the reference's pixel (y, x) is at (y + dy, x + dx) in the frame
+    if factor == 1:
+        return coarse_dy, coarse_dx
+
+    shift_y, shift_x = round(coarse_dy * factor), round(coarse_dx * factor)
+    crop_height, crop_width = min(CORRELATION_SIZE, height - abs(shift_y)), min(CORRELATION_SIZE, width - abs(shift_x))
+    if crop_height < 8 or crop_width < 8:
+        return coarse_dy * factor, coarse_dx * factor
+    # A crop of the reference away from the edges, and the crop of the frame its pixels should have moved to
+    top = max(0, -shift_y) + (height - abs(shift_y) - crop_height) // 2
+    left = max(0, -shift_x) + (width - abs(shift_x) - crop_width) // 2
+    fine_dy, fine_dx = _phase_correlation(
+        reference[top:top + crop_height, left:left + crop_width],
+        frame[top + shift_y:top + shift_y + crop_height, left + shift_x:left + shift_x + crop_width]
+    )
+    return shift_y + fine_dy, shift_x + fine_dx
+
+
+def _shifted(frame: np.ndarray, offset_y: int, offset_x: int, shape: tuple) -> np.ndarray:
+    # An array of shape whose pixel (y, x) is frame's (y + offset_y, x + offset_x), NaN where that is off the frame
+    shifted = np.full(shape, np.nan, dtype=np.float64)
+    top, bottom = max(0, -offset_y), min(shape[0], frame.shape[0] - offset_y)
+    left, right = max(0, -offset_x), min(shape[1], frame.shape[1] - offset_x)
+    if top < bottom and left < right:
+        shifted[top:bottom, left:right] = frame[top + offset_y:bottom + offset_y, left + offset_x:right + offset_x]
+    return shifted
+
+
+def _split_shift(shift: float) -> tuple:
+    # The whole and fractional pixels of a shift, rounded to a whole number of pixels within INTEGER_SHIFT_TOLERANCE
+    if abs(shift - round(shift)) < INTEGER_SHIFT_TOLERANCE:
+        return round(shift), 0.0
+    return math.floor(shift), shift - math.floor(shift)
+
+
+def shift_frame(frame: np.ndarray, shift: tuple, shape: tuple) -> np.ndarray:
+    ''' frame resampled onto the reference grid of shape, given its shift from wcs_translations or
+        phase_correlation_shift. Whole pixel shifts keep the frame's pixels as they are, others are interpolated bilinearly.
+        Pixels the frame doesn't cover are NaN.
+    '''
+    (offset_y, fraction_y), (offset_x, fraction_x) = _split_shift(shift[0]), _split_shift(shift[1])
+    aligned = None
+    for step_y, weight_y in ((0, 1 - fraction_y), (1, fraction_y)):
+        for step_x, weight_x in ((0, 1 - fraction_x), (1, fraction_x)):
+            if weight_y * weight_x == 0:
+                continue
+            contribution = weight_y * weight_x * _shifted(frame, offset_y + step_y, offset_x + step_x, shape)
+            aligned = contribution if aligned is None else aligned + contribution
+    return aligned
+
+
+def covered_bbox(shape: tuple, frame_shape: tuple, shift: tuple) -> tuple:
+    ''' The bbox (r0, r1, c0, c1) of the reference grid of shape that shift_frame fills from a frame of frame_shape '''
+    (offset_y, fraction_y), (offset_x, fraction_x) = _split_shift(shift[0]), _split_shift(shift[1])
+    # Interpolated pixels need the frame's next row or column too
+    r1 = min(shape[0], frame_shape[0] - offset_y - (1 if fraction_y else 0))
+    c1 = min(shape[1], frame_shape[1] - offset_x - (1 if fraction_x else 0))
+    return max(0, -offset_y), r1, max(0, -offset_x), c1
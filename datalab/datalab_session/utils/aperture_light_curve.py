@@ -26,6 +26,7 @@ from datalab.datalab_session.utils.comparison_stars import (
     measure_candidate_on_frame,
 )
 from datalab.datalab_session.utils.centroiding import calculate_background_model, centroid
+from datalab.datalab_session.utils.file_utils import get_fits_metadata
 from datalab.datalab_session.utils.fits_metadata import (
     FrameGeometry,
     arcsec_to_pixels,
@@ -113,16 +114,16 @@ class FrameContext:
 
     @classmethod
     def from_fits(cls, fits_path: str) -> "FrameContext":
-        """Reads the SCI header and CAT table only. Raises LightCurveError if the frame is unusable."""
-        with fits.open(fits_path) as hdul:
-            for extension in ("SCI", "CAT"):
-                if extension not in hdul:
-                    raise LightCurveError(
-                        f"{os.path.basename(fits_path)} has no {extension} extension. Aperture "
-                        "photometry needs reduced frames carrying an image and a source catalog."
-                    )
-            header = dict(hdul["SCI"].header)
-            second_hdu_rows = tuple(_cat_rows(hdul["CAT"].data))
+        """Reads the SCI header and CAT table only, from the file's cached metadata. Raises LightCurveError if the frame is unusable."""
+        metadata = get_fits_metadata(fits_path)
+        for extension, contents in (("SCI", metadata.header), ("CAT", metadata.catalog)):
+            if contents is None:
+                raise LightCurveError(
+                    f"{os.path.basename(fits_path)} has no {extension} extension. Aperture "
+                    "photometry needs reduced frames carrying an image and a source catalog."
+                )
+        header = dict(metadata.header)
+        second_hdu_rows = tuple(_cat_rows(metadata.catalog))
 
         if int(header.get("NAXIS", 0)) != 2:
             raise LightCurveError(f"Primary image for {fits_path} is not a 2D array.")
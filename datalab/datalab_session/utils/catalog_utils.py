@@ -7,7 +7,7 @@ from astropy.time import Time
 from astropy.wcs import WCS
 
 from datalab.datalab_session.exceptions import ClientAlertException
-from datalab.datalab_session.utils.file_utils import get_fits_header, get_hdu
+from datalab.datalab_session.utils.file_utils import get_catalog, get_fits_header
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -24,7 +24,7 @@ def extract_calibrated_catalog(fits_path: str, basename: str = '') -> dict:
   - Drops rows with non-finite values in any returned column, and rows whose photometry
     the extraction itself flagged as unreliable (see reliable_photometry)
   """
-  cat_data = get_hdu(fits_path, 'CAT').data
+  cat_data = get_catalog(fits_path)
 
   if 'mag' not in cat_data.names or 'magerr' not in cat_data.names:
     raise ClientAlertException(f'{basename} has no zero-point calibrated magnitudes (CAT mag/magerr), '
@@ -0,0 +1,164 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Pixels sampled from each frame to estimate its background noise
+NOISE_SAMPLE_SIZE = 100000
+# Scales the median absolute deviation of normally distributed pixels to their standard deviation
+MAD_TO_SIGMA = 1.4826
+
+
+class StackAccumulator():
+    ''' Combines frames pixel by pixel as they are added one at a time, so only the accumulators and the frame being
+        added are ever in memory. Frames are cropped to the largest shape they all share, as crop_arrays does, and NaN
+        pixels are left out of the combination.
+        An accumulator that needs to see the frames more than once (e.g. to reject outliers) asks for another pass by
+        returning True from end_pass(), after which every frame is added again in the same order.
+    '''
+
+    def __init__(self):
+        self.shape = None
+
+    def _allocate(self, shape: tuple):
+        raise NotImplementedError
+
+    def _crop(self, shape: tuple):
+        raise NotImplementedError
+
+    def _fit(self, frame: np.ndarray) -> np.ndarray:
+        # Allocates the accumulators for the first frame and crops them down to any smaller frame after it
+        if self.shape is None:
+            self.shape = frame.shape
+            self._allocate(self.shape)
+        elif frame.shape[0] < self.shape[0] or frame.shape[1] < self.shape[1]:
+            self.shape = (min(frame.shape[0], self.shape[0]), min(frame.shape[1], self.shape[1]))
+            self._crop(self.shape)
+        return np.asarray(frame[:self.shape[0], :self.shape[1]], dtype=np.float64)
+
+    def add(self, frame: np.ndarray):
+        raise NotImplementedError
+
+    def end_pass(self) -> bool:
+        ''' Called after every frame has been added, returns whether the frames should be added again '''
+        return False
+
+    def result(self) -> np.ndarray:
+        raise NotImplementedError
+
+
+class SumAccumulator(StackAccumulator):
+    ''' The sum of the frames, as np.nansum '''
+
+    def _allocate(self, shape):
+        self.total = np.zeros(shape, dtype=np.float64)
+
+    def _crop(self, shape):
+        self.total = self.total[:shape[0], :shape[1]]
+
+    def add(self, frame):
+        frame = self._fit(frame)
+        np.add(self.total, frame, out=self.total, where=~np.isnan(frame))
+
+    def result(self):
+        return self.total
+
+
+class InverseVarianceAccumulator(StackAccumulator):
+    ''' The mean of the frames weighted by the inverse of their background variance, so noisy frames count for less.
+        Each frame's variance is estimated from the median absolute deviation of a sample of its pixels.
+    '''
+
+    def _allocate(self, shape):
+        self.weighted_total = np.zeros(shape, dtype=np.float64)
+        self.total_weight = np.zeros(shape, dtype=np.float64)
+
+    def _crop(self, shape):
+        self.weighted_total = self.weighted_total[:shape[0], :shape[1]]
+        self.total_weight = self.total_weight[:shape[0], :shape[1]]
+
+    @staticmethod
+    def frame_weight(frame: np.ndarray) -> float:
+        sample = frame.ravel()[::max(1, frame.size // NOISE_SAMPLE_SIZE)]
+        sample = sample[np.isfinite(sample)]
+        sigma = MAD_TO_SIGMA * np.median(np.abs(sample - np.median(sample))) if sample.size else 0.0
+        if not sigma > 0:
+            # A constant frame has no measurable noise, so it is weighted like a frame of unit variance
+            log.warning('InverseVarianceAccumulator: frame has no measurable background noise, weighting it as 1')
+            return 1.0
+        return 1.0 / sigma**2
+
+    def add(self, frame):
+        frame = self._fit(frame)
+        weight = self.frame_weight(frame)
+        valid = ~np.isnan(frame)
+        np.add(self.weighted_total, weight * frame, out=self.weighted_total, where=valid)
+        np.add(self.total_weight, weight, out=self.total_weight, where=valid)
+
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.weighted_total / self.total_weight
+
+
+class SigmaClipAccumulator(StackAccumulator):
+    ''' The mean of the frames after rejecting, pixel by pixel, values more than sigma standard deviations from the
+        mean. The first pass takes the running mean and variance of every value, and each later pass of only the values
+        within the bounds of the pass before, until no more are rejected or after iterations clipping passes.
+        A single value can only lie sqrt(n - 1) standard deviations from the mean of n, so fewer than sigma**2 + 1
+        frames never reject anything.
+    '''
+
+    def __init__(self, sigma: float = 3.0, iterations: int = 3):
+        super().__init__()
+        self.sigma = sigma
+        self.iterations = iterations
+        self.clipping_pass = 0
+        self.center = self.spread = self.previous_count = None
+
+    def _allocate(self, shape):
+        # Welford's running count, mean and sum of squared deviations
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.squared_deviations = np.zeros(shape, dtype=np.float64)
+
+    def _crop(self, shape):
+        self.count = self.count[:shape[0], :shape[1]]
+        self.mean = self.mean[:shape[0], :shape[1]]
+        self.squared_deviations = self.squared_deviations[:shape[0], :shape[1]]
+
+    def add(self, frame):
+        frame = self._fit(frame)
+        valid = ~np.isnan(frame)
+        if self.center is not None:
+            with np.errstate(invalid='ignore'):
+                valid &= np.abs(frame - self.center) <= self.sigma * self.spread
+        np.add(self.count, 1, out=self.count, where=valid)
+        delta = frame - self.mean
+        np.add(self.mean, delta / np.maximum(self.count, 1), out=self.mean, where=valid)
+        np.add(self.squared_deviations, delta * (frame - self.mean), out=self.squared_deviations, where=valid)
+
+    def end_pass(self):
+        nothing_rejected = self.previous_count is not None and np.array_equal(self.count, self.previous_count)
+        if self.clipping_pass >= self.iterations or nothing_rejected:
+            return False
+        self.clipping_pass += 1
+        self.center = self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.spread = np.sqrt(self.squared_deviations / self.count)
+        self.previous_count = self.count
+        self._allocate(self.shape)
+        return True
+
+    def result(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+
+def combine_frames(frame_passes, accumulator: StackAccumulator) -> np.ndarray:
+    ''' Combines the frames yielded by frame_passes() with accumulator, calling it again for every pass it asks for '''
+    while True:
+        for frame in frame_passes():
+            accumulator.add(frame)
+        if not accumulator.end_pass():
+            return accumulator.result()
@@ -1,20 +1,31 @@
 import tempfile
 import logging
 import os
+import uuid
 from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from astropy.io import fits
 import numpy as np
-from fits2image.conversions import fits_to_jpg, fits_to_img, multi_fits_to_img
+from fits2image.conversions import fits_to_jpg, fits_to_img
+from fits2image.orientation import orient_array, orient_image
+from fits2image.scaling import DEFAULT_GAMMA_LUT, auto_scale_data, quick_scale_image
+from PIL import Image
 
 from datalab import settings
 from datalab.datalab_session.exceptions import ClientAlertException
+from datalab.datalab_session.utils.fits_compression import ProfiledCompImageHDU, get_compression_profile
+from datalab.datalab_session.utils.strips import common_shape
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
 TIFF_EXTENSION = 'TIFF'
+# A fits file's SCI header and CAT table are kept next to it as <path>.meta.npz
+METADATA_SUFFIX = '.meta.npz'
 
 def get_hdu(path: str, extension: str = 'SCI', use_fsspec: bool = False) -> list[fits.HDUList]:
   """
@@ -31,11 +42,121 @@ def get_hdu(path: str, extension: str = 'SCI', use_fsspec: bool = False) -> list
 
     return extension_copy
 
+class CatalogColumns():
+  """
+  The columns of a CAT table as read-only numpy arrays. Reads like the table's FITS_rec: by column name,
+  with .names, len() in rows, and an index or slice selecting rows
+  """
+  def __init__(self, columns: dict):
+    self.columns = columns
+    for column in self.columns.values():
+      column.flags.writeable = False
+
+  @property
+  def names(self) -> list:
+    return list(self.columns)
+
+  def __len__(self):
+    return len(next(iter(self.columns.values()), []))
+
+  def __getitem__(self, key):
+    if isinstance(key, str):
+      return self.columns[key]
+    if isinstance(key, slice):
+      return CatalogColumns({name: column[key].copy() for name, column in self.columns.items()})
+    # A single row, as a dict of its values
+    return {name: column[key] for name, column in self.columns.items()}
+
+@dataclass(frozen=True)
+class FitsMetadata:
+  """ A fits file's SCI header and CAT columns, None for an extension the file doesn't have """
+  header: fits.Header | None
+  catalog: CatalogColumns | None
+
+def _read_fits_metadata(path: str) -> FitsMetadata:
+  with fits.open(path) as hdul:
+    header = hdul['SCI'].header.copy() if 'SCI' in hdul else None
+    catalog = None
+    if 'CAT' in hdul and hdul['CAT'].data is not None:
+      cat_data = hdul['CAT'].data
+      # Native byte order, so the columns don't need swapping every time they are used
+      catalog = CatalogColumns({name: np.asarray(cat_data[name]).astype(cat_data[name].dtype.newbyteorder('='))
+                                for name in cat_data.names})
+  return FitsMetadata(header, catalog)
+
+def write_fits_metadata(path: str) -> int:
+  """
+  Extracts the SCI header and CAT table of a fits file into <path>.meta.npz, stamped with the file's size and
+  modification time so a sidecar left behind by a replaced file is never used. Returns the sidecar's size.
+  """
+  metadata = _read_fits_metadata(path)
+  file_stat = os.stat(path)
+  arrays = {'source_stat': np.array([file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)}
+  if metadata.header is not None:
+    arrays['header'] = np.array(metadata.header.tostring())
+  if metadata.catalog is not None:
+    arrays['catalog_names'] = np.array(metadata.catalog.names, dtype=str)
+    arrays.update({f'catalog_{index}': metadata.catalog[name] for index, name in enumerate(metadata.catalog.names)})
+
+  metadata_path = f'{path}{METADATA_SUFFIX}'
+  # Written under a temporary name and renamed into place, so readers never load a partially written sidecar
+  partial_path = f'{metadata_path}.{uuid.uuid4().hex}{METADATA_SUFFIX}'
+  try:
+    with open(partial_path, 'wb') as partial_file:
+      np.savez(partial_file, **arrays)
+    os.replace(partial_path, metadata_path)
+  finally:
+    Path(partial_path).unlink(missing_ok=True)
+  return os.path.getsize(metadata_path)
+
+def _load_metadata_sidecar(path: str, size: int, mtime_ns: int) -> FitsMetadata | None:
+  try:
+    with np.load(f'{path}{METADATA_SUFFIX}') as sidecar:
+      if list(sidecar['source_stat']) != [size, mtime_ns]:
+        return None
+      header = fits.Header.fromstring(str(sidecar['header'])) if 'header' in sidecar else None
+      catalog = None
+      if 'catalog_names' in sidecar:
+        catalog = CatalogColumns({str(name): sidecar[f'catalog_{index}'] for index, name in enumerate(sidecar['catalog_names'])})
+      return FitsMetadata(header, catalog)
+  except (OSError, ValueError, KeyError):
+    # No sidecar, or an unreadable one
+    return None
+
+@lru_cache(maxsize=16)
+def _cached_fits_metadata(path: str, size: int, mtime_ns: int) -> FitsMetadata:
+  # Keyed on the file's size and modification time too, so a rewritten file is read again
+  return _load_metadata_sidecar(path, size, mtime_ns) or _read_fits_metadata(path)
+
+def get_fits_metadata(path: str) -> FitsMetadata:
+  """
+  Returns the SCI header and CAT columns of a fits file, from its metadata sidecar if the FileCache wrote one, so
+  metadata-only reads don't reopen the file. Repeat reads within a process are served from memory.
+  Treat the returned header as read-only, get_fits_header returns a copy.
+  """
+  file_stat = os.stat(path)
+  return _cached_fits_metadata(path, file_stat.st_size, file_stat.st_mtime_ns)
+
+def get_catalog(path: str) -> CatalogColumns:
+  """
+  Returns the CAT table of a fits file as read-only columns, see get_fits_metadata
+  """
+  catalog = get_fits_metadata(path).catalog
+  if catalog is None:
+    raise ClientAlertException(f"CAT Header not found in fits file at {path.split('/')[-1]}")
+  return catalog
+
 def get_fits_header(path: str, extension: str = 'SCI') -> fits.Header:
   """
   Returns the header for an extension without touching its data, so large (compressed) images
-  are never decompressed into memory.
+  are never decompressed into memory. The SCI header comes from get_fits_metadata.
   """
+  if extension == 'SCI':
+    header = get_fits_metadata(path).header
+    if header is None:
+      raise ClientAlertException(f"{extension} Header not found in fits file at {path.split('/')[-1]}")
+    return header.copy()
+
   with fits.open(path) as hdu:
     try:
       return hdu[extension].header.copy()
@@ -43,21 +164,27 @@ def get_fits_header(path: str, extension: str = 'SCI') -> fits.Header:
       raise ClientAlertException(f"{extension} Header not found in fits file at {path.split('/')[-1]}")
 
 def get_fits_dimensions(fits_file, extension: str = 'SCI') -> tuple:
+  if extension == 'SCI':
+    header = get_fits_header(fits_file, extension)
+    return tuple(header[f'NAXIS{axis}'] for axis in range(header['NAXIS'], 0, -1))
+
   with fits.open(fits_file) as hdu:
     hdu_shape = hdu[extension].shape
     return hdu_shape
 
 @contextmanager
-def create_fits(key: str, image_arr: np.ndarray, comment=None) -> str:
+def create_fits(key: str, image_arr: np.ndarray, comment=None, compression: str = None) -> str:
   """
-  Creates a fits file with the given key and image array
+  Creates a fits file with the given key and image array, compressed with the compression profile given or
+  FITS_OUTPUT_COMPRESSION
   Returns the the path to the fits_file
   """
 
   header = fits.Header([('KEY', key)])
   header.add_comment(comment) if comment else None
   primary_hdu = fits.PrimaryHDU(header=header)
-  image_hdu = fits.CompImageHDU(data=image_arr, name='SCI')
+  profile = get_compression_profile(compression or settings.FITS_OUTPUT_COMPRESSION)
+  image_hdu = ProfiledCompImageHDU(data=image_arr, name='SCI', profile=profile, workers=settings.FITS_COMPRESSION_WORKERS)
 
   hdu_list = fits.HDUList([primary_hdu, image_hdu])
   fits_path = tempfile.NamedTemporaryFile(suffix=f'{key}.fits', dir=settings.TEMP_FITS_DIR).name
@@ -103,34 +230,75 @@ def create_jpgs(fits_paths: str, large_jpg_path, thumbnail_jpg_path, color=False
   fits_to_jpg(fits_paths, large_jpg_path, width=max_width, height=max_height, color=color, zmin=zmin, zmax=zmax)
   fits_to_jpg(fits_paths, thumbnail_jpg_path, color=color, zmin=zmin, zmax=zmax)
 
-
-def get_input_dimensions(input_dict):
+def create_jpgs_from_data(image_data: np.ndarray, header: fits.Header, large_jpg_path: str, thumbnail_jpg_path: str):
   """
-    Get max width/height for the set of fits input dicts for the multi_fits_to_img function
+    Renders the jpgs create_jpgs would from an image already in memory, so a freshly computed output isn't written
+    and decompressed again. The image is scaled and oriented once for both jpgs.
   """
-  if input_dict.get('fits_path'):
-    return get_fits_dimensions(input_dict['fits_path'])
-  else:
-    return input_dict['fits_data'].shape
+  header = header.copy()
+  header['NAXIS1'], header['NAXIS2'] = image_data.shape[1], image_data.shape[0]
+  image = Image.fromarray(auto_scale_data(image_data, header))
+  image = orient_image(image, header, flip_v=True).convert('RGB')
+  image.save(large_jpg_path, 'jpeg', quality=95)
+  image.thumbnail((200, 200), Image.LANCZOS)
+  image.save(thumbnail_jpg_path, 'jpeg', quality=95)
 
 
-def create_composite_jpgs(input_dicts: dict, large_jpg_path: str, thumbnail_jpg_path: str):
+def _composite_orientation(input_dicts: list):
   """
-    Converts FITS images to color JPEG images.
+    The orientation shared by every channel of a composite, from the first channel with a usable WCS, as
+    multi_fits_to_img resolves it. None flips them all vertically.
   """
-  max_height, max_width = max(get_input_dimensions(input_dict) for input_dict in input_dicts)
-
-  multi_fits_to_img(input_dicts, large_jpg_path, width=max_width, height=max_height, file_type='jpeg')
-  multi_fits_to_img(input_dicts, thumbnail_jpg_path, width=200, height=200, file_type='jpeg')
-
+  transforms = [input_dict.get('transform') for input_dict in input_dicts if input_dict.get('transform') is not None]
+  if len(set(transforms)) > 1:
+    log.warning(f'Composite channels disagree on their orientation, using {transforms[0]} from the first')
+  return transforms[0] if transforms else None
 
-def create_composite_tif(input_dicts: dict, tif_path: str):
+def render_composite(input_dicts: list) -> Image.Image:
   """
-    Converts FITS images to color TIFF images.
+    Renders the full resolution RGB image multi_fits_to_img would (with its default sum blending) from the same input
+    dicts. Each channel is read and scaled once, on a thread per channel, and summed into one float RGB buffer.
   """
-  max_height, max_width = max(get_input_dimensions(input_dict) for input_dict in input_dicts)
-
-  multi_fits_to_img(input_dicts, tif_path, width=max_width, height=max_height, file_type='tiff')
+  with ThreadPoolExecutor(max_workers=len(input_dicts)) as executor:
+    scaled_images = list(executor.map(quick_scale_image, input_dicts))
+
+  transform = _composite_orientation(input_dicts)
+  scaled_images = [orient_array(scaled_image, transform) for scaled_image in scaled_images]
+
+  # Channels of different sizes are cropped to the center of the smallest
+  height, width = common_shape(scaled_images)
+  composite = np.zeros((height, width, 3), dtype=np.result_type(np.uint8, *scaled_images))
+  for input_dict, scaled_image in zip(input_dicts, scaled_images):
+    top, left = (scaled_image.shape[0] - height) // 2, (scaled_image.shape[1] - width) // 2
+    scaled_image = scaled_image[top:top + height, left:left + width]
+    for band, weight in enumerate(input_dict['color']):
+      if weight > 0:
+        composite[:, :, band] += scaled_image * weight
+  composite.clip(0, 255, composite)
+  composite.round(out=composite)
+  return Image.fromarray(np.take(DEFAULT_GAMMA_LUT, composite.astype(np.uint8)))
+
+def _save_image(image: Image.Image, path: str, file_type: str, size: tuple = None):
+  # Saving keeps encoder state on the image, so each save gets its own copy to run alongside the others
+  image = image.copy()
+  if size:
+    image.thumbnail(size, Image.LANCZOS)
+  image.save(path, file_type, quality=95)
+
+def create_composite_images(input_dicts: list, tif_path: str, large_jpg_path: str, thumbnail_jpg_path: str):
+  """
+    Converts FITS images to a color TIFF, a full size color JPEG and a 200x200 color JPEG thumbnail.
+    The composite is rendered once and the three are encoded from it at the same time.
+  """
+  image = render_composite(input_dicts)
+  with ThreadPoolExecutor(max_workers=3) as executor:
+    saves = [
+      executor.submit(_save_image, image, tif_path, 'tiff'),
+      executor.submit(_save_image, image, large_jpg_path, 'jpeg'),
+      executor.submit(_save_image, image, thumbnail_jpg_path, 'jpeg', (200, 200)),
+    ]
+    for save in saves:
+      save.result()
 
 
 def create_tif(fits_paths: np.ndarray, tif_path, color=False, zmin=None, zmax=None) -> str:
@@ -1,57 +1,446 @@
+import contextvars
+import json
 import os
+import socket
 import time
 import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
 from django.core.cache import cache
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connections
 
-from datalab.datalab_session.utils.s3_utils import download_fits
+from datalab.datalab_session.utils.file_utils import METADATA_SUFFIX, get_hdu, write_fits_metadata
+from datalab.datalab_session.utils.filecache_eviction import get_eviction_strategy
+from datalab.datalab_session.utils.filecache_manifest import MANIFEST_PREFIX, FileCacheManifest
+from datalab.datalab_session.utils.s3_utils import (DOWNLOAD_PART_SUFFIX, download_fits, download_fits_metadata, fits_basename,
+                                                    get_archive_urls)
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+# Slim copies holding only a file's headers and catalog are cached under the file's key with this suffix
+METADATA_ONLY_SUFFIX = '_metadata'
+# A cached file's decompressed SCI pixels are kept next to it as <file_path>.npy
+SIDECAR_SUFFIX = '.npy'
+# Files are downloaded to <file_path>.<owner id>.partial and renamed into place once complete
+PARTIAL_SUFFIX = '.partial'
+# ... which the downloader streams to <partial path>.part first, so it can resume an interrupted attempt
+DOWNLOADING_SUFFIXES = (PARTIAL_SUFFIX, f'{PARTIAL_SUFFIX}{DOWNLOAD_PART_SUFFIX}')
+# The FileLease entered in the current context, used by get_fits and prefetch when no lease is passed
+_active_lease = contextvars.ContextVar('filecache_lease', default=None)
+
+# The eviction index is a sorted set of file_keys scored by their priority under the FILECACHE_EVICTION_STRATEGY, lowest
+# evicted first, and every change to it runs as one server-side script so cache hits, inserts and evictions are atomic
+# without taking the global filecache lock. Each script is prefixed with the strategy's priority function and SCRIPT_HELPERS.
+# Accesses that are part of a scan, i.e. the inputs of a bulk operation, neither count as hits of an entry nor raise its
+# priority, and new entries they add start at the clock, so one large operation can't flush the frames in everyday use.
+
+# An entry being downloaded has size -1, and is leased to its downloader: the hash's owner field holds the downloader's
+# id and lease_expiry when the lease runs out unless the downloader renews it. Whoever finds an expired lease, e.g. of a
+# worker that was killed mid-download, takes the download over.
+
+# Entries pinned by a FileLease have the lease's id in the sorted set <file_key>:pins, scored by when the pin expires.
+# Eviction skips an entry while it has unexpired pins.
+
+SCRIPT_HELPERS = """
+local function read_clock(clock_key)
+  return tonumber(redis.call('GET', clock_key) or '0')
+end
+
+local function touch(file_key, index, now, clock, scan, size)
+  if not scan then
+    local hits = redis.call('HINCRBY', file_key, 'hits', 1)
+    redis.call('ZADD', index, priority(now, clock, hits, size), file_key)
+  end
+end
+"""
+
+# KEYS: file hash, eviction index, clock | ARGV: access time, file_path to claim the entry with, '1' if a scan access else '',
+# lease id (or ''), pin expiry, pin ttl, download owner id, download lease expiry
+# Returns the entry's [file_path, size] and touches it if downloaded, or [file_path, -1, lease expiry] while another worker
+# is downloading it. Otherwise claims the entry for the owner to download, taking over an expired download lease, and
+# returns nil. Pins the entry for the lease either way
+LOOKUP_OR_CLAIM_SCRIPT = """
+if ARGV[4] ~= '' then
+  redis.call('ZADD', KEYS[1] .. ':pins', ARGV[5], ARGV[4])
+  redis.call('EXPIRE', KEYS[1] .. ':pins', ARGV[6])
+end
+local details = redis.call('HMGET', KEYS[1], 'file_path', 'size', 'lease_expiry')
+if details[1] and details[2] then
+  if tonumber(details[2]) >= 0 then
+    touch(KEYS[1], KEYS[2], tonumber(ARGV[1]), read_clock(KEYS[3]), ARGV[3] ~= '', tonumber(details[2]))
+    return {details[1], details[2]}
+  end
+  if tonumber(details[3] or '0') > tonumber(ARGV[1]) then
+    return details
+  end
+end
+redis.call('HSET', KEYS[1], 'file_path', ARGV[2], 'size', -1, 'owner', ARGV[7], 'lease_expiry', ARGV[8])
+redis.call('ZADD', KEYS[2], read_clock(KEYS[3]), KEYS[1])
+return false
+"""
+
+# KEYS: file hash | ARGV: download owner id, download lease expiry
+# Extends the owner's download lease, returning 0 if the download was taken over
+RENEW_DOWNLOAD_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'size', 'owner')
+if details[1] ~= '-1' or details[2] ~= ARGV[1] then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'lease_expiry', ARGV[2])
+return 1
+"""
+
+# KEYS: file hash, eviction index, clock | ARGV: access time, '1' if a scan access else ''
+# Returns the entry's file_path and touches it if downloaded, otherwise nil
+TOUCH_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'file_path', 'size')
+if not details[1] or tonumber(details[2] or '-1') < 0 then
+  return false
+end
+touch(KEYS[1], KEYS[2], tonumber(ARGV[1]), read_clock(KEYS[3]), ARGV[2] ~= '', tonumber(details[2]))
+return details[1]
+"""
+
+# KEYS: file hash, total size | ARGV: size the entry is expected to have, file_path to claim the entry with, download owner id,
+# download lease expiry
+# Claims an entry whose file went missing from disk for the owner to download, returning 0 if another worker changed it first.
+# The entry's sidecar is no longer accounted for either, since it is stale once the file is downloaded again
+RECLAIM_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'size', 'sidecar_size')
+if details[1] ~= ARGV[1] then
+  return 0
+end
+redis.call('DECRBY', KEYS[2], tonumber(ARGV[1]) + tonumber(details[2] or '0'))
+redis.call('HDEL', KEYS[1], 'sidecar_size')
+redis.call('HSET', KEYS[1], 'file_path', ARGV[2], 'size', -1, 'owner', ARGV[3], 'lease_expiry', ARGV[4])
+return 1
+"""
+
+# Shared tail of the scripts that grow the cache - expects KEYS[2] to be the eviction index, KEYS[3] the total size,
+# KEYS[4] the clock, and the locals total, limit, now and clock. Evicts the lowest priority entries, along with their
+# sidecars, until the cache fits the limit, advancing the clock to the priority of each. Entries still downloading aren't
+# counted in the total yet, and pinned entries are in use, so both are skipped, as is the entry the script is growing
+EVICT_LOWEST_PRIORITY = """
+local evicted = {}
+local offset = 0
+while total >= limit do
+  local candidate = redis.call('ZRANGE', KEYS[2], offset, offset, 'WITHSCORES')
+  if not candidate[1] then
+    break
+  end
+  local details = redis.call('HMGET', candidate[1], 'file_path', 'size', 'sidecar_size')
+  redis.call('ZREMRANGEBYSCORE', candidate[1] .. ':pins', '-inf', now)
+  if not details[1] then
+    redis.call('ZREM', KEYS[2], candidate[1])
+  elseif candidate[1] == KEYS[1] or tonumber(details[2]) < 0 or redis.call('ZCARD', candidate[1] .. ':pins') > 0 then
+    offset = offset + 1
+  else
+    redis.call('ZREM', KEYS[2], candidate[1])
+    redis.call('HDEL', candidate[1], 'file_path', 'size', 'sidecar_size', 'hits')
+    total = redis.call('DECRBY', KEYS[3], tonumber(details[2]) + tonumber(details[3] or '0'))
+    table.insert(evicted, details[1])
+    if tonumber(candidate[2]) > clock then
+      clock = tonumber(candidate[2])
+      redis.call('SET', KEYS[4], candidate[2])
+    end
+  end
+end
+"""
+
+# KEYS: file hash, eviction index, total size, clock | ARGV: file_path, size, access time, cache size limit,
+# '1' if a scan access else '', download owner id (or '' for a file that wasn't downloaded)
+# Stores the entry, accounts for its size and evicts until the cache fits the limit. A sidecar of the entry's previous
+# file is dropped from the accounting, since it no longer matches the file. Returns nil if the owner's download was taken
+# over, otherwise {total size, evicted file_paths, 1 if the entry had a sidecar else 0}
+ADD_AND_EVICT_SCRIPT = """
+local previous = redis.call('HMGET', KEYS[1], 'size', 'sidecar_size', 'owner')
+if ARGV[6] ~= '' and (previous[1] ~= '-1' or previous[3] ~= ARGV[6]) then
+  return false
+end
+redis.call('HDEL', KEYS[1], 'sidecar_size', 'owner', 'lease_expiry')
+redis.call('HSET', KEYS[1], 'file_path', ARGV[1], 'size', ARGV[2])
+local now = tonumber(ARGV[3])
+local clock = read_clock(KEYS[4])
+if ARGV[5] ~= '' then
+  redis.call('ZADD', KEYS[2], clock, KEYS[1])
+else
+  touch(KEYS[1], KEYS[2], now, clock, false, tonumber(ARGV[2]))
+end
+local previous_size = math.max(tonumber(previous[1] or '-1'), 0) + tonumber(previous[2] or '0')
+local total = redis.call('INCRBY', KEYS[3], tonumber(ARGV[2]) - previous_size)
+local limit = tonumber(ARGV[4])
+""" + EVICT_LOWEST_PRIORITY + """
+return {total, evicted, previous[2] and 1 or 0}
+"""
+
+# KEYS: file hash, eviction index, total size, clock | ARGV: file_path, sidecar size, cache size limit, current time
+# Accounts for a sidecar written next to the entry's file and evicts until the cache fits the limit. Returns nil if the
+# entry no longer holds that file, otherwise {total size, evicted file_paths}
+ATTACH_SIDECAR_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'file_path', 'size', 'sidecar_size')
+if details[1] ~= ARGV[1] or tonumber(details[2] or '-1') < 0 then
+  return false
+end
+if details[3] then
+  return {tonumber(redis.call('GET', KEYS[3]) or '0'), {}}
+end
+redis.call('HSET', KEYS[1], 'sidecar_size', ARGV[2])
+local total = redis.call('INCRBY', KEYS[3], ARGV[2])
+local limit = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local clock = read_clock(KEYS[4])
+""" + EVICT_LOWEST_PRIORITY + """
+return {total, evicted}
+"""
+
+# KEYS: file hash, eviction index | ARGV: download owner id
+# Drops an entry whose download failed, if the owner is still downloading it
+ABANDON_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'size', 'owner')
+if details[1] == '-1' and details[2] == ARGV[1] then
+  redis.call('HDEL', KEYS[1], 'file_path', 'size', 'owner', 'lease_expiry')
+  redis.call('ZREM', KEYS[2], KEYS[1])
+end
+return 0
+"""
+
+# KEYS: file hash, eviction index, total size | ARGV: file_path, size, sidecar size (0 for none), priority if not indexed yet
+# Sets an entry to what reconcile_cache found on the temp volume, adjusting the total size by the difference (the total
+# only counts indexed entries). Entries being downloaded are left alone
+RECONCILE_ENTRY_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'file_path', 'size', 'sidecar_size')
+if details[2] == '-1' then
+  return 0
+end
+local previous_size = 0
+if details[1] and details[2] and redis.call('ZSCORE', KEYS[2], KEYS[1]) then
+  previous_size = tonumber(details[2]) + tonumber(details[3] or '0')
+end
+redis.call('HSET', KEYS[1], 'file_path', ARGV[1], 'size', ARGV[2])
+if tonumber(ARGV[3]) > 0 then
+  redis.call('HSET', KEYS[1], 'sidecar_size', ARGV[3])
+else
+  redis.call('HDEL', KEYS[1], 'sidecar_size')
+end
+redis.call('ZADD', KEYS[2], 'NX', ARGV[4], KEYS[1])
+redis.call('INCRBY', KEYS[3], tonumber(ARGV[2]) + tonumber(ARGV[3]) - previous_size)
+return 1
+"""
+
+# KEYS: file hash, eviction index, total size
+# Drops an entry whose file is no longer on the temp volume, unless it is being downloaded
+FORGET_ENTRY_SCRIPT = """
+local details = redis.call('HMGET', KEYS[1], 'size', 'sidecar_size')
+if details[1] == '-1' then
+  return 0
+end
+redis.call('ZREM', KEYS[2], KEYS[1])
+if details[1] then
+  redis.call('DECRBY', KEYS[3], tonumber(details[1]) + tonumber(details[2] or '0'))
+end
+redis.call('HDEL', KEYS[1], 'file_path', 'size', 'sidecar_size', 'hits')
+return 1
+"""
+
+
+class Heartbeat():
+    ''' Calls beat every interval seconds on a daemon thread, from start() until stop(). A failed beat is logged, and
+        the next one tries again
+    '''
+    def __init__(self, beat, interval: float, name: str):
+        self.beat = beat
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                log.warning(f"{self._thread.name}: heartbeat failed: {repr(e)}")
+
+
+class FileLease():
+    ''' Pins the cache entries of the files an operation uses, so eviction leaves them on disk until the lease is released.
+        Pins are reference counted, one per lease, and a held lease refreshes its pins in the background. If the worker
+        holding it dies, its pins expire after FileCache.PIN_TTL seconds.
+        Get one from FileCache.lease(): while it is entered, get_fits and prefetch pin each file they look up with it.
+    '''
+    def __init__(self, client, ttl: int):
+        self.client = client
+        self.ttl = ttl
+        self.lease_id = uuid.uuid4().hex
+        self.file_keys = set()
+        self._lock = threading.Lock()
+        self._heartbeat = Heartbeat(self._refresh_pins, ttl / 4, f"filecache_lease_{self.lease_id}")
+        self._context_token = None
+
+    def __enter__(self):
+        self._context_token = _active_lease.set(self)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _active_lease.reset(self._context_token)
+        self._heartbeat.stop()
+        with self._lock:
+            pipeline = self.client.pipeline()
+            for file_key in self.file_keys:
+                pipeline.zrem(f"{file_key}:pins", self.lease_id)
+            pipeline.execute()
+            self.file_keys.clear()
+
+    def expiry(self):
+        return time.time() + self.ttl
+
+    def track(self, file_key):
+        # Records a file_key pinned by the lookup scripts, so its pin is refreshed and released with the lease
+        with self._lock:
+            self.file_keys.add(file_key)
+
+    def pin(self, file_key):
+        self.client.zadd(f"{file_key}:pins", {self.lease_id: self.expiry()})
+        self.client.expire(f"{file_key}:pins", self.ttl)
+        self.track(file_key)
+
+    def _refresh_pins(self):
+        with self._lock:
+            pipeline = self.client.pipeline()
+            for file_key in self.file_keys:
+                pipeline.zadd(f"{file_key}:pins", {self.lease_id: self.expiry()})
+                pipeline.expire(f"{file_key}:pins", self.ttl)
+            pipeline.execute()
+
 
 class FileCache():
-    ''' Class for managing file access. It uses django_redis to support a LRU cache of files in redis.
+    ''' Class for managing file access. It uses django_redis to keep a size-bounded cache of files in redis, evicting them
+        in the order of the FILECACHE_EVICTION_STRATEGY (see filecache_eviction).
         It is meant to be a drop-in non-contextmanager replacement for the get_fits method we previously
         used, as well as having an add_file_to_cache method which adds a created dataproduct that is on
         the filesystem to the file cache.
     '''
     LOCK_TIMEOUT = 5  # lock timeout in seconds
+    PIN_TTL = 120  # seconds a pin outlives its last refresh
+    GET_FITS_TIMEOUT = 30  # seconds get_fits waits on another worker's download
+    DOWNLOAD_LEASE_TTL = 30  # seconds a download lease outlives its last renewal
+    RECONCILE_BATCH_SIZE = 500  # entries reconcile_cache diffs against redis per pipeline
     def __init__(self):
         self.lock_name = f"{settings.CONTAINER_TYPE}_filecache_lock"
-        self.list_name = f"{settings.CONTAINER_TYPE}_filecache_list"
+        self.index_name = f"{settings.CONTAINER_TYPE}_filecache_index"
+        self.legacy_list_name = f"{settings.CONTAINER_TYPE}_filecache_list"
         self.total_size_name = f"{settings.CONTAINER_TYPE}_filecache_size"
+        self.clock_name = f"{settings.CONTAINER_TYPE}_filecache_clock"
+        self.strategy = get_eviction_strategy(settings.FILECACHE_EVICTION_STRATEGY)
         self.client = cache.client.get_client()
+        script_prefix = self.strategy.PRIORITY + SCRIPT_HELPERS
+        self._lookup_or_claim = self.client.register_script(script_prefix + LOOKUP_OR_CLAIM_SCRIPT)
+        self._touch = self.client.register_script(script_prefix + TOUCH_SCRIPT)
+        self._reclaim = self.client.register_script(RECLAIM_SCRIPT)
+        self._renew_download = self.client.register_script(RENEW_DOWNLOAD_SCRIPT)
+        self._add_and_evict = self.client.register_script(script_prefix + ADD_AND_EVICT_SCRIPT)
+        self._abandon = self.client.register_script(ABANDON_SCRIPT)
+        self._attach_sidecar = self.client.register_script(script_prefix + ATTACH_SIDECAR_SCRIPT)
+        self._reconcile_entry = self.client.register_script(RECONCILE_ENTRY_SCRIPT)
+        self._forget_entry = self.client.register_script(FORGET_ENTRY_SCRIPT)
+        self.manifest = FileCacheManifest(settings.TEMP_FITS_DIR)
+
+    @staticmethod
+    def _sidecar_path(file_path):
+        return f"{file_path}{SIDECAR_SUFFIX}"
+
+    def _delete_files(self, file_path):
+        # Removes a cached file from disk along with its sidecar and metadata, if it has them
+        Path(file_path).unlink(missing_ok=True)
+        Path(self._sidecar_path(file_path)).unlink(missing_ok=True)
+        Path(f"{file_path}{METADATA_SUFFIX}").unlink(missing_ok=True)
+
+    def _write_metadata(self, file_key, file_path):
+        # Extracts the file's header and catalog next to it, returning the size to account for along with the file
+        try:
+            return write_fits_metadata(file_path)
+        except Exception as e:
+            # Metadata reads fall back to opening the file itself
+            log.warning(f"_write_metadata for {file_key}: could not extract metadata: {repr(e)}")
+            Path(f"{file_path}{METADATA_SUFFIX}").unlink(missing_ok=True)
+            return 0
+
+    def _delete_evicted(self, caller, evicted_paths):
+        for evicted_path in evicted_paths:
+            log.info(f"{caller}: evicted file {evicted_path.decode('utf-8')}")
+            self.manifest.record_remove(os.path.basename(evicted_path.decode('utf-8')).split('.')[0])
+            self._delete_files(evicted_path.decode('utf-8'))
+
+    def lease(self):
+        ''' Returns a FileLease, to be used as a context manager for as long as the files it pins are in use:
+                with FileCache().lease():
+                    fits_path = FileCache().get_fits(basename, source, user)
+            Operations run inside one, see BaseDataOperation.allocate_operate
+        '''
+        return FileLease(self.client, self.PIN_TTL)
+
+    @staticmethod
+    def _file_key(basename, source, metadata_only=False):
+        return f"{source}_{basename}{METADATA_ONLY_SUFFIX if metadata_only else ''}"
 
-    def _increment_file_usage(self, file_key):
-        # Assumes you already have an the cache lock
-        # Moves file_key to the front of the LRU list of files
-        log.debug(f"_increment_file_usage moving {file_key} to most recently accessed")
-        self.client.lrem(self.list_name, 0, file_key)
-        self.client.lpush(self.list_name, file_key)
-
-    def _remove_least_recently_used(self):
-        # Assumes you already have an the cache lock
-        # Removes least recently used file from the cache and deletes it from the local file system
-        file_key = self.client.rpop(self.list_name)
-        if file_key:
-            # Get the file_details and remove those as well
-            file_details = self.client.hgetall(file_key)
-            log.info(f"_remove_least_recently_used removing {file_key} with size {int(file_details.get(b'size', 0))}")
-            self.client.hdel(file_key, 'file_path', 'size')
-            # Delete the file from the filesystem
-            Path(file_details.get(b'file_path').decode('utf-8')).unlink(missing_ok=True)
-            # Removes the file size from the size counter
-            return int(self.client.decrby(self.total_size_name, int(file_details.get(b'size', 0))))
-        return int(self.client.get(self.total_size_name))
-
-    def add_file_to_cache(self, file_path):
+    def _download_channel(self, file_key):
+        # Pub/sub channel the downloader of file_key publishes to once the download finishes or fails
+        return f"{settings.CONTAINER_TYPE}_filecache_download_{file_key}"
+
+    def _notify_download_finished(self, file_key):
+        # Wakes every worker blocked in get_fits waiting on this file, whether the download succeeded or not
+        self.client.publish(self._download_channel(file_key), 'done')
+
+    def _record_access(self, file_key, file_path, scan):
+        # Appends the access to the FILECACHE_TRACE_PATH trace, for replaying with the simulate_file_cache command
+        try:
+            record = {'time': time.time(), 'file_key': file_key, 'size': os.path.getsize(file_path), 'scan': scan}
+            with open(settings.FILECACHE_TRACE_PATH, 'a') as trace_file:
+                trace_file.write(f"{json.dumps(record)}\n")
+        except OSError as e:
+            log.warning(f"_record_access for {file_key}: could not record trace: {repr(e)}")
+
+    def _store_file(self, file_key, file_path, file_size, scan=False, owner='', fits_file=True):
+        # Records the file's final size and priority, then deletes whatever the eviction pushed out. Returns None if the
+        # owner's download was taken over.
+        # A fits file's metadata is extracted first and counted in its size, so header and catalog reads never reopen it
+        if fits_file:
+            file_size += self._write_metadata(file_key, file_path)
+        stored = self._add_and_evict(
+            keys=[file_key, self.index_name, self.total_size_name, self.clock_name],
+            args=[file_path, file_size, time.time(), settings.FILECACHE_TOTAL_SIZE, '1' if scan else '', owner]
+        )
+        if stored is None:
+            return None
+        total_size, evicted_paths, had_sidecar = stored
+        self.manifest.record_add(file_key, file_path, file_size, time.time())
+        if had_sidecar:
+            # The sidecar was decompressed from the file this one replaces
+            Path(self._sidecar_path(file_path)).unlink(missing_ok=True)
+        self._delete_evicted(f"_store_file for {file_key}", evicted_paths)
+        log.debug(f"_store_file for {file_key}: Cache total size is now {total_size}")
+        return total_size
+
+    def add_file_to_cache(self, file_path, fits_file=True):
         ''' This is called to add an already existing file that is in the temp dir into the file cache.
             This will mainly be used for adding operation output fits files into the file cache so they can
-            persist along with other files.
+            persist along with other files. Other files an operation wants to reuse, like reprojected frames, are added
+            with fits_file=False and looked up again with get_cached_file.
         '''
         # Verify that the file exists on the local filesystem
         if not os.path.isfile(file_path):
@@ -59,177 +448,429 @@ class FileCache():
 
         file_key = os.path.basename(file_path).split('.')[0]
         file_size = os.path.getsize(file_path)
-        # Add it to the cache here
-        with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
-            current_size = int(self.client.get(self.total_size_name))
-            # First make sure we have enough room for this file, and if not delete things from the cache until there is enough room
-            while current_size + file_size >= settings.FILECACHE_TOTAL_SIZE:
-                log.debug(f"add_file_to_cache for {file_path}: Cache total size {current_size + file_size} exceeds the limit {settings.FILECACHE_TOTAL_SIZE} - removing LRU file")
-                current_size = self._remove_least_recently_used()
-            # Now there is enough room so add the file to the cache
-            file_details = {
-                'file_path': file_path,
-                'size': file_size
-            }
-            self.client.hset(file_key, mapping=file_details)
-            self.client.incrby(self.total_size_name, file_size)
-            self._increment_file_usage(file_key)
+        self._store_file(file_key, file_path, file_size, fits_file=fits_file)
         return True
 
-    def _download_file_to_cache(self, basename: str, source: str = 'archive', user: User = User.objects.none):
-        # First place the fits details into the cache, then download the file, then update the cache with the final file size
-        file_key = f"{source}_{basename}"
+    def get_cached_file(self, file_key: str, lease: FileLease = None):
+        ''' Returns the path of a file added with add_file_to_cache under file_key (its name up to the first '.'), or None
+            if it isn't cached. Like get_fits, the file is touched and pinned by the given or entered lease.
+        '''
+        return self._cached_file(file_key, lease or _active_lease.get())
+
+    def _renew_download_lease(self, file_key, owner):
+        # Returns False if the download was taken over by another worker
+        return bool(self._renew_download(keys=[file_key], args=[owner, time.time() + self.DOWNLOAD_LEASE_TTL]))
+
+    def _download_file_to_cache(self, basename: str, source: str = 'archive', user: User = User.objects.none, metadata_only: bool = False,
+                                scan: bool = False, owner: str = ''):
+        # The fits details are already claimed in the cache under owner's download lease, so download the file while
+        # renewing the lease, then update the cache with the final file size.
+        # Returns None if the lease expired and another worker took the download over
+        file_key = self._file_key(basename, source, metadata_only)
         file_name = f"{file_key}.fits.fz"
         file_path = os.path.join(settings.TEMP_FITS_DIR, file_name)
+        partial_path = f"{file_path}.{owner}{PARTIAL_SUFFIX}"
         log.debug(f"_download_file_to_cache for {file_key}")
+
+        def renew_lease():
+            if not self._renew_download_lease(file_key, owner):
+                log.warning(f"_download_file_to_cache for {file_key}: download lease of {owner} was taken over")
+
+        heartbeat = Heartbeat(renew_lease, self.DOWNLOAD_LEASE_TTL / 3, f"filecache_download_{owner}")
+        heartbeat.start()
         try:
-            log.info(f"_download_file_to_cache for {file_key}: initial cache set, downloading file to {file_path}")
-            download_fits(file_path, basename, source, user)
+            log.info(f"_download_file_to_cache for {file_key}: initial cache set, downloading file to {partial_path}")
+            if metadata_only:
+                download_fits_metadata(partial_path, basename, source, user)
+            else:
+                stats = download_fits(partial_path, basename, source, user)
+                if stats:
+                    log.info(f"_download_file_to_cache for {file_key}: downloaded {stats.transferred} bytes in "
+                             f"{stats.seconds:.1f}s, {stats.bytes_per_second / 1048576:.1f} MiB/s")
+            heartbeat.stop()
+            if not self._renew_download_lease(file_key, owner):
+                log.warning(f"_download_file_to_cache for {file_key}: download was taken over, discarding it")
+                return None
             # Now download is finished, so get the file size and update the cache with it
+            os.replace(partial_path, file_path)
             file_size = os.path.getsize(file_path)
             log.info(f"_download_file_to_cache for {file_key}: download complete with file size {file_size}")
-            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
-                self.client.hset(file_key, key='size', value=file_size)
-                total_size = int(self.client.incrby(self.total_size_name, file_size))
-                log.debug(f"_download_file_to_cache for {file_key}: Cache total size is now {total_size}")
-                # If this file increased total size above the cache maximum, delete files from cache until it is below the maximum
-                while total_size >= settings.FILECACHE_TOTAL_SIZE:
-                    log.info(f"_download_file_to_cache for {file_key}: Cache total size {total_size} exceeds the limit {settings.FILECACHE_TOTAL_SIZE} - removing LRU file")
-                    total_size = self._remove_least_recently_used()
+            if self._store_file(file_key, file_path, file_size, scan, owner) is None:
+                log.warning(f"_download_file_to_cache for {file_key}: download was taken over before it was stored")
+                return None
+            self._notify_download_finished(file_key)
 
             return file_path
         except Exception as e:
             log.error(f"Failed to download file {basename} from {source}: {repr(e)}")
-            # Failed to download file, so clean up cache here
-            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
-                # Don't have to do anything with total size since that was never incremented for the file yet
-                self.client.hdel(file_key, 'file_path', 'size')
-                self.client.lrem(self.list_name, 0, file_key)
+            # Failed to download file, so clean up cache here. Total size was never incremented for the file yet
+            self._abandon(keys=[file_key, self.index_name], args=[owner])
+            # Waiters wake up, find no entry and retry the download themselves
+            self._notify_download_finished(file_key)
             # Raise an exception here since we failed to download the file
             raise
+        finally:
+            heartbeat.stop()
+            Path(partial_path).unlink(missing_ok=True)
+            Path(f"{partial_path}{DOWNLOAD_PART_SUFFIX}").unlink(missing_ok=True)
 
-    def get_fits(self, basename: str, source: str = 'archive', user: User = User.objects.none):
+    def get_fits(self, basename: str, source: str = 'archive', user: User = User.objects.none, metadata_only: bool = False,
+                 lease: FileLease = None, scan: bool = False):
         ''' This attempts to get the file out of the cache and increment its usage. If the file isn't in the cache,
             or if its in the cache but not on the filesystem, then the file will be redownloaded from S3 and placed
             in the cache. Returns the local temp dir file_path to the downloaded file.
+            If another worker is already downloading the file, this blocks on that download's completion channel
+            rather than polling the cache, so waiting costs no lock traffic.
+            With metadata_only, callers that only read the SCI header and CAT table get the full file if it is already
+            cached, and otherwise a slim copy with just those, fetched with range requests and cached under its own key.
+            The file is pinned by the given lease, or else by the lease entered in this context if any, until it is released.
+            scan marks the access as one of many inputs of a bulk operation, which doesn't make the file likelier to stay cached.
         '''
-        GET_FITS_TIMEOUT = 30
-        start_time = time.time()
-
-        basename = basename.replace('-large', '').replace('-small', '')
-        file_path = self._get_fits_helper(basename, source, user)
-        while file_path is None:
-            if time.time() - start_time > GET_FITS_TIMEOUT:
-                log.error(f"Timeout reached while waiting for {basename} to download.")
-                raise TimeoutError(f"Failed to retrieve {basename} within {GET_FITS_TIMEOUT} seconds.")
-            
-            time.sleep(0.1)
-            file_path = self._get_fits_helper(basename, source, user)
+        deadline = time.time() + self.GET_FITS_TIMEOUT
+        lease = lease or _active_lease.get()
+
+        basename = fits_basename(basename)
+        file_path = None
+        if metadata_only:
+            file_path = self._cached_file(self._file_key(basename, source), lease, scan)
+        if file_path is None:
+            file_path = self._get_fits_helper(basename, source, user, metadata_only, lease, scan)
+        if file_path is None:
+            file_path = self._wait_for_fits(basename, source, user, metadata_only, lease, scan, deadline)
+        if settings.FILECACHE_TRACE_PATH:
+            self._record_access(os.path.basename(file_path).split('.')[0], file_path, scan)
+        return file_path
+
+    def _wait_for_fits(self, basename, source, user, metadata_only, lease, scan, deadline):
+        # Waits out another worker's download of the file, downloading it ourselves if that one fails or its lease expires.
+        # Subscribe before checking again so a download finishing in between can't be missed
+        file_key = self._file_key(basename, source, metadata_only)
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self._download_channel(file_key))
+            file_path = self._get_fits_helper(basename, source, user, metadata_only, lease, scan)
+            while file_path is None:
+                if time.time() >= deadline:
+                    log.error(f"Timeout reached while waiting for {basename} to download.")
+                    raise TimeoutError(f"Failed to retrieve {basename} within {self.GET_FITS_TIMEOUT} seconds.")
+                # Wakes up when the download finishes, or when its lease runs out so the download can be taken over
+                lease_expiry = float(self.client.hget(file_key, 'lease_expiry') or 0)
+                self._wait_for_download(pubsub, min(deadline, lease_expiry))
+                file_path = self._get_fits_helper(basename, source, user, metadata_only, lease, scan)
+        finally:
+            pubsub.close()
 
         return file_path
 
-    def _get_fits_helper(self, basename: str, source: str = 'archive', user: User = User.objects.none):
-        file_key = f"{source}_{basename}"
+    def prefetch(self, basenames: list, source='archive', user: User = User.objects.none, max_workers: int = None, metadata_only: bool = False,
+                 lease: FileLease = None):
+        ''' Starts downloading all the basenames into the cache at once, with at most max_workers downloads in flight.
+            source is either one source for every basename, or a list with the source of each basename.
+            metadata_only and lease are passed on to get_fits, with the lease entered in this context used if none is given.
+            Prefetches of more than FILECACHE_SCAN_THRESHOLD files under a lease are bulk operation inputs, so they are
+            fetched as a scan. Without a lease they aren't, since new scan entries are the first evicted.
+            Returns an iterator of futures in the order of basenames, each resolving to the local file_path of its file
+            (or raising its download's error), so callers can work on the first frames while the rest are still downloading.
+        '''
+        sources = list(source) if isinstance(source, (list, tuple)) else [source] * len(basenames)
+        # Resolved here, since the download threads don't share this context
+        lease = lease or _active_lease.get()
+        scan = lease is not None and len(basenames) > settings.FILECACHE_SCAN_THRESHOLD
+        self._resolve_archive_urls(basenames, sources, user, metadata_only)
+        executor = ThreadPoolExecutor(max_workers=max_workers or settings.FILECACHE_PREFETCH_WORKERS, thread_name_prefix='filecache_prefetch')
+        futures = [executor.submit(self._prefetch_file, basename, file_source, user, metadata_only, lease, scan) for basename, file_source in zip(basenames, sources)]
+
+        def ordered_futures():
+            try:
+                yield from futures
+            finally:
+                # Downloads already running still finish into the cache, but queued ones are dropped if the caller stops early
+                executor.shutdown(wait=False, cancel_futures=True)
+        return ordered_futures()
+
+    def _resolve_archive_urls(self, basenames, sources, user, metadata_only):
+        # Looks up the archive urls of the files that aren't cached yet in one batch, so each download finds its url
+        # already cached rather than querying the archive on its own. Names are those of the fits files get_fits downloads
+        archive_basenames = list(dict.fromkeys(fits_basename(basename) for basename, source in zip(basenames, sources) if source == 'archive'))
+        if not archive_basenames:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for basename in archive_basenames:
+            pipeline.exists(self._file_key(basename, 'archive', metadata_only))
+        uncached = [basename for basename, cached in zip(archive_basenames, pipeline.execute()) if not cached]
+        if not uncached:
+            return
+        try:
+            get_archive_urls(uncached, user=user)
+        except Exception as e:
+            # Each download looks its url up again, and fails with its own error
+            log.warning(f"prefetch: could not resolve every archive url: {repr(e)}")
+
+    def _prefetch_file(self, basename: str, source: str, user: User, metadata_only: bool, lease: FileLease, scan: bool):
+        try:
+            return self.get_fits(basename, source, user, metadata_only, lease, scan)
+        finally:
+            # Archive lookups query the user's auth profile, which opens a db connection for this worker thread
+            connections.close_all()
+
+    def _wait_for_download(self, pubsub, wake_at):
+        # Blocks until the download channel is published to, returning False if wake_at passes first
+        while (remaining := wake_at - time.time()) > 0:
+            if pubsub.get_message(timeout=remaining) is not None:
+                return True
+        return False
+
+    def _cached_file(self, file_key, lease: FileLease = None, scan: bool = False):
+        # The path of a file already downloaded into the cache, touching it in the eviction index, or None if it isn't
+        if lease:
+            # Pinned before checking the entry, so it can't be evicted once found
+            lease.pin(file_key)
+        cached_path = self._touch(keys=[file_key, self.index_name, self.clock_name], args=[time.time(), '1' if scan else ''])
+        if cached_path is None or not os.path.isfile(cached_path.decode('utf-8')):
+            return None
+        return cached_path.decode('utf-8')
+
+    def _get_fits_helper(self, basename: str, source: str = 'archive', user: User = User.objects.none, metadata_only: bool = False,
+                         lease: FileLease = None, scan: bool = False):
+        file_key = self._file_key(basename, source, metadata_only)
+        file_path = os.path.join(settings.TEMP_FITS_DIR, f"{file_key}.fits.fz")
         log.debug(f"_get_fits_helper for {file_key}")
-        # First see if the file is in the file cache and increment its name on the LRU list
-        with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
-            file_details = self.client.hgetall(file_key)
-            if file_details and file_details.get(b'file_path') and file_details.get(b'size'):
-                if int(file_details.get(b'size')) == -1:
-                    log.debug(f"_get_fits_helper for {file_key}: File is currently downloading")
-                    # This means the file is currently loading / hasn't finished downloading yet, so we should sleep and try again later
-                    return None
-                elif os.path.isfile(file_details.get(b'file_path').decode('utf-8')):
-                    log.debug(f"_get_fits_helper for {file_key}: File is retrieved and returned")
-                    self._increment_file_usage(file_key)
-                    return file_details.get(b'file_path').decode('utf-8')
-                else:
-                    log.warning(f"_get_fits_helper for {file_key}: File details exist but os.path.isfile fails")
-            # Otherwise we have a problem where the file doesn't exist locally even though its in the cache - or its not in the cache at all
-            # Here we will place it in the cache and then initiate downloading it to the filesystem
-            log.debug(f"_get_fits_helper for {file_key}: File doesn't currently exist and will be downloaded")
-            file_name = f"{file_key}.fits.fz"
-            file_path = os.path.join(settings.TEMP_FITS_DIR, file_name)
-            file_details = {
-                'file_path': file_path,
-                'size': -1  # Negative size implies download is in progress
-            }
-            self.client.hset(file_key, mapping=file_details)
-            self._increment_file_usage(file_key)
-        return self._download_file_to_cache(basename, source, user)
+        # Either touches the file's entry in the eviction index, or claims the entry for us to download
+        pin_args = [lease.lease_id, lease.expiry(), lease.ttl] if lease else ['', 0, 0]
+        owner = f"{socket.gethostname()}_{uuid.uuid4().hex}"
+        download_lease_expiry = time.time() + self.DOWNLOAD_LEASE_TTL
+        file_details = self._lookup_or_claim(
+            keys=[file_key, self.index_name, self.clock_name],
+            args=[time.time(), file_path, '1' if scan else '', *pin_args, owner, download_lease_expiry]
+        )
+        if lease:
+            lease.track(file_key)
+        if file_details:
+            cached_path, cached_size = file_details[0].decode('utf-8'), int(file_details[1])
+            if cached_size == -1:
+                log.debug(f"_get_fits_helper for {file_key}: File is currently downloading")
+                # This means another worker is downloading the file under an unexpired lease, so we should wait and try again later
+                return None
+            elif os.path.isfile(cached_path):
+                log.debug(f"_get_fits_helper for {file_key}: File is retrieved and returned")
+                return cached_path
+            # We have a problem where the file doesn't exist locally even though its in the cache, so claim it to download again
+            log.warning(f"_get_fits_helper for {file_key}: File details exist but os.path.isfile fails")
+            if not self._reclaim(keys=[file_key, self.total_size_name], args=[cached_size, file_path, owner, download_lease_expiry]):
+                # Another worker got to it first
+                return None
+            self.manifest.record_remove(file_key)
+            self._delete_files(cached_path)
+        # The entry is claimed with a negative size, which implies download is in progress
+        log.debug(f"_get_fits_helper for {file_key}: File doesn't currently exist and will be downloaded")
+        return self._download_file_to_cache(basename, source, user, metadata_only, scan, owner)
+
+    def get_sci_data(self, file_path: str):
+        ''' Returns the SCI pixels of a file in the cache, as returned by get_fits or add_file_to_cache. They are
+            decompressed once into a float32 sidecar next to the file, which counts toward the cache size and is
+            evicted with the file, and later calls memory-map the sidecar read-only instead of decompressing again.
+            Falls back to decompressing the file every time if FILECACHE_SCI_SIDECARS is off.
+        '''
+        if not settings.FILECACHE_SCI_SIDECARS:
+            return get_hdu(file_path, 'SCI').data
+
+        sidecar_path = self._sidecar_path(file_path)
+        try:
+            return np.load(sidecar_path, mmap_mode='r')
+        except FileNotFoundError:
+            pass
+
+        sci_data = np.asarray(get_hdu(file_path, 'SCI').data, dtype=np.float32)
+        # Written under a temporary name and renamed into place, so readers never map a partially written sidecar
+        partial_path = f"{sidecar_path}.{uuid.uuid4().hex}{SIDECAR_SUFFIX}"
+        try:
+            with open(partial_path, 'wb') as partial_file:
+                np.save(partial_file, sci_data)
+            os.replace(partial_path, sidecar_path)
+        finally:
+            Path(partial_path).unlink(missing_ok=True)
+        # Mapped before the sidecar is accounted for, so an eviction right after still leaves this caller its pixels
+        sidecar_data = np.load(sidecar_path, mmap_mode='r')
+
+        file_key = os.path.basename(file_path).split('.')[0]
+        attached = self._attach_sidecar(
+            keys=[file_key, self.index_name, self.total_size_name, self.clock_name],
+            args=[file_path, os.path.getsize(sidecar_path), settings.FILECACHE_TOTAL_SIZE, time.time()]
+        )
+        if attached is None:
+            # The file was evicted or replaced while decompressing it, so the sidecar can't be accounted for
+            log.info(f"get_sci_data for {file_key}: file left the cache, discarding its sidecar")
+            Path(sidecar_path).unlink(missing_ok=True)
+        else:
+            total_size, evicted_paths = attached
+            self.manifest.record_sidecar(file_key, os.path.getsize(sidecar_path))
+            self._delete_evicted(f"get_sci_data for {file_key}", evicted_paths)
+            log.debug(f"get_sci_data for {file_key}: Cache total size is now {total_size}")
+        return sidecar_data
 
     def clear_cache(self):
         ''' Clears out the file cache - assumes you already have a lock open from the calling process
         '''
-        filecache_len = self.client.llen(self.list_name)
-        filecache_list = self.client.lrange(self.list_name, 0, filecache_len)
-        self.client.delete(self.list_name)
+        filecache_list = self.client.zrange(self.index_name, 0, -1)
+        self.client.delete(self.index_name, self.clock_name)
         self.client.set(self.total_size_name, 0)
         for file_key in filecache_list:
-            self.client.hdel(file_key, 'file_path', 'size')
+            self.client.hdel(file_key, 'file_path', 'size', 'sidecar_size', 'hits', 'owner', 'lease_expiry')
+
+    def _migrate_legacy_list(self):
+        ''' Moves the LRU list used before the sorted set index into the index, keeping its order.
+            Assumes you already have a lock open from the calling process
+        '''
+        legacy_list = self.client.lrange(self.legacy_list_name, 0, -1)
+        if legacy_list:
+            log.warning(f"reconcile_cache: migrating {len(legacy_list)} files from the legacy LRU list to the index")
+            # The head of the list is the most recently used file
+            now = time.time()
+            priorities = {}
+            for position, file_key in enumerate(legacy_list):
+                file_size = max(int(self.client.hget(file_key, 'size') or 0), 0)
+                priorities[file_key] = self.strategy.priority(now - position, 0, 1, file_size)
+            self.client.zadd(self.index_name, priorities, nx=True)
+        self.client.delete(self.legacy_list_name)
+
+    def _reconciled_size(self, file_path, metadata):
+        # Size of a file found on the temp drive, counting the metadata extracted next to it
+        file_size = os.path.getsize(file_path)
+        if os.path.basename(f"{file_path}{METADATA_SUFFIX}") in metadata:
+            file_size += os.path.getsize(f"{file_path}{METADATA_SUFFIX}")
+        return file_size
 
-    def reconcile_cache(self):
-        ''' This looks through all the files currently on the system and rebuilds the cache using those files.
-            This is mainly meant to be called on pod creation, especially when running locally, to make sure that what is in
-            the redis cache matches what is in the temporary volume, because either could get blown away on pod redeploys.
+    def _entries_on_disk(self):
+        ''' Lists and sizes every file on the temp drive, as the manifest's entries. Sidecars and metadata of files that
+            are gone, and partial downloads whose lease has long expired, are deleted along the way
+        '''
+        try:
+            files = [f for f in os.listdir(settings.TEMP_FITS_DIR) if os.path.isfile(os.path.join(settings.TEMP_FITS_DIR, f))]
+        except FileNotFoundError:
+            files = []
+        files = [f for f in files if not f.startswith(MANIFEST_PREFIX)]
+        # Sidecars and metadata are accounted for under their file's entry rather than as entries of their own
+        sidecars = {f for f in files if f.endswith(SIDECAR_SUFFIX)}
+        metadata = {f for f in files if f.endswith(METADATA_SUFFIX)}
+        partials = [f for f in files if f.endswith(DOWNLOADING_SUFFIXES)]
+        files = [f for f in files if not f.endswith((SIDECAR_SUFFIX, METADATA_SUFFIX, *DOWNLOADING_SUFFIXES))]
+        for partial_name in partials:
+            # Drop downloads left behind by workers that died, whose leases have long expired
+            partial_path = os.path.join(settings.TEMP_FITS_DIR, partial_name)
+            if os.path.getmtime(partial_path) < time.time() - self.DOWNLOAD_LEASE_TTL:
+                Path(partial_path).unlink(missing_ok=True)
+        for orphan_name in (sidecars | metadata) - {f"{f}{SIDECAR_SUFFIX}" for f in files} - {f"{f}{METADATA_SUFFIX}" for f in files}:
+            Path(os.path.join(settings.TEMP_FITS_DIR, orphan_name)).unlink(missing_ok=True)
+
+        entries = {}
+        for file_name in files:
+            file_path = os.path.join(settings.TEMP_FITS_DIR, file_name)
+            sidecar_name = os.path.basename(self._sidecar_path(file_path))
+            entries[file_name.split('.')[0]] = {
+                'file_path': file_path,
+                'size': self._reconciled_size(file_path, metadata),
+                'sidecar_size': os.path.getsize(self._sidecar_path(file_path)) if sidecar_name in sidecars else 0,
+                # Without any usage history, the file's modification time is the best guess at its last use
+                'time': os.path.getmtime(file_path),
+            }
+        return entries
+
+    def _apply_entries(self, entries):
+        # Sets the entries that redis has differently or not in the index, RECONCILE_BATCH_SIZE at a time. Each batch is read without the lock
+        # and only the entries that differ are written under it
+        file_keys = list(entries)
+        for start in range(0, len(file_keys), self.RECONCILE_BATCH_SIZE):
+            batch = file_keys[start:start + self.RECONCILE_BATCH_SIZE]
+            pipeline = self.client.pipeline(transaction=False)
+            for file_key in batch:
+                pipeline.hmget(file_key, 'file_path', 'size', 'sidecar_size')
+                pipeline.zscore(self.index_name, file_key)
+            results = pipeline.execute()
+            stale = []
+            for file_key, details, score in zip(batch, results[::2], results[1::2]):
+                entry = entries[file_key]
+                expected = [entry['file_path'].encode(), str(entry['size']).encode(), str(entry['sidecar_size']).encode() if entry['sidecar_size'] else None]
+                if details != expected or score is None:
+                    stale.append(file_key)
+            if not stale:
+                continue
+            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
+                pipeline = self.client.pipeline(transaction=False)
+                for file_key in stale:
+                    entry = entries[file_key]
+                    self._reconcile_entry(
+                        keys=[file_key, self.index_name, self.total_size_name],
+                        args=[entry['file_path'], entry['size'], entry['sidecar_size'], self.strategy.priority(entry['time'], 0, 1, entry['size'])],
+                        client=pipeline
+                    )
+                pipeline.execute()
+            log.info(f"reconcile_cache: updated {len(stale)} of {len(batch)} entries in redis")
+
+    def _forget_unknown_entries(self, entries):
+        # Drops the index's entries the manifest doesn't know, RECONCILE_BATCH_SIZE at a time. One whose file is on disk
+        # after all was stored since the manifest was read, so it is recorded instead
+        def forget(batch):
+            pipeline = self.client.pipeline(transaction=False)
+            for file_key in batch:
+                pipeline.hmget(file_key, 'file_path', 'size')
+            missing = []
+            for file_key, (file_path, size) in zip(batch, pipeline.execute()):
+                if size == b'-1':
+                    continue
+                if file_path and os.path.isfile(file_path.decode('utf-8')):
+                    self.manifest.record_add(file_key.decode('utf-8'), file_path.decode('utf-8'), int(size), time.time())
+                else:
+                    missing.append(file_key)
+            if not missing:
+                return
+            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
+                pipeline = self.client.pipeline(transaction=False)
+                for file_key in missing:
+                    self._forget_entry(keys=[file_key, self.index_name, self.total_size_name], client=pipeline)
+                pipeline.execute()
+            log.info(f"reconcile_cache: removed {len(missing)} entries whose files are no longer on the temp drive")
+
+        batch = []
+        for file_key, _ in self.client.zscan_iter(self.index_name, count=self.RECONCILE_BATCH_SIZE):
+            if file_key.decode('utf-8') not in entries:
+                batch.append(file_key)
+            if len(batch) == self.RECONCILE_BATCH_SIZE:
+                forget(batch)
+                batch = []
+        if batch:
+            forget(batch)
+
+    def reconcile_cache(self, full: bool = False):
+        ''' This rebuilds the cache in redis from the files on the temp volume. It is mainly meant to be called on pod creation,
+            to make sure that what is in the redis cache matches what is in the temporary volume, because either could get
+            blown away on pod redeploys.
+            The volume's contents come from the manifest the cache appends to as it stores and evicts files, or, with full
+            or when there's no manifest to trust yet, from listing the volume, which also rewrites the manifest.
+            They are diffed against redis in batched pipelines, and the lock is only held while a batch's differences are
+            written, so get_fits carries on while it runs.
         '''
         log.debug("reconcile_cache: begin reconciling cache files")
-        with cache.lock(self.lock_name, timeout=60):
-            # Get the files on the filesystem in the temp dir
-            try:
-                files = [f.decode('utf-8') for f in os.listdir(settings.TEMP_FITS_DIR) if os.path.isfile(os.path.join(settings.TEMP_FITS_DIR, f))]
-            except FileNotFoundError:
-                files = []
-            if not files:
-                # Special case where there are no temp files, i.e. temp volume was blown away, so clear the cache here
-                log.warning("reconcile_cache: No files found on the temp drive - clearing cache")
+        with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
+            self._migrate_legacy_list()
+        if full or not self.manifest.exists():
+            log.warning("reconcile_cache: listing the files on the temp drive")
+            rotated_logs = self.manifest.begin_rewrite()
+            entries = self._entries_on_disk()
+            self.manifest.finish_rewrite(entries, rotated_logs)
+        else:
+            entries = self.manifest.compact()
+
+        if not entries:
+            # Special case where there are no temp files, i.e. temp volume was blown away, so clear the cache here
+            log.warning("reconcile_cache: No files found on the temp drive - clearing cache")
+            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
                 self.clear_cache()
-            elif self.client.exists(self.total_size_name) == 0:
-                # Special case where redis was reset and has no data in it but temp volume has files, so reset cache with those files
-                log.warning("reconcile_cache: redis cache empty - resetting with current files in temp drive")
-                for file_name in files:
-                    file_key = os.path.basename(file_name).split('.')[0]
-                    file_path = os.path.join(settings.TEMP_FITS_DIR, file_name)
-                    file_size = os.path.getsize(file_path)
-                    file_details = {
-                        'file_path': file_path,
-                        'size': file_size
-                    }
-                    self.client.hset(file_key, mapping=file_details)
-                    self._increment_file_usage(file_key)
-                    self.client.incrby(self.total_size_name, file_size)
-            else:
-                # Case where both redis and filesystem have stuff in them, so just reconcile the two to make sure they aggree here
-                # It would be safer to blow away the cache and regenerate it, but we would lost the ordering of the LRU part
-                log.warning("reconcile_cache: reconciling files from temp drive with what is in redis cache")
-                filecache_len = self.client.llen(self.list_name)
-                filecache_list = [f.decode('utf-8') for f in self.client.lrange(self.list_name, 0, filecache_len)]
-                for file_key in filecache_list:
-                    file_details = self.client.hgetall(file_key)
-                    file_path = file_details.get(b'file_path').decode('utf-8')
-                    file_path_base = os.path.basename(file_path)
-                    if file_path_base not in files:
-                        # File is in cache but no longer in the temp drive
-                        self.client.lrem(self.list_name, 0, file_key)
-                        self.client.decrby(self.total_size_name, int(file_details.get(b'size', 0)))
-                        self.client.hdel(file_key, 'file_path', 'size')
-                current_total_size = int(self.client.get(self.total_size_name))
-                for file_name in files:
-                    file_key = os.path.basename(file_name).split('.')[0]
-                    file_path = os.path.join(settings.TEMP_FITS_DIR, file_name)
-                    if file_key not in filecache_list:
-                        # File is on the filesystem in the temp drive but not in the file cache - so add it here at the end
-                        file_size = os.path.getsize(file_path)
-                        if current_total_size + file_size < settings.FILECACHE_TOTAL_SIZE:
-                            file_details = {
-                                'file_path': file_path,
-                                'size': file_size
-                            }
-                            self.client.hset(file_key, mapping=file_details)
-                            current_total_size = int(self.client.incrby(self.total_size_name, file_size))
-                            # Put it on the end of the LRU - first to be ejected since it wasn't already there
-                            self.client.rpush(self.list_name, file_key)
-                        else:
-                            # We are over size - since we would put these on the end of the LRU anyway, just remove the files completely to clean them up
-                            Path(file_path).unlink(missing_ok=True)
+            return
+        if self.client.exists(self.total_size_name) == 0:
+            # Special case where redis was reset, so start from nothing and add every file
+            log.warning("reconcile_cache: redis cache empty - resetting with current files in temp drive")
+            with cache.lock(self.lock_name, timeout=self.LOCK_TIMEOUT):
+                self.clear_cache()
+        self._apply_entries(entries)
+        self._forget_unknown_entries(entries)
         log.debug("reconcile_cache: done reconciling cache files")
@@ -0,0 +1,134 @@
+import json
+import logging
+from dataclasses import dataclass
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# GDSF counts an entry's hits per MiB it takes up
+GDSF_SIZE_UNIT = 1048576
+
+
+class EvictionStrategy():
+    ''' Decides the order the FileCache evicts entries in. Every entry is scored in the index with its priority, and the
+        lowest priority entry is evicted first. Evicting an entry advances the cache's clock to its priority, so entries
+        admitted later start out ahead of it.
+        A strategy gives its priority both as a Lua function, run by the FileCache's server-side scripts, and in python,
+        run by simulate() - the two must agree.
+    '''
+    name = None
+    # Lua source of: local function priority(now, clock, hits, size)
+    PRIORITY = None
+
+    @staticmethod
+    def priority(now: float, clock: float, hits: int, size: int) -> float:
+        raise NotImplementedError
+
+
+class LRUStrategy(EvictionStrategy):
+    ''' Least recently used: the priority is the time of last access '''
+    name = 'lru'
+    PRIORITY = """
+local function priority(now, clock, hits, size)
+  return now
+end
+"""
+
+    @staticmethod
+    def priority(now, clock, hits, size):
+        return now
+
+
+class GDSFStrategy(EvictionStrategy):
+    ''' Greedy-Dual-Size-Frequency: the priority is the clock plus the entry's hits per MiB, so small frames that are
+        used often outlive large ones used once. The clock ages out entries that were popular long ago.
+    '''
+    name = 'gdsf'
+    PRIORITY = f"""
+local function priority(now, clock, hits, size)
+  return clock + hits * {GDSF_SIZE_UNIT} / math.max(size, 1)
+end
+"""
+
+    @staticmethod
+    def priority(now, clock, hits, size):
+        return clock + hits * GDSF_SIZE_UNIT / max(size, 1)
+
+
+EVICTION_STRATEGIES = {strategy.name: strategy for strategy in (LRUStrategy, GDSFStrategy)}
+
+
+def get_eviction_strategy(name: str) -> EvictionStrategy:
+    try:
+        return EVICTION_STRATEGIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown file cache eviction strategy {name}, expected one of {', '.join(EVICTION_STRATEGIES)}")
+
+
+@dataclass(frozen=True)
+class TraceRecord:
+    ''' One get_fits access, as recorded by the FileCache to FILECACHE_TRACE_PATH. scan marks the inputs of bulk operations '''
+    time: float
+    file_key: str
+    size: int
+    scan: bool = False
+
+
+def read_trace(trace_path: str) -> list[TraceRecord]:
+    ''' Reads the json lines of a recorded trace, in the order they were accessed '''
+    with open(trace_path) as trace_file:
+        records = [TraceRecord(**json.loads(line)) for line in trace_file if line.strip()]
+    return sorted(records, key=lambda record: record.time)
+
+
+@dataclass(frozen=True)
+class SimulationResult:
+    strategy: str
+    requests: int
+    hits: int
+    requested_bytes: int
+    hit_bytes: int
+    evictions: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.requests if self.requests else 0.0
+
+    @property
+    def byte_hit_rate(self) -> float:
+        return self.hit_bytes / self.requested_bytes if self.requested_bytes else 0.0
+
+
+def simulate(trace: list[TraceRecord], strategy: EvictionStrategy, cache_size: int) -> SimulationResult:
+    ''' Replays an access trace against a cache of cache_size bytes evicting with strategy, the way the FileCache's
+        scripts do, less pinning: scan accesses don't count as hits of an entry or promote it, and new scan entries start
+        at the clock.
+    '''
+    entries = {}  # file_key -> [priority, hits, size]
+    clock = 0.0
+    total = hits = requested_bytes = hit_bytes = evictions = 0
+    for record in trace:
+        requested_bytes += record.size
+        entry = entries.get(record.file_key)
+        if entry:
+            hits += 1
+            hit_bytes += entry[2]
+            if not record.scan:
+                entry[1] += 1
+                entry[0] = strategy.priority(record.time, clock, entry[1], entry[2])
+            continue
+
+        entry_hits = 0 if record.scan else 1
+        priority = clock if record.scan else strategy.priority(record.time, clock, entry_hits, record.size)
+        entries[record.file_key] = [priority, entry_hits, record.size]
+        total += record.size
+        while total >= cache_size and len(entries) > 1:
+            # Ties go to the lowest file_key, like the index's sorted set. The entry just added is never evicted
+            victim = min((file_key for file_key in entries if file_key != record.file_key),
+                         key=lambda file_key: (entries[file_key][0], file_key))
+            victim_priority, _, victim_size = entries.pop(victim)
+            clock = max(clock, victim_priority)
+            total -= victim_size
+            evictions += 1
+
+    return SimulationResult(strategy.name, len(trace), hits, requested_bytes, hit_bytes, evictions)
@@ -0,0 +1,118 @@
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Every file of the manifest starts with this, so listings of the temp dir can tell them apart from cached files
+MANIFEST_PREFIX = '.filecache_manifest'
+
+
+class FileCacheManifest():
+    ''' Append-only record of the entries the FileCache keeps on this temp volume, so reconcile_cache can rebuild redis
+        without listing and stat-ing every file.
+        Stores, sidecars and removals are appended as json lines to the log as they happen. compact() folds the log into
+        the snapshot, which holds one line per entry. The snapshot is only ever written from a complete picture of the
+        volume, so a manifest without one (e.g. on a volume cached to before the manifest existed) isn't trusted.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, f'{MANIFEST_PREFIX}.snapshot')
+        self.log_path = os.path.join(directory, f'{MANIFEST_PREFIX}.log')
+        self.compacting_path = os.path.join(directory, f'{MANIFEST_PREFIX}.compacting')
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.snapshot_path)
+
+    def _append(self, record: dict):
+        # A line this short is written by one write() in append mode, so concurrent workers never interleave records
+        line = f'{json.dumps(record)}\n'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(line)
+        except OSError as e:
+            # The cache carries on without it, and reconcile_cache records entries it finds missing from the manifest
+            log.warning(f"FileCacheManifest: could not record {record['op']} of {record['file_key']}: {repr(e)}")
+
+    def record_add(self, file_key: str, file_path: str, size: int, access_time: float):
+        self._append({'op': 'add', 'file_key': file_key, 'file_path': file_path, 'size': size, 'time': access_time})
+
+    def record_sidecar(self, file_key: str, sidecar_size: int):
+        self._append({'op': 'sidecar', 'file_key': file_key, 'sidecar_size': sidecar_size})
+
+    def record_remove(self, file_key: str):
+        self._append({'op': 'remove', 'file_key': file_key})
+
+    @staticmethod
+    def _replay(path: str, entries: dict):
+        # Applies the records in path to entries, a dict of file_key to its file_path, size, sidecar_size and time
+        try:
+            with open(path) as manifest_file:
+                lines = manifest_file.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The tail of a worker that died mid-write
+                continue
+            file_key = record['file_key']
+            if record['op'] == 'add':
+                entries[file_key] = {'file_path': record['file_path'], 'size': record['size'], 'sidecar_size': 0, 'time': record['time']}
+            elif record['op'] == 'sidecar' and file_key in entries:
+                entries[file_key]['sidecar_size'] = record['sidecar_size']
+            elif record['op'] == 'remove':
+                entries.pop(file_key, None)
+
+    def _write_snapshot(self, entries: dict):
+        # Written under a temporary name and renamed into place, so a reconcile that dies midway leaves the last snapshot
+        partial_path = f'{self.snapshot_path}.{uuid.uuid4().hex}'
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(partial_path, 'w') as snapshot_file:
+                for file_key, entry in entries.items():
+                    snapshot_file.write(f"{json.dumps({'op': 'add', 'file_key': file_key, **entry})}\n")
+                    if entry['sidecar_size']:
+                        snapshot_file.write(f"{json.dumps({'op': 'sidecar', 'file_key': file_key, 'sidecar_size': entry['sidecar_size']})}\n")
+            os.replace(partial_path, self.snapshot_path)
+        finally:
+            Path(partial_path).unlink(missing_ok=True)
+
+    def _rotate_log(self) -> list:
+        # Renames the log aside so later records start a new one, returning the logs set aside oldest first - including
+        # any left by a compaction that died midway
+        try:
+            os.replace(self.log_path, f'{self.compacting_path}.{time.time_ns()}')
+        except FileNotFoundError:
+            pass
+        return sorted(glob.glob(f'{glob.escape(self.compacting_path)}.*'))
+
+    def compact(self) -> dict:
+        ''' Folds the log into the snapshot, returning the entries it holds '''
+        rotated_paths = self._rotate_log()
+        entries = {}
+        self._replay(self.snapshot_path, entries)
+        for rotated_path in rotated_paths:
+            self._replay(rotated_path, entries)
+        self._write_snapshot(entries)
+        for rotated_path in rotated_paths:
+            Path(rotated_path).unlink(missing_ok=True)
+        return entries
+
+    def begin_rewrite(self) -> list:
+        ''' Starts replacing the manifest with the entries found on the volume. Records from here on are kept on top of
+            them, and the returned logs from before are dropped by finish_rewrite
+        '''
+        return self._rotate_log()
+
+    def finish_rewrite(self, entries: dict, rotated_paths: list):
+        self._write_snapshot(entries)
+        for rotated_path in rotated_paths:
+            Path(rotated_path).unlink(missing_ok=True)
@@ -0,0 +1,220 @@
+import gzip
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.fitsrec import FITS_rec
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
+
+# Tiles are compressed in parallel with astropy's private tile compression internals, as of the astropy minor version
+# pinned in pyproject.toml. If they have moved, outputs are compressed by CompImageHDU itself, one tile at a time
+try:
+    from astropy.io.fits.hdu.compressed._quantization import DITHER_METHODS, QuantizationFailedException, Quantize
+    from astropy.io.fits.hdu.compressed._tiled_compression import (DEFAULT_ZBLANK, _check_compressed_header,
+                                                                    _compress_tile, _get_compression_setting,
+                                                                    _header_to_settings, _update_tile_settings)
+    from astropy.io.fits.hdu.compressed.utils import _data_shape, _iter_array_tiles, _tile_shape
+    from astropy.io.fits.util import _is_pseudo_integer, _pseudo_zero
+    PARALLEL_COMPRESSION = hasattr(fits.CompImageHDU, '_update_compressed_data')
+except ImportError:
+    PARALLEL_COMPRESSION = False
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+if not PARALLEL_COMPRESSION:
+    log.warning('fits_compression: astropy tile compression internals not found, compressing fits outputs serially')
+
+
+@dataclass(frozen=True)
+class CompressionProfile:
+    ''' How a CompImageHDU output is compressed. A quantize_level of 0 stores float pixels losslessly, which only GZIP
+        supports. Tiles are strips of tile_rows full image rows, so a reader of a band of rows decompresses only the
+        tiles it overlaps.
+    '''
+    name: str
+    compression_type: str
+    quantize_level: float
+    tile_rows: int
+
+    def tile_shape(self, shape: tuple) -> tuple:
+        if len(shape) < 2:
+            return tuple(shape)
+        return (1,) * (len(shape) - 2) + (min(self.tile_rows, shape[-2]), shape[-1])
+
+
+COMPRESSION_PROFILES = {profile.name: profile for profile in (
+    # Outputs whose pixels are used for further science, kept exactly as computed
+    CompressionProfile('science', 'GZIP_2', 0, 16),
+    # Outputs that are only looked at, quantized coarsely for speed and size
+    CompressionProfile('preview', 'RICE_1', 4, 64),
+)}
+
+
+def get_compression_profile(name: str) -> CompressionProfile:
+    try:
+        return COMPRESSION_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown fits compression profile {name}, expected one of {', '.join(COMPRESSION_PROFILES)}")
+
+
+def _encode_tile(tile_data, algorithm, settings):
+    # astropy's GZIP codecs stamp every tile with the time it was compressed, so the same image never compresses to the
+    # same bytes twice. Stamped with 0 instead, identical outputs are byte-identical and the heap is otherwise unchanged
+    if algorithm not in ('GZIP_1', 'GZIP_2'):
+        return _compress_tile(tile_data, algorithm=algorithm, **settings)
+    array = tile_data.astype(tile_data.dtype.newbyteorder('>'), copy=False).ravel()
+    if algorithm == 'GZIP_2':
+        buffer = array.view(np.uint8).reshape((-1, array.dtype.itemsize)).T.ravel().tobytes()
+    else:
+        buffer = array.tobytes()
+    return gzip.compress(buffer, mtime=0)
+
+
+def _compress_tile_data(tile_data, irow, compression_type, compressed_header, settings, quantize):
+    # Compresses one tile the way astropy's compress_image_data does, returning its bytes, ZSCALE, ZZERO, whether it
+    # fell back to GZIP_1, and whether it holds blanks
+    settings = _update_tile_settings(dict(settings), compression_type, tile_data.shape)
+    if tile_data.dtype.kind != 'f' or not quantize:
+        return _encode_tile(tile_data, compression_type, settings), 0, 0, False, False
+
+    dither_method = DITHER_METHODS[compressed_header.get('ZQUANTIZ', 'NO_DITHER')]
+    dither_seed = compressed_header.get('ZDITHER0', 0)
+    q = Quantize(
+        row=(irow + dither_seed) if dither_method != -1 else 0,
+        dither_method=dither_method,
+        quantize_level=_get_compression_setting(compressed_header, 'noisebit', 0),
+        bitpix=compressed_header['ZBITPIX'],
+    )
+    original_shape = tile_data.shape
+    # NaNs are set to an existing value for quantization, then to ZBLANK
+    nan_mask = np.isnan(tile_data)
+    any_nan = np.any(nan_mask)
+    if any_nan:
+        tile_data = tile_data.copy()
+        tile_data[nan_mask] = 0 if np.all(nan_mask) else np.nanmin(tile_data)
+    try:
+        tile_data, scale, zero = q.encode_quantized(tile_data)
+    except QuantizationFailedException:
+        if any_nan:
+            tile_data[nan_mask] = np.nan
+        return _encode_tile(tile_data, 'GZIP_1', {}), 0, 0, True, False
+
+    tile_data = np.asarray(tile_data).reshape(original_shape)
+    if any_nan:
+        if not tile_data.flags.writeable:
+            tile_data = tile_data.copy()
+        tile_data[nan_mask] = DEFAULT_ZBLANK
+    return _encode_tile(tile_data, compression_type, settings), scale, zero, False, any_nan
+
+
+def compress_image_data_parallel(image_data, compression_type, compressed_header, compressed_coldefs, workers):
+    ''' astropy's compress_image_data with the tiles compressed by a pool of workers threads. The codecs release the
+        GIL while they run, so tiles compress on as many cores as there are workers. Returns the same heap, byte for byte
+        but for the GZIP timestamps.
+    '''
+    _check_compressed_header(compressed_header)
+    settings = _header_to_settings(compressed_header)
+    quantize = 'ZSCALE' in compressed_coldefs.dtype.names
+    tiles = _iter_array_tiles(_data_shape(compressed_header), _tile_shape(compressed_header))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda tile: _compress_tile_data(image_data[tile[1]], tile[0], compression_type, compressed_header, settings, quantize),
+            tiles
+        ))
+    compressed_bytes = [result[0] for result in results]
+    gzip_fallback = [result[3] for result in results]
+    if any(result[4] for result in results):
+        compressed_header['ZBLANK'] = DEFAULT_ZBLANK
+
+    table = np.zeros(len(compressed_bytes), dtype=compressed_coldefs.dtype.newbyteorder('>'))
+    if 'ZSCALE' in table.dtype.names:
+        table['ZSCALE'] = np.array([result[1] for result in results])
+        table['ZZERO'] = np.array([result[2] for result in results])
+    table['COMPRESSED_DATA'][:, 0] = [len(cbytes) for cbytes in compressed_bytes]
+    table['COMPRESSED_DATA'][:1, 1] = 0
+    table['COMPRESSED_DATA'][1:, 1] = np.cumsum(table['COMPRESSED_DATA'][:-1, 0])
+    for irow, fallback in enumerate(gzip_fallback):
+        if fallback:
+            table['GZIP_COMPRESSED_DATA'][irow] = table['COMPRESSED_DATA'][irow]
+            table['COMPRESSED_DATA'][irow] = 0
+
+    heap = b''.join(compressed_bytes)
+    return len(heap), np.frombuffer(table.tobytes() + heap, dtype=np.uint8)
+
+
+class ProfiledCompImageHDU(fits.CompImageHDU):
+    ''' A CompImageHDU compressed with a CompressionProfile, its tiles compressed in parallel by workers threads when
+        PARALLEL_COMPRESSION is available and by CompImageHDU otherwise
+    '''
+    def __init__(self, data=None, header=None, name=None, profile: CompressionProfile = COMPRESSION_PROFILES['science'],
+                 workers: int = None):
+        shape = data.shape if data is not None else ()
+        super().__init__(data=data, header=header, name=name, compression_type=profile.compression_type,
+                         tile_shape=profile.tile_shape(shape), quantize_level=profile.quantize_level)
+        self.profile = profile
+        self.workers = workers or os.cpu_count()
+
+    def _update_compressed_data(self):
+        # CompImageHDU._update_compressed_data, compressing with compress_image_data_parallel
+        if not PARALLEL_COMPRESSION:
+            return super()._update_compressed_data()
+        image_bitpix = DTYPE2BITPIX[self.data.dtype.name]
+        if image_bitpix != self._orig_bitpix or self.data.shape != self.shape:
+            self._update_header_data(self.header)
+
+        old_data = self.data
+        if _is_pseudo_integer(self.data.dtype):
+            self.data = np.array(self.data - _pseudo_zero(self.data.dtype), dtype=f'=i{self.data.dtype.itemsize}')
+        try:
+            self._header['PCOUNT'] = 0
+            if 'THEAP' in self._header:
+                del self._header['THEAP']
+            self._theap = self._header['NAXIS1'] * self._header['NAXIS2']
+            del self.compressed_data
+            heapsize, self.compressed_data = compress_image_data_parallel(
+                self.data, self.compression_type, self._header, self.columns, self.workers
+            )
+        finally:
+            self.data = old_data
+
+        table_len = len(self.compressed_data) - heapsize
+        if table_len != self._theap:
+            raise Exception(f'Unexpected compressed table size (expected {self._theap}, got {table_len})')
+        compressed_data = self.compressed_data[:self._theap].view(dtype=self.columns.dtype.newbyteorder('>'), type=np.rec.recarray)
+        self.compressed_data = compressed_data.view(FITS_rec)
+        self.compressed_data._coldefs = self.columns
+        self.compressed_data._heapoffset = self._theap
+        self.compressed_data._heapsize = heapsize
+
+
+@dataclass(frozen=True)
+class CompressionBenchmark:
+    profile: str
+    workers: int
+    raw_bytes: int
+    compressed_bytes: int
+    seconds: float
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.raw_bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+
+
+def benchmark_compression(data: np.ndarray, profile: CompressionProfile, workers: int = None) -> CompressionBenchmark:
+    ''' Times writing data as a ProfiledCompImageHDU to memory '''
+    hdu = ProfiledCompImageHDU(data=data, name='SCI', profile=profile, workers=workers)
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer)
+    seconds = time.perf_counter() - start
+    return CompressionBenchmark(profile.name, hdu.workers, data.nbytes, buffer.tell(), seconds)
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import resource
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_area
+from reproject import reproject_adaptive, reproject_exact, reproject_interp
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Reprojected frames are cached in the FileCache as <REPROJECTION_PREFIX><hash>.npz
+REPROJECTION_PREFIX = 'reprojected_'
+REPROJECTION_SUFFIX = '.npz'
+
+
+def _reproject_adaptive(input_data, output_wcs, shape_out):
+    return reproject_adaptive(input_data, output_wcs, shape_out=shape_out, return_footprint=True, conserve_flux=True)
+
+
+def _reproject_interp(input_data, output_wcs, shape_out):
+    return reproject_interp(input_data, output_wcs, shape_out=shape_out, return_footprint=True)
+
+
+def _reproject_exact(input_data, output_wcs, shape_out):
+    return reproject_exact(input_data, output_wcs, shape_out=shape_out, return_footprint=True)
+
+
+# adaptive is the most faithful, interp by far the fastest, and exact computes each pixel's exact overlap
+REPROJECTION_METHODS = {
+    'adaptive': _reproject_adaptive,
+    'interp': _reproject_interp,
+    'exact': _reproject_exact,
+}
+# Methods that conserve surface brightness, whose output is scaled by the ratio of pixel areas to conserve flux like adaptive
+SURFACE_BRIGHTNESS_METHODS = ('interp', 'exact')
+
+
+def reproject_frame(data: np.ndarray, header: str, target_header: str, shape_out: tuple, method: str):
+    ''' Reprojects the pixels of a frame with the WCS in header onto the one in target_header, returning the float32
+        reprojected array and footprint. Headers are passed as strings, so this can run in a reprojection_pool process.
+    '''
+    input_wcs = WCS(fits.Header.fromstring(header))
+    output_wcs = WCS(fits.Header.fromstring(target_header))
+    array, footprint = REPROJECTION_METHODS[method]((data, input_wcs), output_wcs, shape_out)
+    if method in SURFACE_BRIGHTNESS_METHODS:
+        array *= proj_plane_pixel_area(output_wcs.celestial) / proj_plane_pixel_area(input_wcs.celestial)
+    return array.astype(np.float32), footprint.astype(np.float32)
+
+
+def _limit_worker_memory(memory_limit: int):
+    # Caps the address space of a pool process, so one huge reprojection fails with a MemoryError rather than the worker
+    # running the operation being killed
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def reprojection_pool(workers: int, memory_limit: int = 0) -> ProcessPoolExecutor:
+    ''' A pool of workers processes for reproject_frame, each limited to memory_limit bytes of address space if given.
+        The processes are spawned rather than forked, so they don't inherit the locks and connections of the operation's threads.
+    '''
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_limit_worker_memory, initargs=(memory_limit,))
+
+
+def reprojection_cache_key(input_key: str, target_header: str, shape_out: tuple, method: str) -> str:
+    ''' The FileCache key of an input's reprojection onto a target WCS and shape with a method '''
+    target = hashlib.sha256(f'{input_key}|{target_header}|{tuple(shape_out)}|{method}'.encode('utf-8')).hexdigest()
+    return f'{REPROJECTION_PREFIX}{target[:32]}'
+
+
+def load_reprojection(file_path: str):
+    with np.load(file_path) as reprojection:
+        return reprojection['array'], reprojection['footprint']
+
+
+def write_reprojection(directory: str, cache_key: str, array: np.ndarray, footprint: np.ndarray) -> str:
+    ''' Writes a reprojection to the file its cache_key is stored under in directory, returning its path '''
+    file_path = os.path.join(directory, f'{cache_key}{REPROJECTION_SUFFIX}')
+    # Written under a temporary name and renamed into place, so readers never load a partially written reprojection
+    partial_path = f'{file_path}.{uuid.uuid4().hex}{REPROJECTION_SUFFIX}'
+    try:
+        np.savez(partial_path, array=array, footprint=footprint)
+        os.replace(partial_path, file_path)
+    finally:
+        Path(partial_path).unlink(missing_ok=True)
+    return file_path
@@ -1,23 +1,104 @@
+import hashlib
 import logging
+import re
 import requests
 from retrying import retry
 import os
-import urllib.request
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 
 import boto3
+from astropy.io import fits
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
 
 from ocs_authentication.auth_profile.models import AuthProfile
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from datalab.datalab_session.exceptions import ClientAlertException
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
-config = Config(connect_timeout=10, retries={'mode': 'standard', 'total_max_attempts': 12})
+config = Config(
+  connect_timeout=10,
+  retries={'mode': 'standard', 'total_max_attempts': 12},
+  max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+  tcp_keepalive=True,
+)
+# Large outputs go up as multipart uploads, their parts sent in parallel
+transfer_config = TransferConfig(
+  multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+  multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+  max_concurrency=settings.S3_MULTIPART_CONCURRENCY,
+)
+
+FITS_BLOCK_SIZE = 2880
+# Header blocks fetched per range request when walking a fits file's headers
+HEADER_FETCH_BLOCKS = 8
+
+# Presigned urls are valid for 30 days, and reused from the cache until 3 days before they expire
+PRESIGNED_URL_EXPIRY = 60 * 60 * 24 * 30
+PRESIGNED_URL_CACHE_TTL = PRESIGNED_URL_EXPIRY - 60 * 60 * 24 * 3
+# Seconds a key found missing from the bucket is remembered as missing, unless add_file_to_bucket stores it sooner
+MISSING_KEY_CACHE_TTL = 300
+# Seconds a key stored or found in the bucket is remembered as existing, well under the bucket's lifecycle expiry
+EXISTING_KEY_CACHE_TTL = 60 * 60
+
+# Downloads are streamed to <file_path>.part, which later attempts resume from, and renamed into place once verified
+DOWNLOAD_PART_SUFFIX = '.part'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for a connection, and for each chunk of a download
+DOWNLOAD_TIMEOUT = (10, 60)
+# An S3 ETag is the object's md5 unless it was uploaded in parts
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+def get_s3_client():
+  """
+  Returns the process-wide S3 client, creating it on first use. Clients are thread-safe and keep their connection pool
+  between calls, so every S3 helper shares this one rather than paying for a new client and new connections each call.
+  A forked worker process creates its own, since connections can't be shared across processes.
+  """
+  global _s3_client, _s3_client_pid
+  if _s3_client is None or _s3_client_pid != os.getpid():
+    with _s3_client_lock:
+      if _s3_client is None or _s3_client_pid != os.getpid():
+        # Sessions aren't thread-safe, so the client gets one of its own rather than using boto3's default session
+        _s3_client = boto3.session.Session().client('s3', config=config)
+        _s3_client_pid = os.getpid()
+  return _s3_client
+
+
+def get_http_session() -> requests.Session:
+  """
+  Returns the process-wide requests session used to download fits files, so downloads reuse pooled, kept-alive
+  connections instead of opening a new one per file. Created per process like get_s3_client.
+  """
+  global _http_session, _http_session_pid
+  if _http_session is None or _http_session_pid != os.getpid():
+    with _http_session_lock:
+      if _http_session is None or _http_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=settings.S3_MAX_POOL_CONNECTIONS, pool_maxsize=settings.S3_MAX_POOL_CONNECTIONS)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+        _http_session_pid = os.getpid()
+  return _http_session
 
 
 def add_file_to_bucket(item_key: str, path: object) -> str:
@@ -31,30 +112,52 @@ def add_file_to_bucket(item_key: str, path: object) -> str:
   Returns:
     A presigned url for the object just added to the bucket
   """
-  s3 = boto3.client('s3', config=config)
+  s3 = get_s3_client()
   try:
     response = s3.upload_file(
       path,
       settings.DATALAB_OPERATION_BUCKET,
-      item_key
+      item_key,
+      Config=transfer_config
     )
   except ClientError as e:
     log.error(f'Error uploading the operation output: {e}')
     raise ClientAlertException(f'Error uploading the operation output')
 
-  return get_s3_url(item_key)
+  cache.delete(_missing_key_cache_key(settings.DATALAB_OPERATION_BUCKET, item_key))
+  cache.set(_existing_key_cache_key(settings.DATALAB_OPERATION_BUCKET, item_key), True, timeout=EXISTING_KEY_CACHE_TTL)
+  # Signed afresh rather than reusing a cached url, since the object was just replaced
+  return get_s3_url(item_key, use_cache=False)
+
+
+def _s3_url_cache_key(bucket: str, key: str) -> str:
+  return f's3_url_{bucket}_{key}'
+
+
+def _missing_key_cache_key(bucket: str, key: str) -> str:
+  return f's3_missing_{bucket}_{key}'
+
+
+def _existing_key_cache_key(bucket: str, key: str) -> str:
+  return f's3_existing_{bucket}_{key}'
+
 
-def get_s3_url(key: str, bucket: str = settings.DATALAB_OPERATION_BUCKET) -> str:
+def get_s3_url(key: str, bucket: str = settings.DATALAB_OPERATION_BUCKET, use_cache: bool = True) -> str:
   """
   Gets a presigned url from the bucket using the key
 
   Args:
     item_key -- name to look up in the bucket
+    use_cache -- reuse a url signed earlier, if it has PRESIGNED_URL_EXPIRY - PRESIGNED_URL_CACHE_TTL left at least
 
   Returns:
     A presigned url for the object or None
   """
-  s3 = boto3.client('s3', config=config)
+  url_cache_key = _s3_url_cache_key(bucket, key)
+  if use_cache and (url := cache.get(url_cache_key)):
+    return url
+
+  s3 = get_s3_client()
 
   try:
     url = s3.generate_presigned_url(
@@ -63,33 +166,46 @@ def get_s3_url(key: str, bucket: str = settings.DATALAB_OPERATION_BUCKET) -> str
             'Bucket': bucket,
             'Key': key
         },
-        ExpiresIn = 60 * 60 * 24 * 30 # URL will be valid for 30 days
+        ExpiresIn = PRESIGNED_URL_EXPIRY
     )
   except ClientError as e:
     log.error(f'Could not generate url for {key}: {e}')
     raise ClientAlertException(f'Could not create url for {key}')
 
+  cache.set(url_cache_key, url, timeout=PRESIGNED_URL_CACHE_TTL)
   return url
 
 
 def key_exists(key: str) -> bool:
   """
-  Checks if a given string exists as part of an object key in an S3 bucket.
+  Checks if an object with the given key exists in the operation bucket.
 
   Args:
-    bucket_name (str): The name of the S3 bucket.
-    prefix (str): The string to look for in the object keys.
+    key (str): The key of the object to look for.
 
   Returns:
-    bool: True if at least one object key contains the given prefix, False otherwise.
+    bool: True if the object exists, False otherwise.
+
+  Keys stored by add_file_to_bucket or found by a HEAD request are remembered as existing for EXISTING_KEY_CACHE_TTL,
+  and keys found missing for MISSING_KEY_CACHE_TTL, so repeated checks skip the HEAD request. A cached presigned url
+  is no proof, since urls are signed without checking the object.
   """
-  s3 = boto3.client('s3', config=config)
+  bucket = settings.DATALAB_OPERATION_BUCKET
+  cached = cache.get_many([_existing_key_cache_key(bucket, key), _missing_key_cache_key(bucket, key)])
+  if _existing_key_cache_key(bucket, key) in cached:
+    return True
+  if _missing_key_cache_key(bucket, key) in cached:
+    return False
+
+  s3 = get_s3_client()
   try:
-    s3.head_object(Bucket=settings.DATALAB_OPERATION_BUCKET, Key=key)
+    s3.head_object(Bucket=bucket, Key=key)
+    cache.set(_existing_key_cache_key(bucket, key), True, timeout=EXISTING_KEY_CACHE_TTL)
     return True
   except ClientError as e:
     if e.response['Error']['Code'] == "404":
       log.warning(f"key {key} not found in s3 bucket")
+      cache.set(_missing_key_cache_key(bucket, key), True, timeout=MISSING_KEY_CACHE_TTL)
     elif e.response['Error']['Code'] == 403:
       log.warning(f"invalid permissions for key {key} in s3 bucket")
     else:
@@ -97,30 +213,37 @@ def key_exists(key: str) -> bool:
     return False
 
 
-def get_archive_url(basename: str, archive: str = settings.ARCHIVE_API, user: User = User.objects.none) -> dict:
+def _archive_headers(user: User) -> dict:
   """
-  Looks for the key as a prefix in the operations s3 bucket
-
-  Args:
-    basename -- name to query
-    archive -- archive api base url
-    user -- user whose credentials should be used for archive query
-  Returns:
-    dict of archive fits urls
+  Headers authenticating archive queries with the user's OCS api token, if they have one
   """
-  query_params = {'basename_exact': basename }
-
+  if not isinstance(user, User):
+    # No user, e.g. the User.objects.none default
+    return {}
   try:
     # Attempt to get the users auth profile and OCS api token to use with the archive query
     auth_profile = AuthProfile.objects.get(user=user)
-    auth_token = auth_profile.api_token
-    headers = {
-      'Authorization': f'Token {auth_token}'
-    }
-    response = requests.get(archive + '/frames/', params=query_params, headers=headers)
+    return {'Authorization': f'Token {auth_profile.api_token}'}
   except AuthProfile.DoesNotExist:
     # Attempt the query without auth headers - if the data is public it should still work
-    response = requests.get(archive + '/frames/', params=query_params)
+    return {}
+
+
+def fits_basename(basename: str) -> str:
+  """
+  The basename of the fits file a name refers to, i.e. without the -large or -small of its jpgs
+  """
+  return basename.replace('-large', '').replace('-small', '')
+
+
+def _archive_url_cache_key(archive: str, user: User, basename: str) -> str:
+  # Per user, since a user's token may see frames others can't
+  return f'archive_url_{archive}_{getattr(user, "pk", None)}_{basename}'
+
+
+def _query_archive_url(basename: str, archive: str, headers: dict) -> str:
+  query_params = {'basename_exact': basename }
+  response = get_http_session().get(archive + '/frames/', params=query_params, headers=headers, timeout=30)
 
   try:
     response.raise_for_status()
@@ -133,44 +256,274 @@ def get_archive_url(basename: str, archive: str = settings.ARCHIVE_API, user: Us
   if not results:
     raise ClientAlertException(f"Could not find {basename} in the archive")
 
-  fits_url = results[0].get('url', 'No URL found')
-  return fits_url
-
-@retry(stop_max_attempt_number=12, wait_fixed=5000)
-def download_fits(file_path: str, basename: str, source: str = 'archive', user: User = User.objects.none):
-  if not os.path.isfile(file_path):
-    # create the tmp directory if it doesn't exist
-    if not os.path.exists(settings.TEMP_FITS_DIR):
-      os.makedirs(settings.TEMP_FITS_DIR, exist_ok=True)
-
-    match source:
-      case 'archive':
-        fits_url = get_archive_url(basename, user=user)
-      case 'datalab':
-        s3_folder_path = f'{basename.split("-")[0]}/{basename}.fits'
-        fits_url = get_s3_url(s3_folder_path)
-      case _:
-        raise ClientAlertException(f"Source {source} not recognized")
-
-    urllib.request.urlretrieve(fits_url, file_path)
+  return results[0].get('url', 'No URL found')
+
+
+def get_archive_urls(basenames: list, archive: str = settings.ARCHIVE_API, user: User = User.objects.none) -> dict:
+  """
+  Resolves many basenames to their archive fits urls at once
+
+  Args:
+    basenames -- names to query
+    archive -- archive api base url
+    user -- user whose credentials should be used for archive query
+  Returns:
+    dict of the fits_basename of each basename to its archive fits url
+
+  Names of jpgs are resolved to the fits file they were made from, as get_fits downloads it, so a -large name and
+  the fits file share one lookup. Urls are cached per user for ARCHIVE_URL_CACHE_TTL. The rest are looked up concurrently over the pooled session,
+  ARCHIVE_LOOKUP_WORKERS at a time, with the user's auth profile read once for the whole batch. If any lookup fails
+  its error is raised, after the urls that were found are cached.
+  """
+  basenames = list(dict.fromkeys(fits_basename(basename) for basename in basenames))
+  cache_keys = {basename: _archive_url_cache_key(archive, user, basename) for basename in basenames}
+  cached_urls = cache.get_many(list(cache_keys.values()))
+  urls = {basename: cached_urls[cache_key] for basename, cache_key in cache_keys.items() if cache_key in cached_urls}
+  missing = [basename for basename in basenames if basename not in urls]
+  if not missing:
+    return urls
+
+  headers = _archive_headers(user)
+  found = {}
+  error = None
+  with ThreadPoolExecutor(max_workers=min(settings.ARCHIVE_LOOKUP_WORKERS, len(missing))) as executor:
+    futures = {executor.submit(_query_archive_url, basename, archive, headers): basename for basename in missing}
+    for future in as_completed(futures):
+      try:
+        found[futures[future]] = future.result()
+      except Exception as e:
+        error = error or e
+  cache.set_many({cache_keys[basename]: url for basename, url in found.items()}, timeout=settings.ARCHIVE_URL_CACHE_TTL)
+  if error:
+    raise error
+  return {**urls, **found}
+
+
+def get_archive_url(basename: str, archive: str = settings.ARCHIVE_API, user: User = User.objects.none) -> str:
+  """
+  Looks up the archive fits url of a basename, see get_archive_urls
+  """
+  return get_archive_urls([basename], archive, user)[fits_basename(basename)]
+
+def get_fits_url(basename: str, source: str = 'archive', user: User = User.objects.none) -> str:
+  """
+  Returns a url the fits file can be downloaded from
+  """
+  match source:
+    case 'archive':
+      return get_archive_url(basename, user=user)
+    case 'datalab':
+      s3_folder_path = f'{basename.split("-")[0]}/{basename}.fits'
+      return get_s3_url(s3_folder_path)
+    case _:
+      raise ClientAlertException(f"Source {source} not recognized")
+
+class DownloadVerificationError(Exception):
+  """ A download didn't match the size or checksum the server gave for it """
+
+
+@dataclass(frozen=True)
+class DownloadStats:
+  """ Bytes transferred by a download, not counting those resumed from an earlier attempt, and the seconds it took """
+  size: int
+  transferred: int
+  seconds: float
+
+  @property
+  def bytes_per_second(self) -> float:
+    return self.transferred / self.seconds if self.seconds else 0.0
+
+
+def _expected_size(response: requests.Response, offset: int) -> int | None:
+  content_range = response.headers.get('Content-Range', '')
+  if '/' in content_range and not content_range.endswith('/*'):
+    return int(content_range.rsplit('/', 1)[1])
+  if 'Content-Length' in response.headers:
+    return offset + int(response.headers['Content-Length'])
+  return None
+
+
+def stream_download(url: str, file_path: str) -> DownloadStats:
+  """
+  Streams url to <file_path>.part and renames it to file_path once its size, and md5 where the server's ETag gives it,
+  match what the server sent. An existing .part is resumed from with a range request rather than downloaded again.
+  A failure leaves the .part behind for the next attempt to resume, except a failed verification, which starts over.
+  """
+  part_path = f'{file_path}{DOWNLOAD_PART_SUFFIX}'
+  offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+  headers = {'Range': f'bytes={offset}-'} if offset else {}
+  start = time.monotonic()
+  with get_http_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+    if response.status_code == 416:
+      # The part is no shorter than the file, so it can't be a prefix of it
+      os.remove(part_path)
+      raise DownloadVerificationError(f'Partial download of {url.split("?")[0]} is larger than the file')
+    response.raise_for_status()
+    if offset and response.status_code != 206:
+      log.warning(f'Range requests are not supported for {url.split("?")[0]}, restarting the download')
+      offset = 0
+
+    expected_size = _expected_size(response, offset)
+    etag_match = MD5_ETAG.match(response.headers.get('ETag', ''))
+    md5 = hashlib.md5() if etag_match else None
+    if md5 and offset:
+      with open(part_path, 'rb') as part_file:
+        for chunk in iter(lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+          md5.update(chunk)
+
+    transferred = 0
+    with open(part_path, 'ab' if offset else 'wb') as part_file:
+      for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        part_file.write(chunk)
+        if md5:
+          md5.update(chunk)
+        transferred += len(chunk)
+
+  size = offset + transferred
+  try:
+    if expected_size is not None and size != expected_size:
+      raise DownloadVerificationError(f'Downloaded {size} of {expected_size} bytes from {url.split("?")[0]}')
+    if md5 and md5.hexdigest() != etag_match.group(1):
+      raise DownloadVerificationError(f'Checksum mismatch downloading {url.split("?")[0]}')
+  except DownloadVerificationError:
+    # A short read is resumed by the next attempt, anything else can't be trusted
+    if expected_size is None or size >= expected_size:
+      os.remove(part_path)
+    raise
+  os.replace(part_path, file_path)
+  return DownloadStats(size, transferred, time.monotonic() - start)
+
+
+# Attempts back off exponentially from half a second up to 30s, jittered so workers retrying together spread out
+@retry(stop_max_attempt_number=12, wait_exponential_multiplier=500, wait_exponential_max=30000, wait_jitter_max=1000)
+def download_fits(file_path: str, basename: str, source: str = 'archive', user: User = User.objects.none) -> DownloadStats | None:
+  """
+  Downloads a fits file to file_path, returning its DownloadStats, or None if file_path already exists.
+  Each retry resumes from what earlier attempts downloaded.
+  """
+  if os.path.isfile(file_path):
+    return None
+  # create the tmp directory if it doesn't exist
+  os.makedirs(settings.TEMP_FITS_DIR, exist_ok=True)
+
+  fits_url = get_fits_url(basename, source, user)
+  return stream_download(fits_url, file_path)
+
+def _fetch_range(fits_url: str, offset: int, length: int) -> bytes:
+  """
+  Fetches length bytes of the file at fits_url from offset, fewer at the end of the file
+  """
+  response = get_http_session().get(fits_url, headers={'Range': f'bytes={offset}-{offset + length - 1}'}, timeout=30)
+  if response.status_code == 416:
+    # The range starts past the end of the file
+    return b''
+  response.raise_for_status()
+  if response.status_code != 206:
+    # The server ignored the range and sent the whole file
+    log.warning(f'Range requests are not supported for {fits_url.split("?")[0]}')
+    return response.content[offset:offset + length]
+  return response.content
+
+
+def _padded_size(size: int) -> int:
+  return -(-size // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+
+
+def _fetch_fits_header(fits_url: str, offset: int) -> tuple:
+  """
+  Reads the header of the HDU starting at offset, returning (header, header size in bytes), or (None, 0) at the end of the file
+  """
+  header_bytes = b''
+  while True:
+    chunk = _fetch_range(fits_url, offset + len(header_bytes), HEADER_FETCH_BLOCKS * FITS_BLOCK_SIZE)
+    if not chunk:
+      if header_bytes:
+        raise ClientAlertException('Truncated fits header')
+      return None, 0
+    header_bytes += chunk
+    # The END card is the first card of an 80 character card image that starts with it
+    for end in range(0, len(header_bytes), 80):
+      if header_bytes[end:end + 8] == b'END     ':
+        header_size = _padded_size(end + 80)
+        return fits.Header.fromstring(header_bytes[:header_size].decode('ascii')), header_size
+
+
+def _fits_data_size(header: fits.Header) -> int:
+  """
+  Size in bytes of the data following a header, including the heap and padding to a whole block
+  """
+  naxis = header.get('NAXIS', 0)
+  if naxis == 0:
+    return 0
+  elements = 1
+  for axis in range(1, naxis + 1):
+    elements *= header[f'NAXIS{axis}']
+  bits = abs(header['BITPIX']) * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + elements)
+  return _padded_size(bits // 8)
+
+
+@retry(stop_max_attempt_number=12, wait_exponential_multiplier=500, wait_exponential_max=30000, wait_jitter_max=1000)
+def download_fits_metadata(file_path: str, basename: str, source: str = 'archive', user: User = User.objects.none):
+  """
+  Writes a slim copy of a tile compressed fits file to file_path, holding its primary header, the SCI header and the
+  CAT table, fetched with range requests so the compressed image itself is never downloaded. The SCI extension is
+  kept as an empty compressed table, so it reads as the image's header but has no pixels.
+  Falls back to downloading the whole file if it isn't laid out that way, e.g. has no CAT or an uncompressed SCI.
+  """
+  if os.path.isfile(file_path):
+    return False
+  os.makedirs(settings.TEMP_FITS_DIR, exist_ok=True)
+
+  fits_url = get_fits_url(basename, source, user)
+  slim_hdus = []
+  offset = 0
+  while True:
+    header, header_size = _fetch_fits_header(fits_url, offset)
+    if header is None:
+      break
+    data_size = _fits_data_size(header)
+    extension = header.get('EXTNAME')
+    if not slim_hdus:
+      if data_size:
+        break
+      slim_hdus.append(header.tostring().encode('ascii'))
+    elif extension == 'SCI':
+      if not header.get('ZIMAGE'):
+        break
+      header['NAXIS2'] = 0
+      header['PCOUNT'] = 0
+      header.remove('THEAP', ignore_missing=True)
+      slim_hdus.append(header.tostring().encode('ascii'))
+    elif extension == 'CAT':
+      if len(slim_hdus) == 2:
+        slim_hdus.append(header.tostring().encode('ascii') + _fetch_range(fits_url, offset + header_size, data_size))
+      break
+    offset += header_size + data_size
+
+  if len(slim_hdus) != 3:
+    log.info(f'{basename} has no compressed SCI and CAT extensions to fetch alone, downloading the whole file')
+    stream_download(fits_url, file_path)
     return True
-  return False
 
+  # Written under a temporary name, so a failed fetch never leaves a partial file at file_path
+  partial_path = f'{file_path}.partial'
+  try:
+    with open(partial_path, 'wb') as partial_file:
+      for hdu_bytes in slim_hdus:
+        partial_file.write(hdu_bytes)
+    os.replace(partial_path, file_path)
+  finally:
+    if os.path.isfile(partial_path):
+      os.remove(partial_path)
+  return True
 
-def save_files_to_s3(cache_key, format, file_paths: dict, index=None):
+
+def _output_uploads(cache_key, file_paths: dict, index=None) -> list:
   """
-  Save multiple files to S3, generating URLs and returning them in a structured output.
-  **file_paths args should follow convention of <annotation>_<file_type>_path
-  <annotation> will be appended to the bucket key for naming in S3
-  path extension will determine file type
+  Returns the (output key, s3 key, path) of each file to upload for save_files_to_s3
   """
   bucket_key = f'{cache_key}/{cache_key}-{index}' if index else f'{cache_key}/{cache_key}'
-  output = {
-    'basename': f'{cache_key}-{index}' if index else cache_key,
-    'source': 'datalab',
-    'type': format
-  }
- 
+  uploads = []
   for key, path in file_paths.items():
     parts = key.split('_')
     annotation = parts[0] if len(parts) == 3 else ''  # Extract annotation if available
@@ -178,8 +531,50 @@ def save_files_to_s3(cache_key, format, file_paths: dict, index=None):
 
     output_key = f"{annotation}_url" if annotation else f"{file_ext}_url"
     s3_key = f"{bucket_key}-{annotation}.{file_ext}" if annotation else f"{bucket_key}.{file_ext}"
+    uploads.append((output_key, s3_key, path))
+  return uploads
 
-    log.info(f"Uploading {path} to {s3_key}")
-    output[output_key] = add_file_to_bucket(s3_key, path)
-    
-  return output
+
+def save_batch_to_s3(cache_key, format, file_paths_by_index: dict, progress_callback=None) -> dict:
+  """
+  Saves many sets of files to S3 at once, e.g. one set per frame of an operation. Every file of every set is uploaded
+  concurrently through a pool of S3_UPLOAD_WORKERS threads, so the batch takes about as long as its slowest upload.
+  file_paths_by_index maps each set's index to its file_paths, following the conventions of save_files_to_s3.
+  Returns the index of each set mapped to the output save_files_to_s3 would give for it.
+  progress_callback, if given, is called from the calling thread with the fraction of files uploaded.
+  """
+  outputs = {}
+  uploads = []
+  for index, file_paths in file_paths_by_index.items():
+    outputs[index] = {
+      'basename': f'{cache_key}-{index}' if index else cache_key,
+      'source': 'datalab',
+      'type': format
+    }
+    uploads.extend((index, *upload) for upload in _output_uploads(cache_key, file_paths, index))
+  if not uploads:
+    return outputs
+
+  with ThreadPoolExecutor(max_workers=min(settings.S3_UPLOAD_WORKERS, len(uploads))) as executor:
+    futures = {}
+    for index, output_key, s3_key, path in uploads:
+      log.info(f"Uploading {path} to {s3_key}")
+      futures[executor.submit(add_file_to_bucket, s3_key, path)] = (index, output_key)
+    for uploaded, future in enumerate(as_completed(futures), start=1):
+      index, output_key = futures[future]
+      outputs[index][output_key] = future.result()
+      if progress_callback:
+        progress_callback(uploaded / len(uploads))
+
+  return outputs
+
+
+def save_files_to_s3(cache_key, format, file_paths: dict, index=None):
+  """
+  Save multiple files to S3, generating URLs and returning them in a structured output.
+  **file_paths args should follow convention of <annotation>_<file_type>_path
+  <annotation> will be appended to the bucket key for naming in S3
+  path extension will determine file type
+  The files are uploaded concurrently, see save_batch_to_s3
+  """
+  return save_batch_to_s3(cache_key, format, {index: file_paths})[index]
@@ -0,0 +1,48 @@
+import logging
+from typing import Callable, Iterator
+
+import numpy as np
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+def common_shape(arrays: list) -> tuple:
+    ''' The largest shape every array can be cropped to, as crop_arrays does '''
+    return min(array.shape[0] for array in arrays), min(array.shape[1] for array in arrays)
+
+
+def strip_rows(frames: int, width: int, itemsize: int, memory_budget: int) -> int:
+    ''' How many full rows of frames images of width pixels fit in memory_budget bytes at once, at least one '''
+    return max(1, memory_budget // max(1, frames * width * itemsize))
+
+
+def iter_strips(height: int, rows: int) -> Iterator[slice]:
+    ''' Yields the bands of rows rows covering height rows, top to bottom '''
+    for start in range(0, height, rows):
+        yield slice(start, min(start + rows, height))
+
+
+def strip_median(arrays: list, memory_budget: int, progress_callback: Callable[[float], None] = None) -> np.ndarray:
+    ''' The pixel-by-pixel median of arrays, cropped to their common shape, computed one band of rows at a time.
+        Only a band of every array is read at once, so arrays that are memory-mapped (like the FileCache's sidecars) or
+        read by section are never loaded whole, and the pixels held at once stay within memory_budget bytes whatever
+        the number of arrays. progress_callback is called with the fraction of rows done after each band.
+    '''
+    height, width = common_shape(arrays)
+    dtype = np.result_type(*(array.dtype for array in arrays))
+    rows = strip_rows(len(arrays), width, dtype.itemsize, memory_budget)
+    log.info(f'strip_median: {len(arrays)} frames of {height}x{width} in bands of {rows} rows')
+
+    # np.median gives floats of integer pixels
+    median = np.empty((height, width), dtype=dtype if dtype.kind == 'f' else np.float64)
+    band = np.empty((len(arrays), min(rows, height), width), dtype=dtype)
+    for strip in iter_strips(height, rows):
+        band_rows = strip.stop - strip.start
+        for index, array in enumerate(arrays):
+            band[index, :band_rows] = array[strip, :width]
+        # Partitions the band in place rather than sorting a copy of it
+        median[strip] = np.median(band[:, :band_rows], axis=0, overwrite_input=True)
+        if progress_callback:
+            progress_callback(strip.stop / height)
+    return median
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import math
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from datalab.datalab_session.utils.strips import iter_strips, strip_rows
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Each level of a pyramid is cut into square tiles of TILE_SIZE pixels a side
+TILE_SIZE = 256
+# Tile pyramids are cached in the FileCache as <TILE_PREFIX><hash>.npy
+TILE_PREFIX = 'tiles_'
+TILE_SUFFIX = '.npy'
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+UINT16_MAX = int(np.iinfo(np.uint16).max)
+
+
+def level_shapes(shape: tuple) -> list:
+    ''' The shape of every level of the pyramid of a frame of shape, from the frame itself at level 0 to the first level
+        that fits in a single tile, each half the size of the one before rounded up
+    '''
+    shapes = [tuple(shape)]
+    while max(shapes[-1]) > TILE_SIZE:
+        shapes.append(tuple(math.ceil(size / 2) for size in shapes[-1]))
+    return shapes
+
+
+def tile_grid(shape: tuple) -> tuple:
+    ''' The (rows, columns) of tiles covering a level of shape '''
+    return math.ceil(shape[0] / TILE_SIZE), math.ceil(shape[1] / TILE_SIZE)
+
+
+def tile_offsets(shape: tuple) -> list:
+    ''' The index in a pyramid's tiles of the first tile of every level above 0, the level at index 0 being level 1.
+        Level 0 isn't stored, since its tiles are read straight from the frame.
+    '''
+    offsets, offset = [], 0
+    for level_shape in level_shapes(shape)[1:]:
+        offsets.append(offset)
+        rows, columns = tile_grid(level_shape)
+        offset += rows * columns
+    return offsets + [offset]
+
+
+def tile_dtype(minimum: float, maximum: float, integer: bool) -> np.dtype:
+    ''' The most compact dtype tiles of pixels from minimum to maximum can be stored in: uint16 for integer pixels that
+        fit, else float16 if they fit in its range and float32 if they don't
+    '''
+    if integer and minimum >= 0 and maximum <= UINT16_MAX:
+        return np.dtype(np.uint16)
+    if max(abs(minimum), abs(maximum)) <= FLOAT16_MAX:
+        return np.dtype(np.float16)
+    return np.dtype(np.float32)
+
+
+def to_tile_dtype(data: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    ''' data converted to dtype, rounding to the nearest integer for integer dtypes '''
+    if dtype.kind == 'u':
+        data = np.rint(data)
+    return np.asarray(data, dtype=dtype)
+
+
+def _downsample(data: np.ndarray) -> np.ndarray:
+    # The mean of every 2x2 block of data, the last row and column repeated to fill the blocks of odd sizes
+    data = np.asarray(data, dtype=np.float32)
+    if data.shape[0] % 2 or data.shape[1] % 2:
+        data = np.pad(data, ((0, data.shape[0] % 2), (0, data.shape[1] % 2)), mode='edge')
+    return (data[0::2, 0::2] + data[1::2, 0::2] + data[0::2, 1::2] + data[1::2, 1::2]) / 4
+
+
+def _finite_range(data: np.ndarray) -> tuple:
+    finite = data[np.isfinite(data)]
+    return (float(finite.min()), float(finite.max())) if finite.size else (0.0, 0.0)
+
+
+def build_levels(sci_data: np.ndarray, memory_budget: int) -> tuple:
+    ''' The levels above 0 of the pyramid of sci_data as float32 arrays, and the finite (minimum, maximum) of its
+        pixels. Level 1 is downsampled from sci_data a band of rows at a time, so a memory-mapped frame is never read
+        whole, and the later, smaller levels from the level before.
+    '''
+    shapes = level_shapes(sci_data.shape)
+    if len(shapes) == 1:
+        return [], _finite_range(np.asarray(sci_data))
+
+    # Bands of an even number of rows, so each downsamples on its own
+    rows = max(2, strip_rows(1, sci_data.shape[1], np.dtype(np.float32).itemsize, memory_budget) // 2 * 2)
+    level = np.empty(shapes[1], dtype=np.float32)
+    minimum, maximum = math.inf, -math.inf
+    for strip in iter_strips(sci_data.shape[0], rows):
+        band = np.asarray(sci_data[strip], dtype=np.float32)
+        band_minimum, band_maximum = _finite_range(band)
+        minimum, maximum = min(minimum, band_minimum), max(maximum, band_maximum)
+        level[strip.start // 2:math.ceil(strip.stop / 2)] = _downsample(band)
+    levels = [level]
+    for _ in shapes[2:]:
+        levels.append(_downsample(levels[-1]))
+    return levels, (minimum, maximum) if minimum <= maximum else (0.0, 0.0)
+
+
+def pyramid_cache_key(file_key: str) -> str:
+    ''' The FileCache key of the tile pyramid of the cached file with file_key '''
+    digest = hashlib.sha256(f'{file_key}|{TILE_SIZE}'.encode('utf-8')).hexdigest()
+    return f'{TILE_PREFIX}{digest[:32]}'
+
+
+def write_pyramid(directory: str, cache_key: str, sci_data: np.ndarray, integer: bool, memory_budget: int) -> str:
+    ''' Builds the pyramid of sci_data and writes its tiles, levels above 0 in order and each level's tiles row by row,
+        to the file its cache_key is stored under in directory, returning its path. The tiles are stored in the
+        tile_dtype of the frame's pixels, those past the edge of a level NaN or 0 for integer tiles.
+    '''
+    levels, (minimum, maximum) = build_levels(sci_data, memory_budget)
+    dtype = tile_dtype(minimum, maximum, integer)
+    offsets = tile_offsets(sci_data.shape)
+    log.info(f'write_pyramid: {len(levels)} levels of {offsets[-1]} {dtype} tiles for a {sci_data.shape} frame')
+
+    file_path = os.path.join(directory, f'{cache_key}{TILE_SUFFIX}')
+    # Written under a temporary name and renamed into place, so readers never map a partially written pyramid
+    partial_path = f'{file_path}.{uuid.uuid4().hex}{TILE_SUFFIX}'
+    try:
+        tiles = np.lib.format.open_memmap(partial_path, mode='w+', dtype=dtype, shape=(offsets[-1], TILE_SIZE, TILE_SIZE))
+        tiles[:] = 0 if dtype.kind == 'u' else np.nan
+        for level, offset in zip(levels, offsets):
+            columns = tile_grid(level.shape)[1]
+            for row in range(tile_grid(level.shape)[0]):
+                for column in range(columns):
+                    tile = level[row * TILE_SIZE:(row + 1) * TILE_SIZE, column * TILE_SIZE:(column + 1) * TILE_SIZE]
+                    tiles[offset + row * columns + column, :tile.shape[0], :tile.shape[1]] = to_tile_dtype(tile, dtype)
+        tiles.flush()
+        del tiles
+        os.replace(partial_path, file_path)
+    finally:
+        Path(partial_path).unlink(missing_ok=True)
+    return file_path
+
+
+def read_tile(sci_data: np.ndarray, tiles: np.ndarray, level: int, row: int, column: int) -> np.ndarray:
+    ''' The tile at row and column of a level of the pyramid of sci_data whose stored tiles are tiles, cropped to the
+        edge of the level. Level 0 tiles are read from sci_data itself and converted to the tiles' dtype.
+    '''
+    shape = level_shapes(sci_data.shape)[level]
+    height = min(TILE_SIZE, shape[0] - row * TILE_SIZE)
+    width = min(TILE_SIZE, shape[1] - column * TILE_SIZE)
+    if level == 0:
+        tile = sci_data[row * TILE_SIZE:row * TILE_SIZE + height, column * TILE_SIZE:column * TILE_SIZE + width]
+        return to_tile_dtype(tile, tiles.dtype)
+    index = tile_offsets(sci_data.shape)[level - 1] + row * tile_grid(shape)[1] + column
+    return tiles[index, :height, :width]
@@ -11,6 +11,7 @@ from datalab.datalab_session.analysis.source_catalog import source_catalog
 from datalab.datalab_session.analysis.get_tif import get_tif
 from datalab.datalab_session.analysis.get_jpg import get_jpg
 from datalab.datalab_session.analysis.raw_data import raw_data
+from datalab.datalab_session.analysis.tiles import tiles
 from datalab.datalab_session.analysis.wcs import wcs
 from datalab.datalab_session.exceptions import ClientAlertException
 
@@ -38,6 +39,7 @@ class AnalysisView(RetrieveAPIView):
         "get-tif": get_tif,
         "get-jpg": get_jpg,
         "raw-data": raw_data,
+        "tiles": tiles,
         "wcs": wcs
     }
 
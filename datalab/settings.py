@@ -133,9 +133,17 @@ DRAMATIQ_TASKS_DATABASE = 'default'
 
 # AWS S3 Bitbucket
 DATALAB_OPERATION_BUCKET = os.getenv('DATALAB_OPERATION_BUCKET', 'datalab-operation-output-lco-global')
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50))  # Connections the shared S3 client keeps open for concurrent uploads and lookups
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS', 8))  # Files a batch of operation outputs uploads at once
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024))  # Files from this size up are uploaded in parts
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024))  # Size of each part of a multipart upload
+S3_MULTIPART_CONCURRENCY = int(os.getenv('S3_MULTIPART_CONCURRENCY', 4))  # Parts of one file uploaded at once
 
 # Datalab Archive
 ARCHIVE_API = os.getenv('ARCHIVE_API', 'https://archive-api.lco.global')
+ARCHIVE_URL_CACHE_TTL = int(os.getenv('ARCHIVE_URL_CACHE_TTL', 3600))  # Seconds a resolved frame url is reused, kept well below the url's expiry
+ARCHIVE_LOOKUP_WORKERS = int(os.getenv('ARCHIVE_LOOKUP_WORKERS', 8))  # Concurrent frame lookups when resolving a batch of basenames
+COLOR_IMAGE_TRANSFORM_CACHE_TTL = int(os.getenv('COLOR_IMAGE_TRANSFORM_CACHE_TTL', 7 * 24 * 3600))  # Seconds the transform aligning one image onto another is reused by color images
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -159,6 +167,18 @@ CACHES = {
 }
 
 FILECACHE_TOTAL_SIZE = int(os.getenv('FILECACHE_TOTAL_SIZE', 2 * 104857600))  # Size in bytes for the file cache
+FILECACHE_PREFETCH_WORKERS = int(os.getenv('FILECACHE_PREFETCH_WORKERS', 8))  # Concurrent downloads when prefetching an operation's inputs
+FILECACHE_SCI_SIDECARS = str2bool(os.getenv('FILECACHE_SCI_SIDECARS', 'true'))  # Keep decompressed SCI pixels next to cached files
+FILECACHE_EVICTION_STRATEGY = os.getenv('FILECACHE_EVICTION_STRATEGY', 'lru')  # Which cached files to evict first, 'lru' or 'gdsf'
+FILECACHE_SCAN_THRESHOLD = int(os.getenv('FILECACHE_SCAN_THRESHOLD', 50))  # Prefetches of more files than this are bulk inputs, cached as a scan
+FILECACHE_TRACE_PATH = os.getenv('FILECACHE_TRACE_PATH', '')  # If set, every get_fits access is appended here for simulate_file_cache
+
+FITS_OUTPUT_COMPRESSION = os.getenv('FITS_OUTPUT_COMPRESSION', 'science')  # Compression profile of operation outputs, 'science' (lossless) or 'preview'
+FITS_COMPRESSION_WORKERS = int(os.getenv('FITS_COMPRESSION_WORKERS', os.cpu_count()))  # Threads compressing the tiles of one output
+
+OPERATION_MEMORY_BUDGET = int(os.getenv('OPERATION_MEMORY_BUDGET', 512 * 1024 * 1024))  # Bytes of pixels an operation working in bands of rows, or batches of frames, holds at once
+REPROJECT_WORKERS = int(os.getenv('REPROJECT_WORKERS', os.cpu_count()))  # Processes reprojecting the inputs of one stack
+REPROJECT_WORKER_MEMORY_LIMIT = int(os.getenv('REPROJECT_WORKER_MEMORY_LIMIT', 0))  # Bytes of address space each reprojection process may use, 0 for no limit
 
 CONTAINER_TYPE = os.getenv('CONTAINER_TYPE', 'server')
 